@@ -9,9 +9,10 @@ if typing.TYPE_CHECKING:
 
 def register_plugin(app: Application):
     from . import signals  # noqa
-    from . import lock
-    from .cli import antivirus
-    from .models import setup_listener
+    from . import lock, renditions, search, tasks
+    from .cli import antivirus, documents
+    from .models import INDEXED_TEXT_LIMIT, setup_listener
+    from .repository import DEFAULT_PAGE_SIZE, DELETE_TASK_THRESHOLD
     from .views import blueprint
 
     app.register_blueprint(blueprint)
@@ -20,4 +21,32 @@ def register_plugin(app: Application):
     # set default lock lifetime
     app.config.setdefault("SBE_LOCK_LIFETIME", lock.DEFAULT_LIFETIME)
 
+    # number of objects per page in folder listings
+    app.config.setdefault("SBE_FOLDER_PAGE_SIZE", DEFAULT_PAGE_SIZE)
+
+    # folders with more descendants are deleted by a background task
+    app.config.setdefault("SBE_DELETE_TASK_THRESHOLD", DELETE_TASK_THRESHOLD)
+
+    # number of objects written at once when reindexing a folder tree
+    app.config.setdefault("SBE_REINDEX_BATCH_SIZE", search.REINDEX_BATCH_SIZE)
+
+    # security changes are reindexed at once after this delay, in seconds
+    app.config.setdefault("SBE_REINDEX_DELAY", search.REINDEX_DELAY)
+
+    # maximum size of the preview images cache on disk, in bytes
+    app.config.setdefault("SBE_RENDITION_CACHE_SIZE", renditions.DEFAULT_CACHE_SIZE)
+
+    # documents committed at once are processed by tasks of this size
+    app.config.setdefault("SBE_PROCESS_BATCH_SIZE", tasks.PROCESS_BATCH_SIZE)
+
+    # extracted text is truncated to this number of characters when indexed
+    app.config.setdefault("SBE_INDEXED_TEXT_LIMIT", INDEXED_TEXT_LIMIT)
+
+    search.init_app(app)
+
+    # remove expired locks periodically
+    schedule = app.config.setdefault("CELERYBEAT_SCHEDULE", {})
+    schedule.setdefault(tasks.LOCK_REAPER_TASK_NAME, tasks.DEFAULT_LOCK_REAPER_SCHEDULE)
+
     app.cli.add_command(antivirus)
+    app.cli.add_command(documents)
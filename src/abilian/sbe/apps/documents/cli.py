@@ -1,17 +1,56 @@
 from __future__ import annotations
 
+import functools
+import multiprocessing
+import os
+import queue
+import time
+from collections import deque
+from pathlib import Path
+from typing import Iterator
+
 import click
 import sqlalchemy as sa
 import sqlalchemy.orm
+from flask import Flask, current_app
 from flask.cli import with_appcontext
 
-from . import tasks
+from abilian.core.extensions import db
+from abilian.services import converter
+
+from . import models, tasks
 from .models import Document
 
+#: documents scanned by each task of `antivirus`
+ANTIVIRUS_CHUNK_SIZE = 100
+
+#: seconds between two progress reports of `reprocess`
+REPORT_INTERVAL = 10
+
+#: completed documents between two checkpoint writes
+CHECKPOINT_INTERVAL = 100
+
+#: seconds to wait for a document processed by a worker of `reprocess`
+#: before giving up, e.g. when a worker was killed
+RESULT_TIMEOUT = 600
+
 
 @click.command()
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=ANTIVIRUS_CHUNK_SIZE,
+    show_default=True,
+    help="Number of documents scanned by each task.",
+)
+@click.option(
+    "--rate",
+    type=float,
+    default=0,
+    help="Maximum number of documents scanned per second. Default: no limit.",
+)
 @with_appcontext
-def antivirus():
+def antivirus(chunk_size: int, rate: float):
     """Schedule documents to antivirus scan."""
 
     documents = Document.query.filter(Document.content_blob != None).options(
@@ -21,12 +60,236 @@ def antivirus():
     )
 
     total = 0
-    count = 0
+    to_scan = []
     for d in documents.yield_per(1000):
         total += 1
         meta = d.content_blob.meta
         if "antivirus" not in meta and "antivirus_task" not in meta:
-            tasks.antivirus_scan.delay(d.id)
-            count += 1
+            to_scan.append((d.id,))
+
+    if to_scan:
+        # one message per chunk, chunks are spread over time if rate limited
+        scans = tasks.antivirus_scan.chunks(to_scan, chunk_size).group()
+        if rate:
+            scans = scans.skew(step=chunk_size / rate)
+        scans.apply_async()
+
+    print(f"{len(to_scan)}/{total} documents scheduled")
+
+
+@click.group()
+def documents():
+    """Folders / documents commands."""
+
+
+@documents.command("fill-ancestor-paths")
+@with_appcontext
+def fill_ancestor_paths():
+    """Compute the materialized path of folders and documents that have
+    none."""
+    count = models.fill_ancestor_paths(db.session())
+    db.session.commit()
+    print(f"{count} objects updated")
+
+
+@documents.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of documents processed at once.",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="File recording progress. Defaults to the instance folder.",
+)
+@click.option("--restart", is_flag=True, help="Ignore a previous checkpoint.")
+@with_appcontext
+def reprocess(jobs: int, checkpoint: str | None, restart: bool):
+    """Compute missing PDF, text, metadata and preview of documents.
+
+    Documents are processed in this process and its workers, not by Celery.
+    Progress is saved in a checkpoint file: when interrupted, the command
+    resumes where it stopped.
+    """
+    if checkpoint is None:
+        checkpoint_path = Path(current_app.instance_path, "reprocess.checkpoint")
+    else:
+        checkpoint_path = Path(checkpoint)
+
+    start_id = 0
+    if not restart and checkpoint_path.exists():
+        start_id = int(checkpoint_path.read_text())
+        click.echo(f"Resuming after document {start_id}")
+
+    progress = _Progress(checkpoint_path, start_id)
+
+    if jobs <= 1:
+        for document_id, stages in _documents_to_process(start_id):
+            progress.started(document_id)
+            progress.done(*_reprocess_document(document_id, stages))
+    else:
+        # workers must not share the connections of this process
+        db.session.remove()
+        db.engine.dispose()
+        context = multiprocessing.get_context("fork")
+        results: queue.Queue[tuple[int, list[str]]] = queue.Queue()
+        with context.Pool(
+            jobs,
+            initializer=_init_worker,
+            initargs=(current_app._get_current_object(),),
+        ) as pool:
+            for document_id, stages in _documents_to_process(start_id):
+                while progress.in_flight >= 2 * jobs:
+                    progress.done(*_next_result(results, progress))
+                progress.started(document_id)
+                pool.apply_async(
+                    _reprocess_document,
+                    (document_id, stages),
+                    callback=results.put,
+                    error_callback=functools.partial(
+                        _worker_failed, results, document_id, stages
+                    ),
+                )
+            while progress.in_flight:
+                progress.done(*_next_result(results, progress))
+
+    progress.finish()
+
+
+def _documents_to_process(start_id: int) -> Iterator[tuple[int, list[str]]]:
+    """Yield (document id, missing stages) for documents after `start_id`."""
+    query = (
+        db.session.query(
+            Document.id,
+            Document._pdf_id,
+            Document._text_id,
+            Document.extra_metadata_json,
+            Document.content_digest,
+            Document.content_type,
+        )
+        .filter(Document._content_id != None, Document.id > start_id)
+        .order_by(Document.id)
+    )
+
+    for row in query.yield_per(1000):
+        missing = {
+            "pdf": row._pdf_id is None,
+            "text": row._text_id is None,
+            "metadata": row.extra_metadata_json is None,
+            "preview": not converter.has_image(
+                row.content_digest, row.content_type, 0, Document.PREVIEW_SIZE
+            ),
+        }
+        stages = [stage for stage in tasks.STAGES if missing[stage]]
+        if stages:
+            yield row.id, stages
+
+
+def _init_worker(app: Flask):
+    app.app_context().push()
+
+
+def _worker_failed(
+    results: queue.Queue, document_id: int, stages: list[str], error: BaseException
+):
+    tasks.logger.error("Reprocessing failed for document %s: %r", document_id, error)
+    results.put((document_id, stages))
+
+
+def _next_result(results: queue.Queue, progress: _Progress) -> tuple[int, list[str]]:
+    """Wait for a document processed by a worker: return (document id,
+    failed stages)."""
+    try:
+        return results.get(timeout=RESULT_TIMEOUT)
+    except queue.Empty:
+        progress.save()
+        raise click.ClickException(
+            f"No document processed for {RESULT_TIMEOUT}s, aborting. "
+            "Run the command again to resume."
+        )
+
+
+def _reprocess_document(document_id: int, stages: list[str]) -> tuple[int, list[str]]:
+    """Return (document id, failed stages).
+
+    Like :func:`tasks.process_document`, content not scanned yet is scanned
+    first, and content that isn't safe to read isn't processed.
+    """
+    try:
+        with tasks.get_document(document_id) as (session, document):
+            if document is None:
+                return document_id, []
+            if document.antivirus_status is None:
+                tasks._run_antivirus(document)
+            if not document.antivirus_ok:
+                return document_id, []
+            _timings, failed = tasks.run_stages(document, stages)
+    except Exception:
+        tasks.logger.error(
+            "Reprocessing failed for document %s", document_id, exc_info=True
+        )
+        failed = stages
+    return document_id, failed
+
+
+class _Progress:
+    """Counts processed documents, reports throughput and saves the
+    checkpoint: the highest id below which all documents are done."""
+
+    def __init__(self, checkpoint_path: Path, start_id: int):
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = start_id
+        self.pending: deque[int] = deque()
+        self.completed: set[int] = set()
+        self.count = 0
+        self.failed: list[int] = []
+        self.start = self.last_report = time.monotonic()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending) - len(self.completed)
+
+    def started(self, document_id: int):
+        self.pending.append(document_id)
+
+    def done(self, document_id: int, failed: list[str]):
+        self.count += 1
+        if failed:
+            self.failed.append(document_id)
+
+        self.completed.add(document_id)
+        while self.pending and self.pending[0] in self.completed:
+            self.completed.remove(self.pending[0])
+            self.checkpoint = self.pending.popleft()
+
+        if self.count % CHECKPOINT_INTERVAL == 0:
+            self.save()
+
+        now = time.monotonic()
+        if now - self.last_report >= REPORT_INTERVAL:
+            self.last_report = now
+            click.echo(f"{self.count} documents, {self.rate:.1f} documents/s")
+
+    @property
+    def rate(self) -> float:
+        return self.count / max(time.monotonic() - self.start, 1e-6)
+
+    def save(self):
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint_path.with_name(self.checkpoint_path.name + ".tmp")
+        tmp_path.write_text(str(self.checkpoint))
+        tmp_path.replace(self.checkpoint_path)
 
-    print(f"{count}/{total} documents scheduled")
+    def finish(self):
+        self.save()
+        elapsed = time.monotonic() - self.start
+        click.echo(
+            f"{self.count} documents processed in {elapsed:.0f}s "
+            f"({self.rate:.1f} documents/s), {len(self.failed)} failed"
+        )
+        if self.failed:
+            click.echo("Failed documents: " + " ".join(map(str, self.failed)))
@@ -247,19 +247,9 @@ def deleteObject():
     log.debug(f"URL: {request.url}")
 
     obj = get_object(id)
-
-    # TODO: remove
-    parent = obj.parent
-    if parent:
-        child_count_0 = len(parent.children)
-
-    db.session.delete(obj)
+    repository.delete_object(obj)
     db.session.commit()
 
-    if parent:
-        child_count_1 = len(parent.children)
-        assert child_count_1 == child_count_0 - 1
-
     return ("", 204, {})
 
 
@@ -458,7 +448,7 @@ def deleteTree():
     log.debug(f"deleteTree called on {id}")
 
     obj = get_object(id)
-    db.session.delete(obj)
+    repository.delete_object(obj)
     db.session.commit()
 
     return ("", 204, {})
@@ -1,17 +1,57 @@
 from __future__ import annotations
 
+import math
+import uuid
 from datetime import datetime, timedelta
 from typing import Any
 
 import dateutil.parser
+import pytz
+import sqlalchemy as sa
 from flask import current_app
 from flask_login import current_user
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.types import DateTime, Integer, String, UnicodeText
 
+from abilian.core.extensions import db
 from abilian.core.models.subjects import User
 from abilian.core.util import utcnow
 
 DEFAULT_LIFETIME = 3600
 
+#: WebDAV lock depths
+DEPTH_ZERO = "0"
+DEPTH_INFINITY = "infinity"
+
+#: one exclusive lock per object, see :func:`acquire`
+object_lock = sa.Table(
+    "object_lock",
+    db.metadata,
+    Column(
+        "object_id",
+        Integer,
+        ForeignKey("cmisobject.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column("token", String(36), nullable=False, unique=True),
+    Column(
+        "owner_id",
+        Integer,
+        ForeignKey(User.id, ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    ),
+    Column("owner", UnicodeText, nullable=False),
+    Column("depth", String(8), nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+)
+
+
+class LockedError(RuntimeError):
+    """The object is already locked by another user."""
+
 
 class Lock:
     """Represent a lock on a document."""
@@ -22,6 +62,9 @@ class Lock:
         user: str,
         date: datetime | str,
         *args: Any,
+        token: str | None = None,
+        depth: str = DEPTH_ZERO,
+        expires_at: datetime | None = None,
         **kwargs: Any,
     ):
         self.user_id = user_id
@@ -33,11 +76,26 @@ class Lock:
                 raise ValueError(f"Error parsing date: {date!r}") from e
 
         self.date = date
+        self.token = token
+        self.depth = depth
+        self.expires_at = expires_at
 
     @staticmethod
     def new() -> Lock:
         return Lock(current_user.id, str(current_user), utcnow())
 
+    @staticmethod
+    def from_row(row: Any) -> Lock:
+        """Build from a row of :data:`object_lock`."""
+        return Lock(
+            row.owner_id,
+            row.owner,
+            _aware(row.created_at),
+            token=row.token,
+            depth=row.depth,
+            expires_at=_aware(row.expires_at),
+        )
+
     def as_dict(self) -> dict[str, Any]:
         """Return a dict suitable for serialization to JSON."""
         return {
@@ -57,10 +115,155 @@ class Lock:
 
     @property
     def expired(self) -> bool:
+        if self.expires_at is not None:
+            return utcnow() >= self.expires_at
         return (utcnow() - self.date) > timedelta(seconds=self.lifetime)
 
+    @property
+    def timeout(self) -> int:
+        """Seconds before expiration."""
+        if self.expires_at is None:
+            expires_at = self.date + timedelta(seconds=self.lifetime)
+        else:
+            expires_at = self.expires_at
+        return max(math.ceil((expires_at - utcnow()).total_seconds()), 0)
+
     def is_owner(self, user: User | None = None) -> bool:
         if user is None:
             user = current_user
 
         return self.user_id == user.id
+
+
+def get_lock(session: Session, object_id: int) -> Lock | None:
+    """Return the lock on an object, or `None` if not locked or expired."""
+    query = object_lock.select().where(
+        sa.and_(
+            object_lock.c.object_id == object_id,
+            object_lock.c.expires_at > _now(),
+        )
+    )
+    row = session.execute(query).first()
+    return Lock.from_row(row) if row is not None else None
+
+
+def acquire(
+    session: Session,
+    object_id: int,
+    user: User,
+    timeout: int | None = None,
+    depth: str = DEPTH_ZERO,
+) -> Lock:
+    """Lock an object for `user`, for `timeout` seconds (at most
+    `SBE_LOCK_LIFETIME`).
+
+    A lock already held by `user` is refreshed, and keeps its token. Raise
+    :class:`LockedError` if another user holds the lock.
+    """
+    timeout = _timeout(timeout)
+    now = _now()
+    lock = get_lock(session, object_id)
+    if lock is not None and lock.user_id != user.id:
+        raise LockedError("This document is already locked by another user")
+    if lock is not None and lock.token is not None:
+        refreshed = refresh(session, object_id, lock.token, timeout)
+        # expired or released meanwhile: a new lock is taken
+        if refreshed is not None:
+            return refreshed
+
+    # an expired lock may remain until reaped
+    session.execute(
+        object_lock.delete().where(
+            sa.and_(
+                object_lock.c.object_id == object_id,
+                object_lock.c.expires_at <= now,
+            )
+        )
+    )
+    values = {
+        "object_id": object_id,
+        "token": str(uuid.uuid4()),
+        "owner_id": user.id,
+        "owner": str(user),
+        "depth": depth,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=timeout),
+    }
+    try:
+        with session.begin_nested():
+            session.execute(object_lock.insert().values(**values))
+    except sa.exc.IntegrityError as e:
+        # locked concurrently
+        raise LockedError("This document is already locked by another user") from e
+
+    return Lock(
+        user.id,
+        values["owner"],
+        _aware(now),
+        token=values["token"],
+        depth=depth,
+        expires_at=_aware(values["expires_at"]),
+    )
+
+
+def refresh(
+    session: Session, object_id: int, token: str, timeout: int | None = None
+) -> Lock | None:
+    """Extend the lock with `token`. Return `None` if there is no such lock,
+    or if it has expired."""
+    timeout = _timeout(timeout)
+    now = _now()
+    statement = (
+        object_lock.update()
+        .where(
+            sa.and_(
+                object_lock.c.object_id == object_id,
+                object_lock.c.token == token,
+                object_lock.c.expires_at > now,
+            )
+        )
+        .values(expires_at=now + timedelta(seconds=timeout))
+    )
+    if not session.execute(statement).rowcount:
+        return None
+    return get_lock(session, object_id)
+
+
+def release(session: Session, object_id: int, token: str | None = None) -> bool:
+    """Remove the lock on an object, only if it has `token` when given.
+
+    Return `False` if there was no such lock.
+    """
+    condition = object_lock.c.object_id == object_id
+    if token is not None:
+        condition = sa.and_(condition, object_lock.c.token == token)
+    return bool(session.execute(object_lock.delete().where(condition)).rowcount)
+
+
+def delete_expired(session: Session) -> int:
+    """Remove expired locks, return their number."""
+    statement = object_lock.delete().where(object_lock.c.expires_at <= _now())
+    return session.execute(statement).rowcount
+
+
+def locked_ids(user: User) -> sa.sql.Select:
+    """Return a query of the ids of the objects locked by `user`."""
+    return sa.select([object_lock.c.object_id]).where(
+        sa.and_(object_lock.c.owner_id == user.id, object_lock.c.expires_at > _now())
+    )
+
+
+def _timeout(timeout: int | None) -> int:
+    lifetime = current_app.config.get("SBE_LOCK_LIFETIME", DEFAULT_LIFETIME)
+    if timeout is None or timeout <= 0:
+        return lifetime
+    return min(timeout, lifetime)
+
+
+def _now() -> datetime:
+    # naive datetimes in UTC are stored
+    return utcnow().replace(tzinfo=None)
+
+
+def _aware(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=pytz.utc)
@@ -4,13 +4,18 @@ TODO: move to an independent service / app.
 """
 from __future__ import annotations
 
+import codecs
+import hashlib
 import itertools
 import logging
 import mimetypes
 import threading
 import uuid
+import zlib
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Collection, Iterator
+from typing import IO, TYPE_CHECKING, Any, Collection, Iterable, Iterator, cast
 
 import pkg_resources
 import sqlalchemy as sa
@@ -20,24 +25,32 @@ from flask_login import current_user
 from sqlalchemy.event import listen, listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref, foreign, relationship, remote
-from sqlalchemy.orm.attributes import Event
+from sqlalchemy.orm.attributes import Event, set_committed_value
 from sqlalchemy.orm.session import Session
 from sqlalchemy.schema import Column, ForeignKey, UniqueConstraint
 from sqlalchemy.types import Integer, Text, UnicodeText
 from sqlalchemy.util.langhelpers import symbol
-from toolz import first
 from whoosh.analysis import CharsetFilter, LowercaseFilter, RegexTokenizer
 from whoosh.support.charset import accent_map
 
 from abilian.core.entities import Entity, db
-from abilian.core.models import NOT_AUDITABLE, SEARCHABLE
+from abilian.core.models import NOT_AUDITABLE, SEARCHABLE, SYSTEM
 from abilian.core.models.blob import Blob
-from abilian.core.models.subjects import Group, User
+from abilian.core.models.subjects import Group, User, membership
 from abilian.core.util import md5
 from abilian.services.conversion import converter
 from abilian.services.indexing import indexable_role
-from abilian.services.security import Admin, Anonymous, InheritSecurity, security
+from abilian.services.repository import repository as blob_repository
+from abilian.services.security import (
+    READ,
+    Admin,
+    Anonymous,
+    InheritSecurity,
+    RoleAssignment,
+    security,
+)
 
+from . import lock as locking
 from . import tasks
 from .lock import Lock
 
@@ -62,6 +75,12 @@ accent_folder = RegexTokenizer() | LowercaseFilter() | CharsetFilter(accent_map)
 
 ICONS_FOLDER = pkg_resources.resource_filename("abilian.sbe", "static/fileicons")
 
+#: default maximum number of characters of extracted text that are indexed
+INDEXED_TEXT_LIMIT = 1000000
+
+#: bytes of text blob read at once by :meth:`Document.iter_text`
+TEXT_CHUNK_SIZE = 64 * 1024
+
 
 def icon_url(filename: str) -> str:
     return url_for("abilian_sbe_static", filename=f"fileicons/{filename}")
@@ -99,6 +118,11 @@ class CmisObject(InheritSecurity, Entity):
 
     _parent_id = Column(Integer, ForeignKey("cmisobject.id"), nullable=True)
 
+    #: Materialized path of ancestor ids, root first: "/1/3/4/" ("/" for a root
+    #: folder). Maintained at flush time, see :func:`_cmis_insert_ancestor_path`
+    #: and :func:`_cmis_update_ancestor_path`.
+    _ancestor_path = Column("ancestor_path", Text, index=True, info=SYSTEM)
+
     # no duplicate name in same folder
     __table_args__ = (UniqueConstraint("_parent_id", "title"),)
 
@@ -162,11 +186,94 @@ class CmisObject(InheritSecurity, Entity):
 
     @property
     def path(self) -> str:
-        if self.parent:
-            return f"{self.parent.path}/{self.title}"
-        else:
+        ancestors = self.ancestors
+        if not ancestors:
             return ""
 
+        parent_path = "".join(f"/{obj.title}" for obj in ancestors[1:])
+        return f"{parent_path}/{self.title}"
+
+    @property
+    def ancestor_ids(self) -> list[int]:
+        """Ids of the ancestors of this object, root folder first."""
+        if self._has_current_ancestor_path():
+            return [int(id) for id in self._ancestor_path.split("/") if id]
+
+        return [obj.id for obj in reversed(list(self._iter_parents()))]
+
+    @property
+    def ancestors(self) -> list[Folder]:
+        """Ancestors of this object, root folder first.
+
+        For persisted objects they are read with a single query using
+        the materialized path, instead of loading `parent` one level at
+        a time.
+        """
+        if not self._has_current_ancestor_path():
+            return list(reversed(list(self._iter_parents())))
+
+        cached = getattr(self, "_ancestors_cache", None)
+        if cached is not None and cached[0] == self._ancestor_path:
+            return cached[1]
+
+        ids = self.ancestor_ids
+        session = sa.orm.object_session(self)
+        mapper = sa.inspect(Folder)
+        by_id = {}
+        for id in ids:
+            obj = session.identity_map.get(mapper.identity_key_from_primary_key([id]))
+            if obj is not None:
+                by_id[id] = obj
+
+        missing = [id for id in ids if id not in by_id]
+        if missing:
+            with session.no_autoflush:
+                query = session.query(Folder).filter(Folder.id.in_(missing))
+                # don't load siblings of ancestors
+                query = query.options(
+                    sa.orm.lazyload(Folder.subfolders),
+                    sa.orm.lazyload(Folder.documents),
+                )
+                by_id.update((obj.id, obj) for obj in query)
+
+        ancestors = [by_id[id] for id in ids if id in by_id]
+        self._ancestors_cache = (self._ancestor_path, ancestors)
+        return ancestors
+
+    def _iter_parents(self) -> Iterator[Folder]:
+        obj = self.parent
+        while obj is not None:
+            yield obj
+            obj = obj.parent
+
+    def _has_current_ancestor_path(self) -> bool:
+        """True if the stored materialized path can be trusted.
+
+        It is not the case for objects not yet flushed, or when some
+        object has been moved in the session and not yet flushed.
+        """
+        state = sa.inspect(self)
+        if not state.persistent or self._ancestor_path is None:
+            return False
+
+        for obj in state.session.dirty:
+            if not isinstance(obj, CmisObject):
+                continue
+            attrs = sa.inspect(obj).attrs
+            if (
+                attrs._parent_id.history.has_changes()
+                or attrs.parent.history.has_changes()
+            ):
+                return False
+
+        return True
+
+    def _ancestor_path_for_children(self) -> str:
+        path = self._ancestor_path
+        if path is None:
+            path = "/" + "".join(f"{id}/" for id in self.ancestor_ids)
+        return f"{path}{self.id}/"
+
     @property
     def is_folder(self) -> bool:
         return self.sbe_type == "cmis:folder"
@@ -205,6 +312,134 @@ def _cmis_sync_name_title(
     return new_value
 
 
+@listens_for(CmisObject, "before_insert", propagate=True)
+def _cmis_insert_ancestor_path(
+    mapper: sa.orm.Mapper, connection: sa.engine.Connection, target: CmisObject
+):
+    """Set materialized path of new objects.
+
+    Parents are inserted before their children, so their id and path
+    are known at this point.
+    """
+    parent = target.parent
+    target._ancestor_path = (
+        parent._ancestor_path_for_children() if parent is not None else "/"
+    )
+
+
+@listens_for(CmisObject, "before_update", propagate=True)
+def _cmis_update_ancestor_path(
+    mapper: sa.orm.Mapper, connection: sa.engine.Connection, target: CmisObject
+):
+    """Update materialized path of moved objects, and of all their
+    descendants with a single UPDATE statement."""
+    attrs = sa.inspect(target).attrs
+    moved = attrs._parent_id.history.has_changes() or attrs.parent.history.has_changes()
+    if not moved and target._ancestor_path is not None:
+        return
+
+    parent = target.parent
+    old_path = target._ancestor_path
+    new_path = parent._ancestor_path_for_children() if parent is not None else "/"
+    if new_path == old_path:
+        return
+
+    target._ancestor_path = new_path
+    if old_path is None or not target.is_folder:
+        return
+
+    old_prefix = f"{old_path}{target.id}/"
+    new_prefix = f"{new_path}{target.id}/"
+    column = CmisObject.__table__.c.ancestor_path
+    stmt = (
+        CmisObject.__table__.update()
+        .where(column.like(f"{old_prefix}%"))
+        .values(
+            ancestor_path=sa.literal(new_prefix, Text)
+            + sa.func.substr(column, len(old_prefix) + 1, type_=Text)
+        )
+    )
+    connection.execute(stmt)
+
+    # keep loaded descendants in sync, without marking them as modified
+    session = sa.orm.object_session(target)
+    for obj in list(session.identity_map.values()):
+        path = obj.__dict__.get("_ancestor_path")
+        if isinstance(obj, CmisObject) and path and path.startswith(old_prefix):
+            set_committed_value(
+                obj, "_ancestor_path", new_prefix + path[len(old_prefix) :]
+            )
+
+
+def fill_ancestor_paths(session: Session) -> int:
+    """Set the materialized path of objects that have none, i.e. objects
+    created before the column existed.
+
+    Paths are computed from `_parent_id`, from the root folders down, with
+    one UPDATE statement per tree level. Return the number of objects
+    updated.
+    """
+    table = CmisObject.__table__
+    parent = table.alias("parent")
+    count = session.execute(
+        table.update()
+        .where(sa.and_(table.c.ancestor_path == None, table.c._parent_id == None))
+        .values(ancestor_path="/")
+    ).rowcount
+
+    parent_known = sa.and_(
+        parent.c.id == table.c._parent_id, parent.c.ancestor_path != None
+    )
+    parent_path = (
+        sa.select([parent.c.ancestor_path + sa.cast(parent.c.id, Text) + "/"])
+        .where(parent_known)
+        .as_scalar()
+    )
+    while True:
+        rowcount = session.execute(
+            table.update()
+            .where(
+                sa.and_(table.c.ancestor_path == None, sa.exists().where(parent_known))
+            )
+            .values(ancestor_path=parent_path)
+        ).rowcount
+        if not rowcount:
+            break
+        count += rowcount
+
+    if count:
+        # loaded objects get their new path when accessed
+        for obj in list(session.identity_map.values()):
+            if (
+                isinstance(obj, CmisObject)
+                and "_ancestor_path" in obj.__dict__
+                and obj.__dict__["_ancestor_path"] is None
+            ):
+                session.expire(obj, ["_ancestor_path"])
+    return count
+
+
+def ensure_ancestor_paths(session: Session):
+    """Fill missing materialized paths before a query on a subtree, see
+    :func:`fill_ancestor_paths`.
+
+    Queries on `ancestor_path` would miss objects without a path. They
+    are normally filled once with `flask documents fill-ancestor-paths`.
+    """
+    table = CmisObject.__table__
+    query = sa.select([sa.exists().where(table.c.ancestor_path == None)])
+    if not session.execute(query).scalar():
+        return
+
+    count = fill_ancestor_paths(session)
+    if count:
+        logger.warning(
+            "Materialized path was missing on %d objects, "
+            "run `flask documents fill-ancestor-paths`",
+            count,
+        )
+
+
 class PathAndSecurityIndexable:
     """Mixin for folder and documents indexation."""
 
@@ -214,7 +449,14 @@ class PathAndSecurityIndexable:
     )
 
     def _iter_to_root(self, skip_self: bool = False) -> Iterator[Document | Folder]:
-        obj = self if not skip_self else self.parent
+        if not skip_self:
+            yield cast("Document | Folder", self)
+
+        if isinstance(self, CmisObject):
+            yield from reversed(self.ancestors)
+            return
+
+        obj = self.parent
         while obj:
             yield obj
             obj = obj.parent
@@ -223,53 +465,19 @@ class PathAndSecurityIndexable:
     def _indexable_parent_ids(self) -> str:
         """Return a string made of ids separated by a slash: "/1/3/4/5", "5"
         being self.parent.id."""
-        ids = [str(obj.id) for obj in self._iter_to_root(skip_self=True)]
-        return f"/{'/'.join(reversed(ids))}"
+        if isinstance(self, CmisObject):
+            # read from the materialized path, without loading the ancestors
+            ids = [str(id) for id in self.ancestor_ids]
+        else:
+            ids = [str(obj.id) for obj in self._iter_to_root(skip_self=True)]
+            ids.reverse()
+        return f"/{'/'.join(ids)}"
 
     @property
     def _indexable_roles_and_users(self) -> str:
         """Returns a string made of type:id elements, like "user:2 group:1
         user:6"."""
-        iter_from_root = reversed(list(self._iter_to_root()))
-        if self.parent:
-            # skip root folder only on non-root folder!
-            next(iter_from_root)
-        allowed = {o[0] for o in security.get_role_assignements(next(iter_from_root))}
-
-        for obj in iter_from_root:
-            if obj.inherit_security:
-                continue
-            obj_allowed = {o[0] for o in security.get_role_assignements(obj)}
-
-            if Anonymous in obj_allowed:
-                continue
-
-            parent_allowed = allowed
-            # pure intersection: users and groups in both are preserved
-            allowed = allowed & obj_allowed
-            remaining = parent_allowed - obj_allowed
-            # find users who can access 'obj' because of their group memberships
-            # 1. extends groups in obj_allowed with their actual member list
-            extended_allowed = set(
-                itertools.chain(
-                    *(p.members if isinstance(p, Group) else (p,) for p in obj_allowed)
-                )
-            )
-
-            # 2. remaining_users are users explicitly listed in parents but not on
-            # obj. Are they in a group?
-            remaining_users = {o for o in remaining if isinstance(o, User)}
-            allowed |= remaining_users & extended_allowed
-
-            # remaining groups: find if some users are eligible
-            remaining_groups_members = set(
-                itertools.chain(*(p.members for p in remaining if isinstance(p, Group)))
-            )
-            allowed |= remaining_groups_members - extended_allowed
-
-        # admin role is always granted access
-        allowed.add(Admin)
-        return " ".join(indexable_role(p) for p in allowed)
+        return " ".join(sorted(effective_principals(cast(CmisObject, self))))
 
 
 class Folder(PathAndSecurityIndexable, CmisObject):
@@ -308,10 +516,7 @@ class Folder(PathAndSecurityIndexable, CmisObject):
 
     @property
     def depth(self) -> int:
-        if self.parent is None:
-            return 0
-
-        return self.parent.depth + 1
+        return len(self.ancestor_ids)
 
     def create_subfolder(self, title: str) -> Folder:
         subfolder = Folder(title=title, parent=self)
@@ -332,13 +537,37 @@ class Folder(PathAndSecurityIndexable, CmisObject):
             return self
 
         path_segments = path[1:].split("/")
-        obj = self
-        try:
-            for name in path_segments[:]:
-                obj = first(x for x in obj.children if x.title == name)
+        if not sa.inspect(self).persistent:
+            obj: Any = self
+            for name in path_segments:
+                obj = next((x for x in obj.children if x.title == name), None)
+                if obj is None:
+                    return None
             return obj
-        except IndexError:
-            return None
+
+        # Resolve the whole path in the database: one join per segment, each
+        # one using the unique index on (_parent_id, title). Only the target
+        # object is loaded, not the siblings at each level.
+        table = CmisObject.__table__
+        parent_id = sa.literal(self.id)
+        criteria = []
+        for idx, name in enumerate(path_segments[:-1]):
+            segment = table.alias(f"segment_{idx:d}")
+            criteria.append(segment.c._parent_id == parent_id)
+            criteria.append(segment.c.title == name)
+            parent_id = segment.c.id
+
+        session = sa.orm.object_session(self)
+        query = (
+            session.query(CmisObject)
+            .with_polymorphic("*")
+            .filter(
+                CmisObject._parent_id == parent_id,
+                CmisObject._title == path_segments[-1],
+                *criteria,
+            )
+        )
+        return query.one_or_none()
 
     def __repr__(self):
         return "<{}.{} id={!r} name={!r} path={!r} at 0x{:x}>".format(
@@ -355,15 +584,15 @@ class Folder(PathAndSecurityIndexable, CmisObject):
     #
     @property
     def filtered_children(self) -> list[Folder | Document]:
-        return security.filter_with_permission(
-            current_user, "read", self.children, inherit=True
-        )
+        from .repository import repository
+
+        return repository.filter_with_permission(current_user, READ, self.children)
 
     @property
     def filtered_subfolders(self) -> list[Folder]:
-        return security.filter_with_permission(
-            current_user, "read", self.subfolders, inherit=True
-        )
+        from .repository import repository
+
+        return repository.filter_with_permission(current_user, READ, self.subfolders)
 
     def get_local_roles_assignments(self):
         local_roles_assignments = security.get_role_assignements(self)
@@ -422,11 +651,20 @@ class BaseContent(CmisObject):
 
     __tablename__: str | None = None
 
-    _content_id = Column(Integer, db.ForeignKey(Blob.id))
-    content_blob = relationship(Blob, cascade="all, delete", foreign_keys=[_content_id])
+    _content_id = Column(Integer, db.ForeignKey(Blob.id), index=True)
+    #: content blobs are shared by objects with the same content: they are
+    #: deleted once they are not referenced anymore, see
+    #: :func:`_collect_unreferenced_blobs`.
+    content_blob = relationship(
+        Blob, cascade="save-update, merge", foreign_keys=[_content_id]
+    )
+
+    #: (foreign key, relationship) attribute names of blobs owned by this
+    #: object.
+    _blob_attributes: tuple[tuple[str, str], ...] = (("_content_id", "content_blob"),)
 
     #: md5 digest (BTW: not sure they should be part of the public API).
-    content_digest = Column(Text)
+    content_digest = Column(Text, index=True)
 
     #: size (in bytes) of the content blob.
     content_length = Column(
@@ -455,10 +693,23 @@ class BaseContent(CmisObject):
     @content.setter
     def content(self, value: bytes):
         assert isinstance(value, bytes)
-        self.content_blob = Blob()
-        self.content_blob.value = value
+        blob = Blob()
+        self.set_content_blob(blob)
+        blob.value = value
         self.content_length = len(value)
 
+    def set_content_blob(self, blob: Blob):
+        """Set `blob` as the content blob."""
+        self.content_blob = blob
+
+    def clone(
+        self, title: str | None = None, parent: Folder | None = None
+    ) -> BaseContent:
+        new_obj = super().clone(title=title, parent=parent)
+        # content is shared, not copied
+        new_obj.content_blob = self.content_blob
+        return new_obj
+
     def set_content(self, content: bytes, content_type: str = ""):
         assert isinstance(content_type, str)
 
@@ -467,7 +718,37 @@ class BaseContent(CmisObject):
             return
 
         self.content_digest = new_digest
-        self.content = content
+        blob = find_content_blob(new_digest, len(content))
+        if blob is None:
+            self.content = content
+        else:
+            self.set_content_blob(blob)
+            self.content_length = len(content)
+
+        content_type = self.find_content_type(content_type)
+        if content_type:
+            self.content_type = content_type
+
+    def set_content_from_file(self, fd: IO[bytes], content_type: str = ""):
+        """Like :meth:`set_content`, but read the content from the file
+        object `fd` by chunks, so that it is never held in memory as a
+        whole."""
+        assert isinstance(content_type, str)
+
+        blob = Blob()
+        new_digest, length = write_blob_file(blob, fd)
+        if new_digest == self.content_digest:
+            blob_repository.delete(blob.uuid)
+            return
+
+        existing = find_content_blob(new_digest, length)
+        if existing is not None:
+            blob_repository.delete(blob.uuid)
+            blob = existing
+
+        self.content_digest = new_digest
+        self.set_content_blob(blob)
+        self.content_length = length
         content_type = self.find_content_type(content_type)
         if content_type:
             self.content_type = content_type
@@ -516,7 +797,7 @@ class Document(BaseContent, PathAndSecurityIndexable):
     __tablename__: str | None = None
 
     __indexable__ = True
-    __index_to__ = (("text", ("text",)),)
+    __index_to__ = (("indexed_text", ("text",)),)
 
     _indexable_roles_and_users = PathAndSecurityIndexable._indexable_roles_and_users
 
@@ -549,13 +830,23 @@ class Document(BaseContent, PathAndSecurityIndexable):
         return self.content_digest
 
     _text_id = Column(Integer, db.ForeignKey(Blob.id), info=NOT_AUDITABLE)
-    text_blob = relationship(Blob, cascade="all, delete", foreign_keys=[_text_id])
+    text_blob = relationship(
+        Blob, cascade="save-update, merge", foreign_keys=[_text_id]
+    )
 
     _pdf_id = Column(Integer, db.ForeignKey(Blob.id), info=NOT_AUDITABLE)
-    pdf_blob = relationship(Blob, cascade="all, delete", foreign_keys=[_pdf_id])
+    pdf_blob = relationship(Blob, cascade="save-update, merge", foreign_keys=[_pdf_id])
 
     _preview_id = Column(Integer, db.ForeignKey(Blob.id), info=NOT_AUDITABLE)
-    preview_blob = relationship(Blob, cascade="all, delete", foreign_keys=[_preview_id])
+    preview_blob = relationship(
+        Blob, cascade="save-update, merge", foreign_keys=[_preview_id]
+    )
+
+    _blob_attributes = BaseContent._blob_attributes + (
+        ("_text_id", "text_blob"),
+        ("_pdf_id", "pdf_blob"),
+        ("_preview_id", "preview_blob"),
+    )
 
     language = Column(
         Text, info={"searchable": True, "index_to": [("language", wf.ID(stored=True))]}
@@ -623,10 +914,11 @@ class Document(BaseContent, PathAndSecurityIndexable):
         return self.antivirus_status is not False
 
     # R/W properties
-    @BaseContent.content.setter
-    def content(self, value: bytes):
-        BaseContent.content.fset(self, value)
-        self.content_blob.meta["antivirus_task_id"] = str(uuid.uuid4())
+    def set_content_blob(self, blob: Blob):
+        super().set_content_blob(blob)
+        # a blob shared with other documents keeps its antivirus state
+        if blob.id is None:
+            blob.meta["antivirus_task_id"] = str(uuid.uuid4())
         self.pdf_blob = None
         self.text_blob = None
 
@@ -634,6 +926,10 @@ class Document(BaseContent, PathAndSecurityIndexable):
         super().set_content(content, content_type)
         async_conversion(self)
 
+    def set_content_from_file(self, fd: IO[bytes], content_type: str = ""):
+        super().set_content_from_file(fd, content_type)
+        async_conversion(self)
+
     @property
     def pdf(self):
         if self.pdf_blob:
@@ -646,16 +942,59 @@ class Document(BaseContent, PathAndSecurityIndexable):
         self.pdf_blob = Blob()
         self.pdf_blob.value = value
 
-    # `text` is an Unicode value.
+    # `text` is an Unicode value, stored compressed.
     @property
     def text(self) -> str:
-        return self.text_blob.value.decode("utf8") if self.text_blob is not None else ""
+        return "".join(self.iter_text())
 
     @text.setter
     def text(self, value: str):
         assert isinstance(value, str)
         self.text_blob = Blob()
-        self.text_blob.value = value.encode("utf8")
+        self.text_blob.meta["compression"] = "zlib"
+        self.text_blob.value = zlib.compress(value.encode("utf8"))
+
+    def iter_text(self, chunk_size: int = TEXT_CHUNK_SIZE) -> Iterator[str]:
+        """Yield the text by chunks, without decoding all of it at once."""
+        path = self.text_blob.file if self.text_blob is not None else None
+        if path is None:
+            return
+
+        # text blobs written before compression are plain UTF-8
+        compressed = self.text_blob.meta.get("compression") == "zlib"
+        decompressor = zlib.decompressobj()
+        decoder = codecs.getincrementaldecoder("utf8")()
+
+        with path.open("rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                final = not data
+                if compressed:
+                    if final:
+                        data = decompressor.flush()
+                    else:
+                        data = decompressor.decompress(data)
+                text = decoder.decode(data, final=final)
+                if text:
+                    yield text
+                if final:
+                    break
+
+    def text_head(self, length: int) -> str:
+        """Return the first `length` characters of the text."""
+        chunks = []
+        for chunk in self.iter_text():
+            chunks.append(chunk)
+            length -= len(chunk)
+            if length <= 0:
+                chunks[-1] = chunk[: len(chunk) + length]
+                break
+        return "".join(chunks)
+
+    @property
+    def indexed_text(self) -> str:
+        """The text, truncated to `SBE_INDEXED_TEXT_LIMIT` characters."""
+        return self.text_head(current_app.config["SBE_INDEXED_TEXT_LIMIT"])
 
     @property
     def extra_metadata(self) -> dict[str, Any]:
@@ -681,21 +1020,19 @@ class Document(BaseContent, PathAndSecurityIndexable):
             self.id, self.title, self.path, self.content_length, id(self)
         )
 
-    # locking management; used for checkin/checkout - this could be generalized to
-    # any entity
+    # locking management; used for checkin/checkout and WebDAV - this could be
+    # generalized to any entity
     @property
     def lock(self) -> Lock | None:
         """
         :returns: either `None` if no lock or current lock is expired; either the
         current valid :class:`Lock` instance.
         """
-        lock = self.meta.setdefault("abilian.sbe.documents", {}).get("lock")
-        if lock:
-            lock = Lock(**lock)
-            if lock.expired:
-                lock = None
+        session = sa.orm.object_session(self)
+        if self.id is None or session is None:
+            return None
 
-        return lock
+        return locking.get_lock(session, self.id)
 
     @lock.setter
     def lock(self, user):
@@ -715,23 +1052,24 @@ class Document(BaseContent, PathAndSecurityIndexable):
 
         `del document.lock` can be safely done even if no lock is set.
         """
-        meta = self.meta.setdefault("abilian.sbe.documents", {})
-        if "lock" in meta:
-            del meta["lock"]
-            self.meta.changed()
+        session = sa.orm.object_session(self)
+        if self.id is not None and session is not None:
+            locking.release(session, self.id)
+
+    def set_lock(self, user=None, timeout: int | None = None) -> Lock:
+        """Lock the document for `user`, or refresh the lock `user` holds.
 
-    def set_lock(self, user=None):
+        Raise :class:`LockedError` if another user holds the lock.
+        """
         if user is None:
             user = current_user
 
-        lock = self.lock
-        if lock and not lock.is_owner(user=user):
-            raise RuntimeError("This document is already locked by another user")
+        session = sa.orm.object_session(self)
+        if self.id is None:
+            session.flush()
+        assert self.id is not None
 
-        meta = self.meta.setdefault("abilian.sbe.documents", {})
-        lock = Lock.new()
-        meta["lock"] = lock.as_dict()
-        self.meta.changed()
+        return locking.acquire(session, self.id, user, timeout)
 
 
 def icon_for(content_type: str) -> str:
@@ -745,19 +1083,573 @@ def icon_for(content_type: str) -> str:
     return icon_url("bin.png")
 
 
+# Content blobs
+def find_content_blob(digest: str, length: int) -> Blob | None:
+    """Return a content blob already holding the content with this md5
+    digest and length, if any."""
+    session = db.session()
+    with session.no_autoflush:
+        query = (
+            session.query(Blob)
+            .join(BaseContent, BaseContent._content_id == Blob.id)
+            .filter(
+                BaseContent.content_digest == digest,
+                BaseContent.content_length == length,
+            )
+        )
+        for blob in query.limit(10):
+            if blob:  # the file exists
+                return blob
+    return None
+
+
+def find_converted_document(doc: Document) -> Document | None:
+    """Return another document with the same content as `doc`, whose
+    conversion results can be reused, if any."""
+    if not doc.content_digest:
+        return None
+
+    session = sa.orm.object_session(doc) or db.session()
+    with session.no_autoflush:
+        query = (
+            session.query(Document)
+            .filter(
+                Document.content_digest == doc.content_digest,
+                Document.content_length == doc.content_length,
+                Document.id != doc.id,
+                Document._pdf_id != None,
+                Document._text_id != None,
+                Document.extra_metadata_json != None,
+            )
+            .options(sa.orm.lazyload("*"))
+        )
+        return query.first()
+
+
+_UNREFERENCED_BLOBS = "abilian.sbe.documents.unreferenced_blobs"
+
+
+@listens_for(Session, "after_flush")
+def _find_dereferenced_blobs(session: Session, flush_context):
+    candidates = session.info.setdefault(_UNREFERENCED_BLOBS, set())
+
+    for obj in session.deleted:
+        if isinstance(obj, BaseContent):
+            candidates.update(getattr(obj, fk) for fk, _rel in obj._blob_attributes)
+
+    for obj in session.dirty:
+        if not isinstance(obj, BaseContent):
+            continue
+        attrs = sa.inspect(obj).attrs
+        for fk, rel in obj._blob_attributes:
+            candidates.update(attrs[fk].history.deleted or ())
+            deleted_blobs = attrs[rel].history.deleted or ()
+            candidates.update(blob.id for blob in deleted_blobs if blob is not None)
+
+    candidates.discard(None)
+
+
+def unreferenced_blobs(session: Session, candidates: Collection[int]) -> set[int]:
+    """Return the ids in `candidates` of blobs not referenced anymore as
+    content or rendition of any object."""
+    # use the table: all content types must be taken into account, even if
+    # their model is not loaded.
+    table = BaseContent.__table__
+    blob_table = Blob.__table__
+    referenced: set[int] = set()
+    for column in table.c:
+        if not any(fk.references(blob_table) for fk in column.foreign_keys):
+            continue
+        query = sa.select([column]).where(column.in_(candidates)).distinct()
+        referenced.update(row[0] for row in session.execute(query))
+    return set(candidates) - referenced
+
+
+@listens_for(Session, "after_flush_postexec")
+def _collect_unreferenced_blobs(session: Session, flush_context):
+    """Delete content and rendition blobs not referenced anymore.
+
+    The blob files are removed by the session repository at commit time.
+    """
+    candidates = session.info.pop(_UNREFERENCED_BLOBS, None)
+    if not candidates:
+        return
+
+    unreferenced = unreferenced_blobs(session, candidates)
+    if unreferenced:
+        for blob in session.query(Blob).filter(Blob.id.in_(unreferenced)):
+            session.delete(blob)
+
+
+# Effective access
+#: Principals having access to each folder, in the format of the
+#: "allowed_roles_and_users" index field: "user:2", "group:1", "role:admin".
+#: Maintained at flush time, see :func:`update_folder_acl`.
+folder_acl = sa.Table(
+    "folder_acl",
+    db.metadata,
+    Column(
+        "folder_id",
+        Integer,
+        ForeignKey("cmisobject.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    ),
+    Column("principal", Text, nullable=False),
+    UniqueConstraint("folder_id", "principal"),
+)
+
+_ADMIN_KEY = indexable_role(Admin)
+_ANONYMOUS_KEY = indexable_role(Anonymous)
+_ACL_CHANGES = "abilian.sbe.documents.acl_changes"
+_PRINCIPALS_MEMO = "abilian.sbe.documents.principals_memo"
+
+
+@contextmanager
+def memoized_principals(session: Session) -> Iterator[None]:
+    """Within this block, the principals of each folder and the members of
+    each group are computed once, then reused.
+
+    Meant for indexing many objects at once: security must not change
+    in the block, the memo is not invalidated.
+    """
+    session.info[_PRINCIPALS_MEMO] = ({}, {})
+    try:
+        yield
+    finally:
+        session.info.pop(_PRINCIPALS_MEMO, None)
+
+
+def effective_principals(obj: CmisObject) -> set[str]:
+    """Return the principals having access to `obj`, see
+    :attr:`PathAndSecurityIndexable._indexable_roles_and_users`.
+
+    Folders principals are read from :data:`folder_acl`.
+    """
+    session = sa.orm.object_session(obj) or db.session()
+    if obj.is_folder:
+        return _folder_principals(session, obj)
+
+    depth = len(obj.ancestor_ids)
+    known = {}
+    if depth >= 2:
+        memo = session.info.get(_PRINCIPALS_MEMO, ({}, {}))[0]
+        if obj._parent_id in memo:
+            known[obj._parent_id] = memo[obj._parent_id]
+        else:
+            known[obj._parent_id] = _folder_principals(session, obj.parent)
+    row = (obj.id, obj._parent_id, depth, obj.inherit_security)
+    return _compute_principals(session, [row], known)[obj.id]
+
+
+def subtree_principals(session: Session, folder: Folder) -> dict[int, set[str]]:
+    """Return the principals of `folder` and of all its descendants, by id.
+
+    Folders principals are read from :data:`folder_acl`, those of
+    documents are computed from their parent. Descendants are not loaded.
+    """
+    ensure_ancestor_paths(session)
+    table = CmisObject.__table__
+    subtree = sa.or_(
+        table.c.id == folder.id,
+        table.c.ancestor_path.startswith(
+            folder._ancestor_path_for_children(), autoescape=True
+        ),
+    )
+    query = (
+        sa.select([folder_acl.c.folder_id, folder_acl.c.principal])
+        .select_from(folder_acl.join(table, folder_acl.c.folder_id == table.c.id))
+        .where(subtree)
+    )
+    known: dict[int, set[str]] = {}
+    for folder_id, principal in session.execute(query):
+        known.setdefault(folder_id, set()).add(principal)
+
+    if folder.id not in known:
+        known[folder.id] = _folder_principals(session, folder)
+
+    query = (
+        sa.select(
+            [
+                table.c.id,
+                table.c._parent_id,
+                table.c.ancestor_path,
+                table.c.inherit_security,
+            ]
+        )
+        .where(
+            sa.and_(
+                subtree,
+                table.c.id != folder.id,
+                ~sa.exists().where(folder_acl.c.folder_id == table.c.id),
+            )
+        )
+        .order_by(table.c.ancestor_path)
+    )
+    rows = [
+        (id, parent_id, path.count("/") - 1, inherit)
+        for id, parent_id, path, inherit in session.execute(query)
+    ]
+    return _compute_principals(session, rows, known)
+
+
+def update_folder_acl(session: Session, folder_ids: Collection[int]) -> set[int]:
+    """Recompute the principals of folders `folder_ids` and of all their
+    descendant folders.
+
+    Return the ids of the folders whose principals have changed.
+    """
+    ensure_ancestor_paths(session)
+    query = session.query(Folder).filter(Folder.id.in_(folder_ids))
+    query = query.options(
+        sa.orm.lazyload(Folder.subfolders), sa.orm.lazyload(Folder.documents)
+    )
+    roots = query.all()
+    root_ids = {folder.id for folder in roots}
+    # subtrees of other roots are recomputed anyway
+    roots = [f for f in roots if not root_ids.intersection(f.ancestor_ids)]
+
+    changed = set()
+    for root in roots:
+        ancestors = root.ancestors
+        known = {}
+        if len(ancestors) >= 2:
+            known[root._parent_id] = _folder_principals(session, ancestors[-1])
+
+        query = (
+            session.query(
+                CmisObject.id,
+                CmisObject._parent_id,
+                CmisObject._ancestor_path,
+                CmisObject.inherit_security,
+            )
+            .filter(
+                CmisObject._entity_type == Folder.entity_type,
+                sa.or_(
+                    CmisObject.id == root.id,
+                    CmisObject._ancestor_path.startswith(
+                        root._ancestor_path_for_children(), autoescape=True
+                    ),
+                ),
+            )
+            .order_by(sa.func.length(CmisObject._ancestor_path))
+        )
+        rows = [
+            (id, parent_id, path.count("/") - 1, inherit)
+            for id, parent_id, path, inherit in query
+        ]
+        computed = _compute_principals(session, rows, known)
+        stored = _stored_principals(session, [row[0] for row in rows])
+        subtree_changed = [
+            row[0] for row in rows if stored.get(row[0]) != computed[row[0]]
+        ]
+        if not subtree_changed:
+            continue
+
+        session.execute(
+            folder_acl.delete().where(folder_acl.c.folder_id.in_(subtree_changed))
+        )
+        session.execute(
+            folder_acl.insert(),
+            [
+                {"folder_id": id, "principal": principal}
+                for id in subtree_changed
+                for principal in computed[id]
+            ],
+        )
+        changed.update(subtree_changed)
+
+    return changed
+
+
+def _folder_principals(session: Session, folder: Folder) -> set[str]:
+    """Principals of `folder`, read from :data:`folder_acl`, or computed
+    from the nearest ancestor with stored principals."""
+    memo = session.info.get(_PRINCIPALS_MEMO, ({}, {}))[0]
+    if folder.id not in memo:
+        memo[folder.id] = _load_folder_principals(session, folder)
+    return memo[folder.id]
+
+
+def _load_folder_principals(session: Session, folder: Folder) -> set[str]:
+    chain = [*folder.ancestors, folder]
+    stored = _stored_principals(session, [f.id for f in chain if f.id is not None])
+    start = 0
+    for depth, item in enumerate(chain):
+        if item.id in stored:
+            start = depth + 1
+
+    if start == len(chain):
+        return stored[folder.id]
+
+    known = {chain[start - 1].id: stored[chain[start - 1].id]} if start else {}
+    rows = [
+        (item.id, item._parent_id, depth, item.inherit_security)
+        for depth, item in enumerate(chain)
+        if depth >= start
+    ]
+    return _compute_principals(session, rows, known)[folder.id]
+
+
+def _stored_principals(session: Session, folder_ids: list[int]) -> dict[int, set[str]]:
+    if not folder_ids:
+        return {}
+
+    query = sa.select([folder_acl.c.folder_id, folder_acl.c.principal]).where(
+        folder_acl.c.folder_id.in_(folder_ids)
+    )
+    stored: dict[int, set[str]] = {}
+    for folder_id, principal in session.execute(query):
+        stored.setdefault(folder_id, set()).add(principal)
+    return stored
+
+
+def _compute_principals(
+    session: Session,
+    rows: list[tuple[int, int, int, bool]],
+    known: dict[int, set[str]],
+) -> dict[int, set[str]]:
+    """Compute principals of objects described by `rows`: `(id, parent_id,
+    depth, inherit_security)` tuples, parents first.
+
+    `known` holds the principals of the parent of the first rows. Only
+    the role assignments of the top level objects (below the root
+    folder), and of objects not inheriting security, are taken into
+    account.
+    """
+    own_ids = [id for id, _parent, depth, inherit in rows if depth <= 1 or not inherit]
+    own = _assigned_principals(session, own_ids)
+    members = {}
+    if any(depth > 1 and not inherit for _id, _parent, depth, inherit in rows):
+        members = _group_members(
+            session, itertools.chain(*own.values(), *known.values())
+        )
+
+    result = dict(known)
+    for id, parent_id, depth, inherit in rows:
+        if depth <= 1:
+            principals = set(own.get(id, ()))
+        elif inherit:
+            principals = set(result[parent_id])
+        else:
+            principals = _restrict_principals(
+                result[parent_id], own.get(id, set()), members
+            )
+        # admin role is always granted access
+        principals.add(_ADMIN_KEY)
+        result[id] = principals
+    return result
+
+
+def _restrict_principals(
+    allowed: set[str], obj_allowed: set[str], members: dict[str, set[str]]
+) -> set[str]:
+    """Principals having access to an object not inheriting security, from
+    those having access to its parent (`allowed`) and those having a role
+    on the object (`obj_allowed`)."""
+    if _ANONYMOUS_KEY in obj_allowed:
+        return set(allowed)
+
+    # pure intersection: users and groups in both are preserved
+    result = allowed & obj_allowed
+    remaining = allowed - obj_allowed
+    # find users who can access 'obj' because of their group memberships
+    # 1. extends groups in obj_allowed with their actual member list
+    extended_allowed = set(
+        itertools.chain(*(members.get(p, (p,)) for p in obj_allowed))
+    )
+
+    # 2. remaining_users are users explicitly listed in parents but not on
+    # obj. Are they in a group?
+    remaining_users = {p for p in remaining if p.startswith("user:")}
+    result |= remaining_users & extended_allowed
+
+    # remaining groups: find if some users are eligible
+    remaining_groups_members = set(
+        itertools.chain(*(members[p] for p in remaining if p in members))
+    )
+    result |= remaining_groups_members - extended_allowed
+    return result
+
+
+def _assigned_principals(
+    session: Session, object_ids: list[int]
+) -> dict[int, set[str]]:
+    """Principals having a local role on each of `object_ids`."""
+    object_ids = [id for id in object_ids if id is not None]
+    if not object_ids:
+        return {}
+
+    table = RoleAssignment.__table__
+    query = sa.select(
+        [table.c.object_id, table.c.anonymous, table.c.user_id, table.c.group_id]
+    ).where(table.c.object_id.in_(object_ids))
+    principals: dict[int, set[str]] = {}
+    for object_id, anonymous, user_id, group_id in session.execute(query):
+        if anonymous:
+            key = _ANONYMOUS_KEY
+        elif user_id is not None:
+            key = f"user:{user_id}"
+        else:
+            key = f"group:{group_id}"
+        principals.setdefault(object_id, set()).add(key)
+    return principals
+
+
+def _group_members(session: Session, principals: Iterable[str]) -> dict[str, set[str]]:
+    """Members of the groups in `principals`, by group."""
+    group_ids = {int(p[len("group:") :]) for p in principals if p.startswith("group:")}
+    memo = session.info.get(_PRINCIPALS_MEMO, ({}, {}))[1]
+    members = {f"group:{id}": memo[id] for id in group_ids if id in memo}
+    group_ids.difference_update(memo)
+    if group_ids:
+        loaded: dict[int, set[str]] = {id: set() for id in group_ids}
+        query = sa.select([membership.c.group_id, membership.c.user_id]).where(
+            membership.c.group_id.in_(group_ids)
+        )
+        for group_id, user_id in session.execute(query):
+            loaded[group_id].add(f"user:{user_id}")
+        memo.update(loaded)
+        members.update((f"group:{id}", users) for id, users in loaded.items())
+    return members
+
+
+@listens_for(Session, "after_flush")
+def _find_acl_changes(session: Session, flush_context):
+    """Collect folders and groups whose changes affect folder principals."""
+    folder_ids, group_ids, deleted_ids = session.info.setdefault(
+        _ACL_CHANGES, (set(), set(), set())
+    )
+
+    for obj in session.new:
+        if isinstance(obj, Folder):
+            folder_ids.add(obj.id)
+        elif isinstance(obj, RoleAssignment):
+            folder_ids.add(obj.object_id)
+
+    for obj in session.deleted:
+        if isinstance(obj, Folder):
+            deleted_ids.add(obj.id)
+        elif isinstance(obj, RoleAssignment):
+            folder_ids.add(obj.object_id)
+
+    for obj in session.dirty:
+        attrs = sa.inspect(obj).attrs
+        if isinstance(obj, Folder):
+            if any(
+                attrs[name].history.has_changes()
+                for name in ("inherit_security", "_parent_id", "parent")
+            ):
+                folder_ids.add(obj.id)
+        elif isinstance(obj, Group):
+            if attrs.members.history.has_changes():
+                group_ids.add(obj.id)
+        elif isinstance(obj, User):
+            history = attrs.groups.history
+            changed = itertools.chain(history.added or (), history.deleted or ())
+            group_ids.update(group.id for group in changed)
+        elif isinstance(obj, RoleAssignment):
+            history = attrs.object_id.history
+            folder_ids.update(
+                itertools.chain(history.added or (), history.deleted or ())
+            )
+
+
+@listens_for(Session, "after_flush_postexec")
+def _update_folder_acl(session: Session, flush_context):
+    changes = session.info.pop(_ACL_CHANGES, None)
+    if not changes:
+        return
+
+    folder_ids, group_ids, deleted_ids = changes
+    if deleted_ids:
+        session.execute(
+            folder_acl.delete().where(folder_acl.c.folder_id.in_(deleted_ids))
+        )
+
+    if group_ids:
+        # folders where these groups have access, or a local role
+        keys = [f"group:{id}" for id in group_ids]
+        query = sa.select([folder_acl.c.folder_id]).where(
+            folder_acl.c.principal.in_(keys)
+        )
+        folder_ids.update(row[0] for row in session.execute(query))
+        table = RoleAssignment.__table__
+        query = sa.select([table.c.object_id]).where(table.c.group_id.in_(group_ids))
+        folder_ids.update(row[0] for row in session.execute(query))
+
+    folder_ids -= deleted_ids
+    folder_ids.discard(None)
+    if folder_ids:
+        update_folder_acl(session, folder_ids)
+
+
+# Streamed content
+#: Size of the chunks used to copy content to the blob store.
+BLOB_CHUNK_SIZE = 64 * 1024
+
+_PENDING_BLOB_FILES = "abilian.sbe.documents.pending_blob_files"
+
+
+def write_blob_file(blob: Blob, fd: IO[bytes]) -> tuple[str, int]:
+    """Copy the content of `fd` to the file of `blob`, by chunks, and return
+    its md5 digest and its length.
+
+    The session repository reads the whole content in memory, so the file
+    is written directly in the repository, and removed if the session is
+    rolled back.
+    """
+    path = blob_repository.abs_path(blob.uuid)
+    path.parent.mkdir(0o775, parents=True, exist_ok=True)
+    db.session.info.setdefault(_PENDING_BLOB_FILES, []).append(path)
+
+    digest = hashlib.md5()
+    length = 0
+    with path.open("wb") as dest:
+        for chunk in iter(partial(fd.read, BLOB_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            length += len(chunk)
+            dest.write(chunk)
+
+    hexdigest = digest.hexdigest()
+    if length:
+        blob.meta["md5"] = hexdigest
+    return hexdigest, length
+
+
+@listens_for(Session, "after_commit")
+def _keep_pending_blob_files(session: Session):
+    if session.transaction.nested:
+        return
+    session.info.pop(_PENDING_BLOB_FILES, None)
+
+
+@listens_for(Session, "after_soft_rollback")
+def _remove_pending_blob_files(session: Session, previous_transaction):
+    # files written during a rolled back savepoint are only removed if the
+    # whole transaction is rolled back.
+    if previous_transaction.parent is not None:
+        return
+    for path in session.info.pop(_PENDING_BLOB_FILES, []):
+        if path.exists():
+            path.unlink()
+
+
 # Async conversion
 _async_data = threading.local()
 
 
-def _get_documents_queue() -> list[tuple[Document, str]]:
+def _get_documents_queue() -> dict[int, tuple[Document, str]]:
+    # keyed by object identity: new documents don't have an id yet
     if not hasattr(_async_data, "documents"):
-        _async_data.documents = []
+        _async_data.documents = {}
     return _async_data.documents
 
 
 def async_conversion(document: Document):
-    _get_documents_queue().append(
-        (document, document.content_blob.meta.get("antivirus_task_id"))
+    _get_documents_queue()[id(document)] = (
+        document,
+        document.content_blob.meta.get("antivirus_task_id"),
     )
 
 
@@ -771,10 +1663,12 @@ def _trigger_conversion_tasks(session: Session):
         return
 
     document_queue = _get_documents_queue()
-    while document_queue:
-        doc, task_id = document_queue.pop()
-        if doc.id:
-            tasks.process_document.apply_async((doc.id,), task_id=task_id)
+    documents: dict[int, str | None] = {
+        doc.id: task_id for doc, task_id in document_queue.values() if doc.id
+    }
+    document_queue.clear()
+    if documents:
+        tasks.dispatch_processing(documents)
 
 
 def setup_listener():
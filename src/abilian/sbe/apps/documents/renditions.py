@@ -0,0 +1,112 @@
+"""Disk cache for document renditions: preview images at any size and page."""
+from __future__ import annotations
+
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import NamedTuple
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+#: default maximum size of the cache, in bytes
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class RenditionKey(NamedTuple):
+    digest: str
+    page: int
+    size: int
+    format: str
+
+    @property
+    def etag(self) -> str:
+        return f"{self.digest}-{self.page}-{self.size}.{self.format}"
+
+
+class RenditionCache:
+    """Renditions of document contents, stored on local disk.
+
+    Renditions are keyed by :class:`RenditionKey`. Since the content digest
+    is part of the key, a cached rendition never changes.
+
+    When the cache grows over `SBE_RENDITION_CACHE_SIZE` bytes, least
+    recently used renditions are removed.
+    """
+
+    def __init__(self):
+        # bytes written by this process since the last eviction
+        self._written = 0
+
+    @property
+    def cache_dir(self) -> Path:
+        cache_dir = current_app.config.get("SBE_RENDITION_CACHE_DIR")
+        if not cache_dir:
+            cache_dir = Path(current_app.instance_path, "renditions")
+        return Path(cache_dir)
+
+    @property
+    def max_size(self) -> int:
+        return current_app.config["SBE_RENDITION_CACHE_SIZE"]
+
+    def path(self, key: RenditionKey) -> Path:
+        return self.cache_dir / key.digest[:2] / key.etag
+
+    def get(self, key: RenditionKey) -> Path | None:
+        """Return the path of the rendition, or `None` if not in cache."""
+        path = self.path(key)
+        try:
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: RenditionKey, data: bytes) -> Path:
+        """Store a rendition, return its path."""
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # concurrent readers never see a partially written file
+        tmp_path = path.with_name(f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+        self._written += len(data)
+        if self._written > self.max_size // 10:
+            self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used renditions, if the cache is too big."""
+        self._written = 0
+        renditions = []
+        total = 0
+        for path in self.cache_dir.glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            renditions.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        if total <= self.max_size:
+            return
+
+        # leave room before next eviction
+        target = self.max_size * 9 // 10
+        renditions.sort()
+        for _mtime, size, path in renditions:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        logger.debug("Rendition cache reduced to %d bytes", total)
+
+
+renditions = RenditionCache()
@@ -1,18 +1,93 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+import itertools
+import pickle
+import re
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Collection, Iterator
 
 import sqlalchemy as sa
+from flask import current_app
+from flask_login import current_user
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.types import Text
 
-from abilian.core.models.subjects import User
-from abilian.services.security import READ, Permission, security
+from abilian.core.entities import Entity
+from abilian.core.extensions import db
+from abilian.core.models.blob import Blob
+from abilian.core.models.subjects import Group, User
+from abilian.core.util import fqcn, slugify, unwrap
+from abilian.services import audit_service
+from abilian.services.audit import CREATION, DELETION, UPDATE, AuditEntry
+from abilian.services.audit.models import Changes
+from abilian.services.repository import session_repository
+from abilian.services.security import (
+    READ,
+    Admin,
+    Anonymous,
+    Authenticated,
+    Creator,
+    Manager,
+    Owner,
+    Permission,
+    PermissionAssignment,
+    Role,
+    RoleAssignment,
+    SecurityAudit,
+    security,
+)
+from abilian.services.security.service import DEFAULT_PERMISSION_ROLE
 
-from .models import BaseContent, CmisObject, Document, Folder
+from . import lock as locking
+from . import tasks
+from .lock import Lock
+from .models import (
+    BaseContent,
+    CmisObject,
+    Document,
+    Folder,
+    ensure_ancestor_paths,
+    unreferenced_blobs,
+    update_folder_acl,
+)
+from .search import index_after_commit
+from .tasks import apply_async_after_commit
 
 if TYPE_CHECKING:
     from abilian.sbe.app import Application
 
 
+#: Default number of objects returned by :meth:`Repository.list_children`.
+DEFAULT_PAGE_SIZE = 200
+
+#: Sort keys accepted by :meth:`Repository.list_children`.
+LISTING_SORT_KEYS = ("title", "date", "size")
+
+#: Number of rows inserted at once by :meth:`Repository.copy_object`.
+COPY_BATCH_SIZE = 1000
+
+#: Number of objects deleted at once by :meth:`Repository.iter_delete_tree`.
+DELETE_BATCH_SIZE = 500
+
+#: Default number of descendants above which folders are deleted by a
+#: background task.
+DELETE_TASK_THRESHOLD = 1000
+
+_ACCESS_CACHE = "abilian.sbe.documents.access_cache"
+
+# flushing those invalidates memoized permissions
+_ACCESS_CACHE_DEPENDENCIES = (
+    RoleAssignment,
+    PermissionAssignment,
+    SecurityAudit,
+    CmisObject,
+    User,
+    Group,
+)
+
+
 class SecurityException(Exception):
     pass
 
@@ -31,7 +106,12 @@ class Repository:
 
     @property
     def root_folder(self) -> Folder:
-        folder = Folder.query.filter(Folder.parent == None).first()
+        query = Folder.query.filter(Folder.parent == None)
+        # don't load the whole first level of the tree
+        query = query.options(
+            sa.orm.lazyload(Folder.subfolders), sa.orm.lazyload(Folder.documents)
+        )
+        folder = query.first()
         if folder:
             return folder
 
@@ -79,6 +159,107 @@ class Repository:
         """
         return Document.query.get(id)
 
+    #
+    # Listing
+    #
+    def list_children(
+        self,
+        folder: Folder,
+        user: User | None = None,
+        sort: str = "title",
+        reverse: bool = False,
+        after: int | None = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        search: str = "",
+        object_type: str | None = None,
+    ) -> tuple[list[BaseContent], int | None]:
+        """Return a page of the children of `folder`, and the cursor to use to
+        get the next page (`None` if this is the last one).
+
+        Subfolders always come first, then objects are ordered by `sort`
+        (one of :data:`LISTING_SORT_KEYS`). Pagination is keyset based:
+        `after` is the id of the last object of the previous page, so
+        getting page N doesn't require scanning the N-1 previous ones.
+
+        `search` filters on titles (case insensitive), `object_type` may
+        be "folder" or "document". If `user` is given, objects they can't
+        read are left out.
+        """
+        if sort not in LISTING_SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort!r}")
+
+        session = sa.orm.object_session(folder)
+        keys = self._listing_keys(sort, reverse)
+        query = session.query(CmisObject).with_polymorphic("*")
+        query = query.filter(CmisObject._parent_id == folder.id)
+        # don't load children of listed folders
+        query = query.options(sa.orm.lazyload("*"))
+
+        if search:
+            query = query.filter(
+                sa.func.lower(CmisObject._title).contains(
+                    search.lower(), autoescape=True
+                )
+            )
+        if object_type == "folder":
+            query = query.filter(CmisObject._entity_type == Folder.entity_type)
+        elif object_type == "document":
+            query = query.filter(CmisObject._entity_type == Document.entity_type)
+        elif object_type is not None:
+            raise ValueError(f"Unknown object type: {object_type!r}")
+
+        query = query.order_by(*(col.desc() if desc else col for col, desc in keys))
+
+        items: list[BaseContent] = []
+        while True:
+            page_query = query
+            if after is not None:
+                anchor = (
+                    session.query(*(col for col, _desc in keys))
+                    .select_from(CmisObject)
+                    .filter(CmisObject.id == after)
+                    .one_or_none()
+                )
+                if anchor is not None:
+                    page_query = page_query.filter(_keyset_after(keys, anchor))
+
+            rows = page_query.limit(limit + 1).all()
+            allowed = (
+                self.check_permission(user, READ, rows)
+                if user is not None
+                else [True] * len(rows)
+            )
+            for obj, ok in zip(rows, allowed):
+                after = obj.id
+                if not ok:
+                    continue
+                items.append(obj)
+                if len(items) > limit:
+                    return items[:limit], items[limit - 1].id
+
+            if len(rows) <= limit:
+                # no more rows
+                return items, None
+
+    def _listing_keys(self, sort: str, reverse: bool) -> list[tuple[Any, bool]]:
+        """Columns used to order a folder listing, as `(expression,
+        descending)` tuples.
+
+        The object id is always the last key, so that the order is
+        total.
+        """
+        is_document = sa.case(
+            [(CmisObject._entity_type == Folder.entity_type, 0)], else_=1
+        )
+        if sort == "title":
+            column = CmisObject._title
+        elif sort == "date":
+            column = CmisObject.created_at
+        else:
+            column = sa.func.coalesce(BaseContent.content_length, 0)
+
+        return [(is_document, False), (column, reverse), (CmisObject.id, reverse)]
+
     #
     # Path based navigation
     #
@@ -94,7 +275,7 @@ class Repository:
 
         Returns None if the folder doesn't exist.
         """
-        obj = self.root_folder.get_object_by_path(path)
+        obj = self.get_object_by_path(path)
         if obj is None or not obj.is_folder:
             return None
         else:
@@ -105,7 +286,7 @@ class Repository:
 
         Returns None if the document doesn't exist.
         """
-        obj = self.root_folder.get_object_by_path(path)
+        obj = self.get_object_by_path(path)
         if obj is None or not obj.is_document:
             return None
         else:
@@ -117,11 +298,108 @@ class Repository:
     def copy_object(
         self, obj: BaseContent, dest_folder: Folder, dest_title: str | None = None
     ) -> Document | Folder:
-        new_obj = obj.clone(title=dest_title, parent=dest_folder)
+        """Copy `obj`, with all its descendants if it is a folder, into
+        `dest_folder`.
+
+        The copy is done with batched inserts, without loading the
+        subtree in the session. Blobs are shared between the original
+        objects and their copies. Slugs and audit entries are set like
+        the ORM does for new objects.
+        """
+        session = sa.orm.object_session(dest_folder)
+        session.flush()
+        ensure_ancestor_paths(session)
+        entity_table = Entity.__table__
+        cmis_table = CmisObject.__table__
+
+        # fetch the subtree, parents first
+        subtree = [obj.id]
+        if obj.is_folder:
+            prefix = obj._ancestor_path_for_children()
+            query = (
+                session.query(CmisObject.id)
+                .filter(CmisObject._ancestor_path.startswith(prefix, autoescape=True))
+                .order_by(sa.func.length(CmisObject._ancestor_path), CmisObject.id)
+            )
+            subtree.extend(row[0] for row in query)
+
+        new_ids = dict(zip(subtree, _allocate_entity_ids(session, len(subtree))))
+        new_paths = {obj._parent_id: dest_folder._ancestor_path_for_children()}
+        new_names = {obj._parent_id: dest_folder.path}
+        now = datetime.utcnow()
+        polymorphic_map = CmisObject.__mapper__.polymorphic_map
+        audited = audit_service.running
+        user_id = getattr(current_user, "id", None)
+        index_items = []
+
+        for start in range(0, len(subtree), COPY_BATCH_SIZE):
+            ids = subtree[start : start + COPY_BATCH_SIZE]
+            entity_rows = {
+                row.id: dict(row)
+                for row in session.execute(
+                    entity_table.select().where(entity_table.c.id.in_(ids))
+                )
+            }
+            cmis_rows = {
+                row.id: dict(row)
+                for row in session.execute(
+                    cmis_table.select().where(cmis_table.c.id.in_(ids))
+                )
+            }
+
+            new_entities = []
+            new_cmis_objects = []
+            audit_entries = []
+            for id in ids:
+                new_id = new_ids[id]
+                entity = entity_rows[id]
+                cmis_obj = cmis_rows[id]
+                parent_id = cmis_obj["_parent_id"]
+                ancestor_path = new_paths[parent_id]
+                new_paths[id] = f"{ancestor_path}{new_id}/"
+
+                if id == obj.id:
+                    parent_id = dest_folder.id
+                    if dest_title:
+                        entity["name"] = cmis_obj["title"] = dest_title
+                else:
+                    parent_id = new_ids[parent_id]
+                parent_name = new_names[cmis_obj["_parent_id"]]
+                new_names[id] = f"{parent_name}/{cmis_obj['title']}"
+
+                cls = polymorphic_map[entity["entity_type"]].class_
+                entity.update(id=new_id, created_at=now, updated_at=now)
+                cmis_obj.update(
+                    id=new_id, _parent_id=parent_id, ancestor_path=ancestor_path
+                )
+                new_entities.append(entity)
+                new_cmis_objects.append(cmis_obj)
+                if getattr(cls, "__indexable__", False):
+                    index_items.append(("new", fqcn(cls), new_id))
+                if audited and audit_service.is_auditable(cls):
+                    audit_entries.append(
+                        {
+                            "happened_at": now,
+                            "type": CREATION,
+                            "_fk_entity_id": new_id,
+                            "entity_id": new_id,
+                            "entity_type": entity["entity_type"],
+                            "entity_name": new_names[id],
+                            "user_id": user_id,
+                        }
+                    )
+
+            _set_auto_slugs(session, new_entities)
+            session.execute(entity_table.insert(), new_entities)
+            session.execute(cmis_table.insert(), new_cmis_objects)
+            if audit_entries:
+                session.execute(AuditEntry.__table__.insert(), audit_entries)
+
+        index_after_commit(session, index_items)
         if obj.is_folder:
-            for child in obj.children:
-                self.copy_object(child, new_obj)
-        return new_obj
+            update_folder_acl(session, [new_ids[obj.id]])
+        session.expire(dest_folder, ["subfolders", "documents"])
+        return session.query(CmisObject).get(new_ids[obj.id])
 
     def move_object(
         self, obj: BaseContent, dest_folder: Folder, dest_title: str | None = None
@@ -130,34 +408,348 @@ class Repository:
         if dest_title:
             obj.title = dest_title
 
+    def title_exists(
+        self, folder: Folder, title: str, exclude: BaseContent | None = None
+    ) -> bool:
+        """True if an object of `folder` other than `exclude` is named
+        `title`."""
+        session = sa.orm.object_session(folder)
+        query = session.query(CmisObject.id).filter(
+            CmisObject._parent_id == folder.id, CmisObject._title == title
+        )
+        if exclude is not None and exclude.id is not None:
+            query = query.filter(CmisObject.id != exclude.id)
+        return session.query(query.exists()).scalar()
+
+    def titles_like(self, folder: Folder, prefix: str, suffix: str = "") -> list[str]:
+        """Titles of the objects of `folder` starting with `prefix` and
+        ending with `suffix`."""
+        session = sa.orm.object_session(folder)
+        query = session.query(CmisObject._title).filter(
+            CmisObject._parent_id == folder.id,
+            CmisObject._title.startswith(prefix, autoescape=True),
+        )
+        if suffix:
+            query = query.filter(CmisObject._title.endswith(suffix, autoescape=True))
+        return [title for title, in query]
+
+    def conflicting_objects(
+        self, objects: Collection[BaseContent], dest_folder: Folder
+    ) -> list[BaseContent]:
+        """Return the objects of `objects` whose title is already used in
+        `dest_folder` by another object, with a single query."""
+        titles = {obj.title for obj in objects}
+        if not titles:
+            return []
+
+        session = sa.orm.object_session(dest_folder)
+        query = session.query(CmisObject._title).filter(
+            CmisObject._parent_id == dest_folder.id,
+            CmisObject._title.in_(titles),
+            # objects already in `dest_folder` don't conflict with themselves
+            CmisObject.id.notin_([obj.id for obj in objects]),
+        )
+        existing = {title for title, in query}
+        return [obj for obj in objects if obj.title in existing]
+
+    def move_objects(self, objects: Collection[BaseContent], dest_folder: Folder):
+        """Move `objects` into `dest_folder`.
+
+        Parents are changed with a single UPDATE, and the paths of the
+        descendants of moved folders with one UPDATE per source folder.
+        Audit entries of the moved objects are written in bulk too. Moved
+        objects and their descendants are reindexed once the session is
+        committed. Callers must check for conflicts first, see
+        :meth:`conflicting_objects`.
+        """
+        objects = [obj for obj in objects if obj._parent_id != dest_folder.id]
+        if not objects:
+            return
+
+        session = sa.orm.object_session(dest_folder)
+        session.flush()
+        ensure_ancestor_paths(session)
+        entity_table = Entity.__table__
+        cmis_table = CmisObject.__table__
+        column = cmis_table.c.ancestor_path
+        new_path = dest_folder._ancestor_path_for_children()
+
+        sources: dict[str, list[BaseContent]] = {}
+        for obj in objects:
+            if obj._ancestor_path is None:
+                # not reachable from a root folder
+                raise ValueError(f"Can't move {obj!r}: its ancestor path is unknown")
+            sources.setdefault(obj._ancestor_path, []).append(obj)
+
+        ids = [obj.id for obj in objects]
+        now = datetime.utcnow()
+        session.execute(
+            cmis_table.update()
+            .where(cmis_table.c.id.in_(ids))
+            .values(_parent_id=dest_folder.id, ancestor_path=new_path)
+        )
+        session.execute(
+            entity_table.update()
+            .where(entity_table.c.id.in_(ids))
+            .values(updated_at=now)
+        )
+        _audit_moves(session, objects, dest_folder, now)
+
+        prefixes = []
+        for old_path, moved in sources.items():
+            folder_prefixes = [
+                (f"{old_path}{obj.id}/", f"{new_path}{obj.id}/")
+                for obj in moved
+                if obj.is_folder
+            ]
+            if not folder_prefixes:
+                continue
+
+            prefixes.extend(folder_prefixes)
+            session.execute(
+                cmis_table.update()
+                .where(
+                    sa.or_(
+                        *(
+                            column.startswith(old_prefix, autoescape=True)
+                            for old_prefix, _new_prefix in folder_prefixes
+                        )
+                    )
+                )
+                .values(
+                    ancestor_path=sa.literal(new_path, Text)
+                    + sa.func.substr(column, len(old_path) + 1, type_=Text)
+                )
+            )
+
+        # update loaded objects, without marking them as modified
+        for obj in objects:
+            parent = obj.parent
+            if parent is not None and parent in session:
+                session.expire(parent, ["subfolders", "documents"])
+            set_committed_value(obj, "parent", dest_folder)
+            set_committed_value(obj, "_parent_id", dest_folder.id)
+            set_committed_value(obj, "_ancestor_path", new_path)
+            set_committed_value(obj, "updated_at", now)
+        session.expire(dest_folder, ["subfolders", "documents"])
+
+        for item in list(session.identity_map.values()):
+            path = item.__dict__.get("_ancestor_path")
+            if not isinstance(item, CmisObject) or not path:
+                continue
+            for old_prefix, new_prefix in prefixes:
+                if path.startswith(old_prefix):
+                    new_item_path = new_prefix + path[len(old_prefix) :]
+                    set_committed_value(item, "_ancestor_path", new_item_path)
+                    break
+
+        update_folder_acl(session, [obj.id for obj in objects if obj.is_folder])
+
+        # reindex parent_ids and security of the moved subtrees
+        polymorphic_map = CmisObject.__mapper__.polymorphic_map
+        query = (
+            sa.select([cmis_table.c.id, Entity.__table__.c.entity_type])
+            .select_from(cmis_table.join(Entity.__table__))
+            .where(
+                sa.or_(
+                    cmis_table.c.id.in_([obj.id for obj in objects]),
+                    *(
+                        column.startswith(new_prefix, autoescape=True)
+                        for _old_prefix, new_prefix in prefixes
+                    ),
+                )
+            )
+        )
+        index_items = []
+        for id, entity_type in session.execute(query):
+            cls = polymorphic_map[entity_type].class_
+            if getattr(cls, "__indexable__", False):
+                index_items.append(("changed", fqcn(cls), id))
+        index_after_commit(session, index_items)
+
     def rename_object(self, obj: BaseContent, title: str):
         obj.title = title
 
     def delete_object(self, obj: BaseContent):
+        """Delete `obj`, and all its descendants if it is a folder.
+
+        Folders are deleted with set based statements, without loading
+        their content. Folders with more than `SBE_DELETE_TASK_THRESHOLD`
+        descendants are deleted by a background task, once the session is
+        committed.
+        """
         if obj.is_root_folder:
             raise Exception("Can't delete root folder.")
 
         session = sa.orm.object_session(obj)
-        obj.__path_before_delete = obj.path  # for audit log.
         parent = obj.parent
-        collection = parent.subfolders if obj.is_folder else parent.documents
-        session.delete(obj)
-        collection.remove(obj)
+        if not obj.is_folder:
+            obj.__path_before_delete = obj.path  # for audit log.
+            collection = parent.documents
+            session.delete(obj)
+            collection.remove(obj)
+            return
+
+        session.flush()
+        ensure_ancestor_paths(session)
+        user_id = getattr(current_user, "id", None) or 0
+        descendants_count = (
+            session.query(sa.func.count(CmisObject.id))
+            .filter(_descendants_criterion(obj))
+            .scalar()
+        )
+        if descendants_count > current_app.config["SBE_DELETE_TASK_THRESHOLD"]:
+            apply_async_after_commit(session, tasks.delete_tree, obj.id, user_id)
+            return
+
+        for _progress in self.iter_delete_tree(session, obj.id, user_id):
+            pass
+
+    def iter_delete_tree(
+        self, session: Session, object_id: int, user_id: int = 0
+    ) -> Iterator[tuple[int, int]]:
+        """Delete an object and its descendants by batches, deepest first.
+
+        Dependent rows (security, tags, ...), blobs not referenced
+        anymore and index documents are deleted too, and audit entries
+        are written. Yields `(deleted, total)` after each batch.
+        """
+        obj = session.query(CmisObject).get(object_id)
+        if obj is None:
+            return
+
+        ensure_ancestor_paths(session)
+        entity_table = Entity.__table__
+        cmis_table = CmisObject.__table__
+        blob_columns = [
+            column
+            for column in cmis_table.c
+            if any(fk.references(Blob.__table__) for fk in column.foreign_keys)
+        ]
+        query = (
+            sa.select(
+                [
+                    cmis_table.c.id,
+                    cmis_table.c._parent_id,
+                    cmis_table.c.title,
+                    entity_table.c.entity_type,
+                    *blob_columns,
+                ]
+            )
+            .select_from(cmis_table.join(entity_table))
+            .where(
+                sa.or_(
+                    cmis_table.c.id == obj.id, _descendants_criterion(obj, cmis_table)
+                )
+            )
+            .order_by(sa.func.length(cmis_table.c.ancestor_path), cmis_table.c.id)
+        )
+        rows = session.execute(query).fetchall()
+
+        paths = {obj._parent_id: obj.path[: -len(obj.title) - 1]}
+        for row in rows:
+            paths[row.id] = f"{paths[row._parent_id]}/{row.title}"
+
+        # forget objects about to be deleted
+        parent = obj.parent
+        deleted_ids = {row.id for row in rows}
+        for item in list(session.identity_map.values()):
+            # expunge cascades to children: they may be gone already
+            if (
+                isinstance(item, CmisObject)
+                and item.id in deleted_ids
+                and item in session
+            ):
+                session.expunge(item)
+        if parent is not None:
+            session.expire(parent, ["subfolders", "documents"])
+
+        audited = audit_service.running
+        polymorphic_map = CmisObject.__mapper__.polymorphic_map
+        rows.reverse()
+        done = 0
+        for start in range(0, len(rows), DELETE_BATCH_SIZE):
+            batch = rows[start : start + DELETE_BATCH_SIZE]
+            ids = [row.id for row in batch]
+            index_items = []
+            audit_entries = []
+            for row in batch:
+                cls = polymorphic_map[row.entity_type].class_
+                if getattr(cls, "__indexable__", False):
+                    index_items.append(("deleted", fqcn(cls), row.id))
+                if audited and audit_service.is_auditable(cls):
+                    audit_entries.append(
+                        {
+                            "happened_at": datetime.utcnow(),
+                            "type": DELETION,
+                            "entity_id": row.id,
+                            "entity_type": row.entity_type,
+                            "entity_name": paths[row.id],
+                            "user_id": user_id,
+                        }
+                    )
+
+            if audit_entries:
+                session.execute(AuditEntry.__table__.insert(), audit_entries)
+            _delete_entity_references(session, ids)
+            session.execute(cmis_table.delete().where(cmis_table.c.id.in_(ids)))
+            session.execute(entity_table.delete().where(entity_table.c.id.in_(ids)))
+
+            blob_ids = {row[col.name] for row in batch for col in blob_columns}
+            blob_ids.discard(None)
+            _delete_blobs(session, unreferenced_blobs(session, blob_ids))
+            index_after_commit(session, index_items)
+
+            done += len(batch)
+            yield done, len(rows)
 
     #
-    # Locking (TODO)
+    # Locking
     #
-    def is_locked(self, obj) -> bool:
-        return False
+    def get_lock(self, obj: BaseContent) -> Lock | None:
+        session = sa.orm.object_session(obj) or db.session()
+        return locking.get_lock(session, obj.id)
+
+    def is_locked(self, obj: BaseContent) -> bool:
+        return self.get_lock(obj) is not None
+
+    def can_unlock(self, obj: BaseContent, user: User | None = None) -> bool:
+        """True if `obj` is not locked, or locked by `user` (default: current
+        user)."""
+        lock = self.get_lock(obj)
+        return lock is None or lock.is_owner(user)
 
-    def can_unlock(self, obj) -> bool:
-        return True
+    def lock(
+        self,
+        obj: BaseContent,
+        user: User | None = None,
+        timeout: int | None = None,
+        depth: str = locking.DEPTH_ZERO,
+    ) -> Lock:
+        """Lock `obj` for `user` (default: current user), or refresh the lock
+        `user` already holds.
 
-    def lock(self, obj):
-        return "???"
+        Raise :class:`LockedError` if another user holds the lock.
+        """
+        if user is None:
+            user = current_user
+        session = sa.orm.object_session(obj) or db.session()
+        return locking.acquire(session, obj.id, user, timeout, depth)
+
+    def refresh_lock(
+        self, obj: BaseContent, token: str, timeout: int | None = None
+    ) -> Lock | None:
+        session = sa.orm.object_session(obj) or db.session()
+        return locking.refresh(session, obj.id, token, timeout)
+
+    def unlock(self, obj: BaseContent, token: str | None = None) -> bool:
+        session = sa.orm.object_session(obj) or db.session()
+        return locking.release(session, obj.id, token)
 
-    def unlock(self, obj):
-        pass
+    def locked_by(self, user: User) -> list[BaseContent]:
+        """Return the objects locked by `user`."""
+        query = CmisObject.query.filter(CmisObject.id.in_(locking.locked_ids(user)))
+        return query.order_by(CmisObject.title).all()
 
     #
     # Security / access rights
@@ -166,17 +758,461 @@ class Repository:
         self, user: User, permission: Permission, obj: BaseContent
     ) -> bool:
         assert isinstance(permission, Permission)
-        return security.has_permission(user, permission, obj, inherit=True)
+        return self.check_permission(user, permission, [obj])[0]
+
+    def filter_with_permission(
+        self, user: User, permission: Permission, objects: Collection[BaseContent]
+    ) -> list[BaseContent]:
+        """Return the objects of `objects` on which `user` has `permission`,
+        with inheritance. Bulk form of :meth:`has_permission`."""
+        objects = list(objects)
+        allowed = self.check_permission(user, permission, objects)
+        return [obj for obj, ok in zip(objects, allowed) if ok]
+
+    def readable_children_counts(
+        self, user: User, folders: Collection[Folder]
+    ) -> dict[int, int]:
+        """Return, by folder id, the number of children of `folders` that
+        `user` can read.
+
+        Children are not loaded as objects: only the columns their
+        permissions depend on are read, and checked with the same rules as
+        :meth:`check_permission`. Security assignments of all children are
+        fetched with one query each.
+        """
+        user = unwrap(user)
+        parents = {folder.id: folder for folder in folders if folder.id is not None}
+        counts = dict.fromkeys(parents, 0)
+        if not parents:
+            return counts
+
+        session = sa.orm.object_session(next(iter(parents.values())))
+        if not security.running or (isinstance(user, User) and user.id == 0):
+            query = (
+                session.query(CmisObject._parent_id, sa.func.count(CmisObject.id))
+                .filter(CmisObject._parent_id.in_(parents))
+                .group_by(CmisObject._parent_id)
+            )
+            counts.update(query)
+            return counts
+
+        principals = [user, *user.groups]
+        security._fill_role_cache_batch(principals)
+        cmis_table = CmisObject.__table__
+        child_ids = sa.select([cmis_table.c.id]).where(
+            cmis_table.c._parent_id.in_(parents)
+        )
+        assignments = _permission_roles(session, READ, child_ids)
+        default_roles = {Admin} | DEFAULT_PERMISSION_ROLE.get(READ, set())
+        default_roles |= assignments.get(None, set())
+        object_roles = (
+            _object_roles(session, principals, child_ids)
+            if not user.is_anonymous
+            else {}
+        )
 
-    def has_access(self, user: User, obj: BaseContent):
+        # results depend on the valid roles, which are the same for most
+        # children
+        global_checks: dict[frozenset[Role], bool] = {}
+        inherited_checks: dict[tuple[int, frozenset[Role]], bool] = {}
+
+        def readable(row: Any) -> bool:
+            valid_roles = frozenset(default_roles | assignments.get(row.id, set()))
+            if Anonymous in valid_roles or (
+                Authenticated in valid_roles and not user.is_anonymous
+            ):
+                return True
+
+            if valid_roles not in global_checks:
+                global_checks[valid_roles] = any(
+                    security.has_role(principal, valid_roles)
+                    for principal in principals
+                )
+            if global_checks[valid_roles]:
+                return True
+
+            # roles on the child itself, like SecurityService.has_role
+            if not user.is_anonymous:
+                if Creator in valid_roles and row.creator_id == user.id:
+                    return True
+                if Owner in valid_roles and row.owner_id == user.id:
+                    return True
+                roles = object_roles.get(row.id, set())
+                if roles & (valid_roles | {Admin, Manager}):
+                    return True
+
+            if not row.inherit_security:
+                return False
+            key = (row._parent_id, valid_roles)
+            if key not in inherited_checks:
+                parent = parents[row._parent_id]
+                inherited_checks[key] = any(
+                    security.has_role(principal, valid_roles, item)
+                    for principal in principals
+                    for item in [parent, *_inherited_from(parent)]
+                )
+            return inherited_checks[key]
+
+        query = session.query(
+            CmisObject.id,
+            CmisObject._parent_id,
+            CmisObject.creator_id,
+            CmisObject.owner_id,
+            CmisObject.inherit_security,
+        ).filter(CmisObject._parent_id.in_(parents))
+        for row in query.yield_per(1000):
+            if readable(row):
+                counts[row._parent_id] += 1
+        return counts
+
+    def has_access(self, user: User, obj: BaseContent) -> bool:
         """Checks that user has actual right to reach this object, 'read'
         permission on each of object's parents."""
-        current = obj
-        while current.parent is not None:
-            if not self.has_permission(user, READ, current):
-                return False
-            current = current.parent
-        return True
+        return bool(self.filter_accessible(user, [obj]))
+
+    def filter_accessible(
+        self, user: User, objects: Collection[BaseContent]
+    ) -> list[BaseContent]:
+        """Return the objects of `objects` that `user` can reach, see
+        :meth:`has_access`.
+
+        Permissions of all objects and of their ancestors are evaluated
+        together, see :meth:`check_permission`.
+        """
+        chains = []
+        for obj in objects:
+            # the root folder doesn't need to be readable
+            chain: list[BaseContent] = (
+                [obj, *reversed(obj.ancestors)] if obj.parent is not None else []
+            )
+            chains.append(chain[:-1])
+
+        to_check = {id(item): item for chain in chains for item in chain}
+        items = list(to_check.values())
+        allowed = {
+            id(item)
+            for item, ok in zip(items, self.check_permission(user, READ, items))
+            if ok
+        }
+        return [
+            obj
+            for obj, chain in zip(objects, chains)
+            if all(id(item) in allowed for item in chain)
+        ]
+
+    def check_permission(
+        self, user: User, permission: Permission, objects: Collection[BaseContent]
+    ) -> list[bool]:
+        """Return for each object of `objects` whether `user` has
+        `permission` on it, with inheritance.
+
+        This gives the same results as :meth:`SecurityService.has_permission`,
+        but the permission assignments of all objects and of their ancestors
+        are fetched with a single query, and results are memoized until the
+        end of the transaction, or until security related objects are
+        flushed.
+        """
+        user = unwrap(user)
+        objects = list(objects)
+        if not security.running or not objects:
+            return [True] * len(objects)
+
+        # root always have any permission
+        if isinstance(user, User) and user.id == 0:
+            return [True] * len(objects)
+
+        principals = [user, *user.groups]
+        # also flushes pending security changes, clearing the memo if needed
+        security._fill_role_cache_batch(principals)
+
+        session = sa.orm.object_session(objects[0]) or db.session()
+        cache = session.info.setdefault(_ACCESS_CACHE, {})
+        keys = [(user.id, permission, obj.id) for obj in objects]
+        to_check = [
+            obj for obj, key in zip(objects, keys) if obj.id is None or key not in cache
+        ]
+
+        checked = {}
+        if to_check:
+            inherited = {id(obj): _inherited_from(obj) for obj in to_check}
+            object_ids = {obj.id for obj in to_check if obj.id is not None}
+            assignments = _permission_roles(session, permission, object_ids)
+            default_roles = {Admin} | DEFAULT_PERMISSION_ROLE.get(permission, set())
+            default_roles |= assignments.get(None, set())
+
+            for obj in to_check:
+                valid_roles = default_roles | assignments.get(obj.id, set())
+                if Anonymous in valid_roles or (
+                    Authenticated in valid_roles and not user.is_anonymous
+                ):
+                    allowed = True
+                else:
+                    checked_objs = [None, obj, *inherited[id(obj)]]
+                    allowed = any(
+                        security.has_role(principal, valid_roles, item)
+                        for principal in principals
+                        for item in checked_objs
+                    )
+                checked[id(obj)] = allowed
+                if obj.id is not None:
+                    cache[(user.id, permission, obj.id)] = allowed
+
+        return [
+            checked[id(obj)] if id(obj) in checked else cache[key]
+            for obj, key in zip(objects, keys)
+        ]
+
+
+def _inherited_from(obj: CmisObject) -> list[Folder]:
+    """Ancestors `obj` inherits its security from, nearest first."""
+    inherited = []
+    for parent in reversed(obj.ancestors):
+        if not obj.inherit_security:
+            break
+        inherited.append(parent)
+        obj = parent
+    return inherited
+
+
+def _permission_roles(
+    session: Session, permission: Permission, object_ids: Collection[int] | Any
+) -> dict[int | None, set[Role]]:
+    """Roles having `permission` on each of `object_ids` (ids, or a select of
+    ids), and globally (`None` key)."""
+    pa_filter = PermissionAssignment.object_id == None
+    if not isinstance(object_ids, Collection) or object_ids:
+        pa_filter |= PermissionAssignment.object_id.in_(object_ids)
+    query = session.query(
+        PermissionAssignment.object_id, PermissionAssignment.role
+    ).filter(PermissionAssignment.permission == permission, pa_filter)
+
+    roles: dict[int | None, set[Role]] = {}
+    for object_id, role in query:
+        roles.setdefault(object_id, set()).add(role)
+    return roles
+
+
+def _object_roles(
+    session: Session, principals: list[Any], object_ids: Any
+) -> dict[int, set[Role]]:
+    """Roles of `principals` on each of the objects selected by
+    `object_ids`."""
+    user_ids = [p.id for p in principals if isinstance(p, User)]
+    group_ids = [p.id for p in principals if isinstance(p, Group)]
+    query = session.query(RoleAssignment.object_id, RoleAssignment.role).filter(
+        RoleAssignment.object_id.in_(object_ids),
+        sa.or_(
+            RoleAssignment.user_id.in_(user_ids),
+            RoleAssignment.group_id.in_(group_ids),
+        ),
+    )
+
+    roles: dict[int, set[Role]] = {}
+    for object_id, role in query:
+        roles.setdefault(object_id, set()).add(role)
+    return roles
+
+
+@listens_for(Session, "after_flush")
+def _clear_access_cache_on_flush(session: Session, flush_context):
+    """Forget memoized permissions when security, membership or folder
+    hierarchy changes are flushed."""
+    if _ACCESS_CACHE not in session.info:
+        return
+
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, _ACCESS_CACHE_DEPENDENCIES):
+            del session.info[_ACCESS_CACHE]
+            return
+
+
+@listens_for(Session, "after_commit")
+def _clear_access_cache(session: Session):
+    if not session.transaction.nested:
+        session.info.pop(_ACCESS_CACHE, None)
+
+
+@listens_for(Session, "after_soft_rollback")
+def _clear_access_cache_on_rollback(session: Session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_ACCESS_CACHE, None)
+
+
+def _keyset_after(keys: list[tuple[Any, bool]], values: tuple) -> Any:
+    """Build the criterion selecting rows that come after `values` in the
+    order defined by `keys`."""
+    clauses = []
+    for idx, (column, desc) in enumerate(keys):
+        criteria = [col == value for (col, _desc), value in zip(keys[:idx], values)]
+        value = values[idx]
+        criteria.append(column < value if desc else column > value)
+        clauses.append(sa.and_(*criteria))
+    return sa.or_(*clauses)
+
+
+def _descendants_criterion(obj: CmisObject, table: Any = None) -> Any:
+    """Criterion selecting the descendants of `obj`."""
+    column = table.c.ancestor_path if table is not None else CmisObject._ancestor_path
+    return column.startswith(obj._ancestor_path_for_children(), autoescape=True)
+
+
+def _delete_entity_references(session: Session, ids: Collection[int]):
+    """Delete or update rows referencing the entities being deleted, as
+    the ORM cascades or the database would do."""
+    entity_table = Entity.__table__
+    cmis_table = CmisObject.__table__
+
+    for table in db.metadata.sorted_tables:
+        if table is cmis_table:
+            continue
+
+        for column in table.c:
+            fks = [
+                fk
+                for fk in column.foreign_keys
+                if fk.references(entity_table) or fk.references(cmis_table)
+            ]
+            if not fks or column.primary_key:
+                # primary key: joined table inheritance
+                continue
+
+            criterion = column.in_(ids)
+            if fks[0].ondelete == "CASCADE" or not column.nullable:
+                # not nullable: dependent objects (i.e comments) can't exist
+                # without their entity.
+                pk_columns = list(table.primary_key.columns)
+                is_entity = len(pk_columns) == 1 and any(
+                    fk.references(entity_table) for fk in pk_columns[0].foreign_keys
+                )
+                if is_entity:
+                    query = sa.select(pk_columns).where(criterion)
+                    dependent_ids = [row[0] for row in session.execute(query)]
+                session.execute(table.delete().where(criterion))
+                if is_entity and dependent_ids:
+                    session.execute(
+                        entity_table.delete().where(
+                            entity_table.c.id.in_(dependent_ids)
+                        )
+                    )
+            else:
+                session.execute(table.update().where(criterion).values({column: None}))
+
+
+def _delete_blobs(session: Session, ids: Collection[int]):
+    """Delete blobs, their files are deleted when the session is
+    committed."""
+    if not ids:
+        return
+
+    blob_table = Blob.__table__
+    query = sa.select([blob_table.c.uuid]).where(blob_table.c.id.in_(ids))
+    for (uuid,) in session.execute(query):
+        session_repository.delete(session, uuid)
+    session.execute(blob_table.delete().where(blob_table.c.id.in_(ids)))
+
+
+def _audit_moves(
+    session: Session,
+    objects: Collection[BaseContent],
+    dest_folder: Folder,
+    happened_at: datetime,
+):
+    """Write the audit entries of `objects` moved to `dest_folder`, like the
+    audit service does when their parent is changed."""
+    if not audit_service.running:
+        return
+
+    user_id = getattr(current_user, "id", None)
+    dest_path = dest_folder.path
+    entries = []
+    for obj in objects:
+        if not audit_service.is_auditable(obj):
+            continue
+        changes = Changes()
+        changes.set_column_changes("_parent_id", obj._parent_id, dest_folder.id)
+        entries.append(
+            {
+                "happened_at": happened_at,
+                "type": UPDATE,
+                "_fk_entity_id": obj.id,
+                "entity_id": obj.id,
+                "entity_type": obj.entity_type,
+                "entity_name": f"{dest_path}/{obj.title}",
+                "user_id": user_id,
+                "changes_pickle": pickle.dumps(changes, protocol=2),
+            }
+        )
+
+    if entries:
+        session.execute(AuditEntry.__table__.insert(), entries)
+
+
+def _set_auto_slugs(session: Session, entities: list[dict[str, Any]]):
+    """Set the slug of new entity rows `entities` from their name, like
+    :attr:`Entity.auto_slug` does on insert, with a single query for the
+    slugs already in use."""
+    entity_table = Entity.__table__
+    polymorphic_map = CmisObject.__mapper__.polymorphic_map
+    bases = {}
+    for entity in entities:
+        if entity["name"]:
+            cls = polymorphic_map[entity["entity_type"]].class_
+            base = slugify(entity["name"], separator=cls.SLUG_SEPARATOR)
+            bases[entity["id"]] = base
+
+    used: dict[str, list[str]] = {}
+    keys = {
+        (entity["entity_type"], bases[entity["id"]])
+        for entity in entities
+        if entity["id"] in bases
+    }
+    if keys:
+        query = sa.select([entity_table.c.entity_type, entity_table.c.slug]).where(
+            sa.or_(
+                *(
+                    sa.and_(
+                        entity_table.c.entity_type == entity_type,
+                        entity_table.c.slug.startswith(base, autoescape=True),
+                    )
+                    for entity_type, base in keys
+                )
+            )
+        )
+        for entity_type, slug in session.execute(query):
+            used.setdefault(entity_type, []).append(slug)
+
+    for entity in entities:
+        entity_type = entity["entity_type"]
+        base = bases.get(entity["id"])
+        if base is None:
+            # no name: same fallback as the ORM, after insert
+            cls = polymorphic_map[entity_type].class_
+            entity["slug"] = f"{cls.__name__.lower()}{cls.SLUG_SEPARATOR}{entity['id']}"
+            continue
+
+        slug_re = re.compile(f"{re.escape(base)}-?(-\\d+)?")
+        matches = (slug_re.match(slug) for slug in used.get(entity_type, []) if slug)
+        max_id = max([-1, *(int(m.group(1) or 0) for m in matches if m)]) + 1
+        slug = f"{base}-{max_id}" if max_id else base
+        entity["slug"] = slug
+        used.setdefault(entity_type, []).append(slug)
+
+
+def _allocate_entity_ids(session: Session, count: int) -> list[int]:
+    """Reserve `count` new primary keys for the entity table."""
+    if not count:
+        return []
+
+    if session.get_bind().dialect.name == "postgresql":
+        query = sa.text(
+            "SELECT nextval(pg_get_serial_sequence('entity', 'id')) "
+            "FROM generate_series(1, :count)"
+        )
+        return [row[0] for row in session.execute(query, {"count": count})]
+
+    # other databases (i.e SQLite during tests) serialize write transactions
+    start = session.query(sa.func.max(Entity.id)).scalar() or 0
+    return list(range(start + 1, start + count + 1))
 
 
 repository = Repository()
@@ -1,56 +1,307 @@
 """Indexing related utilities for Folder, Documents."""
 from __future__ import annotations
 
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Iterable
+
 import sqlalchemy as sa
+import whoosh.fields as wf
+from flask import current_app
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm.session import Session
+from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.types import DateTime, Integer
 
-from abilian.core.entities import Entity
 from abilian.core.extensions import db
 from abilian.sbe.apps.documents.models import Folder
 from abilian.services import get_service
+from abilian.services.indexing.service import index_update
+
+from . import tasks
+from .models import CmisObject, memoized_principals, subtree_principals
+from .tasks import apply_async_after_commit
+
+if TYPE_CHECKING:
+    from abilian.sbe.app import Application
+
+
+#: number of objects whose index entries are rewritten at once by
+#: :func:`update_indexed_security`
+REINDEX_BATCH_SIZE = 500
+
+#: index fields keeping a copy of unstored fields, so that entries can be
+#: rewritten without loading their text and tags, see
+#: :func:`update_indexed_security`
+_STORED_TEXT_FIELD = "stored_text"
+_STORED_TAG_TEXT_FIELD = "stored_tag_text"
+
+#: seconds to wait before reindexing a folder tree, so that consecutive
+#: security changes are indexed at once
+REINDEX_DELAY = 30
+
+#: folders whose tree is waiting to be reindexed, see :func:`reindex_tree`
+pending_reindex = sa.Table(
+    "pending_reindex",
+    db.metadata,
+    Column(
+        "folder_id",
+        Integer,
+        ForeignKey("cmisobject.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column("requested_at", DateTime, nullable=False),
+)
 
-from .models import CmisObject
+
+def init_app(app: Application):
+    """Add the stored text fields to indexing service schemas."""
+    indexing = app.services["indexing"]
+    indexing.register_value_provider(store_text)
+
+    for _name, schema in indexing.schemas.items():
+        for field in (_STORED_TEXT_FIELD, _STORED_TAG_TEXT_FIELD):
+            if field not in schema:
+                schema.add(field, wf.STORED())
+
+
+def store_text(document: dict[str, Any], obj: Any) -> dict[str, Any]:
+    if isinstance(obj, CmisObject) and "text" in document:
+        document[_STORED_TEXT_FIELD] = document["text"]
+        # also stored when empty: entries indexed before tags were stored
+        # don't have it, and must be indexed from scratch
+        document[_STORED_TAG_TEXT_FIELD] = document.get("tag_text", "")
+
+    return document
 
 
 def reindex_tree(obj: Folder):
     """Schedule reindexing `obj` and all of its descendants.
 
-    Generally needed to update indexed security.
+    Generally needed to update indexed security. The folder is recorded
+    in :data:`pending_reindex`, in the current transaction. Requests are
+    coalesced: a background task reindexes all pending trees after
+    `SBE_REINDEX_DELAY` seconds, see :func:`reindex_pending_trees`.
     """
     assert isinstance(obj, CmisObject)
 
     index_service = get_service("indexing")
-    if not index_service.running:
+    if not index_service.running or obj.id is None:
+        # new objects are indexed anyway
         return
 
-    descendants = (
-        sa.select([CmisObject.id, CmisObject._parent_id])
-        .where(CmisObject._parent_id == sa.bindparam("ancestor_id"))
-        .cte(name="descendants", recursive=True)
+    session = sa.orm.object_session(obj) or db.session()
+    now = datetime.utcnow()
+    statement = (
+        pending_reindex.update()
+        .where(pending_reindex.c.folder_id == obj.id)
+        .values(requested_at=now)
     )
-    da = descendants.alias()
-    CA = sa.orm.aliased(CmisObject)
-    d_ids = sa.select([CA.id, CA._parent_id])
-    descendants = descendants.union_all(d_ids.where(CA._parent_id == da.c.id))
+    if not session.execute(statement).rowcount:
+        try:
+            with session.begin_nested():
+                session.execute(
+                    pending_reindex.insert().values(folder_id=obj.id, requested_at=now)
+                )
+        except sa.exc.IntegrityError:
+            # requested concurrently
+            pass
+
+    # tasks finding nothing left to reindex are cheap: always schedule one,
+    # in case a previous task has been lost
+    delay = current_app.config["SBE_REINDEX_DELAY"]
+    apply_async_after_commit(session, tasks.reindex_pending.s().set(countdown=delay))
+
+
+def reindex_requested_at(obj: CmisObject) -> datetime | None:
+    """Return when the last pending reindexing of `obj` was requested, or
+    `None` if its security is up to date in the index."""
+    ids = [*obj.ancestor_ids, obj.id]
     session = sa.orm.object_session(obj) or db.session()
+    query = sa.select([sa.func.max(pending_reindex.c.requested_at)]).where(
+        pending_reindex.c.folder_id.in_(ids)
+    )
+    return session.execute(query).scalar()
+
+
+def reindex_pending_trees(session: Session) -> int:
+    """Reindex the folder trees recorded in :data:`pending_reindex`,
+    committing after each tree.
+
+    Return the number of trees requested again meanwhile.
+    """
+    query = sa.select([pending_reindex.c.folder_id, pending_reindex.c.requested_at])
+    pending = dict(session.execute(query).fetchall())
+    if not pending:
+        return 0
+
+    folders = (
+        session.query(CmisObject)
+        .filter(CmisObject.id.in_(pending))
+        .options(sa.orm.lazyload("*"))
+        .all()
+    )
+
+    # reindexing a folder covers all its descendants
+    covered = {folder.id: [folder.id] for folder in folders}
+    for folder in folders:
+        roots = [id for id in folder.ancestor_ids if id in covered]
+        if roots:
+            covered[roots[0]].extend(covered.pop(folder.id))
+
+    for root_id, folder_ids in covered.items():
+        update_indexed_security(session, root_id)
+        for folder_id in folder_ids:
+            _remove_pending(session, folder_id, pending.pop(folder_id))
+        session.commit()
+
+    # deleted folders
+    for folder_id, requested_at in pending.items():
+        _remove_pending(session, folder_id, requested_at)
+    session.commit()
+
+    count = sa.select([sa.func.count()]).select_from(pending_reindex)
+    return session.execute(count).scalar()
+
 
-    # including ancestor_id in entity_ids_q will garantee at least 1 value for the
-    # "IN" predicate; otherwise when using sqlite (as during tests...)
-    # 'ResourceClosedError' will be raised.
-    #
-    # as an added bonus, "obj" will also be in query results, thus will be added
-    # in "to_update" without needing to do it apart.
-    entity_ids_q = sa.union(
-        sa.select([descendants.c.id]), sa.select([sa.bindparam("ancestor_id")])
+def _remove_pending(session: Session, folder_id: int, requested_at: datetime):
+    # kept if requested again while reindexing
+    session.execute(
+        pending_reindex.delete().where(
+            sa.and_(
+                pending_reindex.c.folder_id == folder_id,
+                pending_reindex.c.requested_at == requested_at,
+            )
+        )
     )
+
+
+def update_indexed_security(
+    session: Session, folder_id: int, batch_size: int | None = None
+):
+    """Update the security fields of folder `folder_id` and all of its
+    descendants in the index.
+
+    Only "allowed_roles_and_users" and "parent_ids" are rewritten, other
+    fields are copied from the existing index entries: content, text blobs
+    and relationships are not loaded. Entries indexed without their text
+    and tags stored, or not indexed at all, are indexed from scratch.
+    """
+    if batch_size is None:
+        batch_size = current_app.config["SBE_REINDEX_BATCH_SIZE"]
+
+    folder = session.query(CmisObject).get(folder_id)
+    if folder is None:
+        return
+
+    principals = subtree_principals(session, folder)
     query = (
-        session.query(Entity)
-        .filter(Entity.id.in_(entity_ids_q))
-        .options(sa.orm.noload("*"))
-        .params(ancestor_id=obj.id)
+        session.query(CmisObject.id, CmisObject._entity_type, CmisObject._ancestor_path)
+        .select_from(CmisObject)
+        .filter(
+            sa.or_(
+                CmisObject.id == folder.id,
+                CmisObject._ancestor_path.startswith(
+                    folder._ancestor_path_for_children(), autoescape=True
+                ),
+            )
+        )
     )
 
-    to_update = index_service.app_state.to_update
-    key = "changed"
+    index = get_service("indexing").app_state.indexes["default"]
+    rows = []
+    stale_ids = []
+    for row in query.yield_per(batch_size):
+        rows.append(row)
+        if len(rows) >= batch_size:
+            stale_ids += _update_security_fields(index, rows, principals)
+            rows = []
+    stale_ids += _update_security_fields(index, rows, principals)
+
+    for start in range(0, len(stale_ids), batch_size):
+        ids = stale_ids[start : start + batch_size]
+        objects = session.query(CmisObject).filter(CmisObject.id.in_(ids)).all()
+        with memoized_principals(session):
+            get_service("indexing").index_objects(objects)
+
+
+def _update_security_fields(
+    index: Any, rows: list[tuple[int, str, str]], principals: dict[int, set[str]]
+) -> list[int]:
+    """Rewrite index entries of objects `rows`: `(id, entity type, ancestor
+    path)` tuples.
+
+    Return the ids of the objects that can't be updated from their index
+    entry.
+    """
+    updates = []
+    stale_ids = []
+    with index.searcher() as searcher:
+        for id, entity_type, path in rows:
+            object_key = f"{entity_type}:{id}"
+            fields = searcher.document(object_key=object_key)
+            if (
+                fields is None
+                or path is None
+                or _STORED_TEXT_FIELD not in fields
+                or _STORED_TAG_TEXT_FIELD not in fields
+            ):
+                stale_ids.append(id)
+                continue
+
+            allowed = " ".join(sorted(principals[id]))
+            parent_ids = f"/{path.strip('/')}"
+            if (
+                fields.get("allowed_roles_and_users") == allowed
+                and fields.get("parent_ids") == parent_ids
+            ):
+                continue
+
+            fields["allowed_roles_and_users"] = allowed
+            fields["parent_ids"] = parent_ids
+            # fields not stored in the index
+            fields["text"] = fields[_STORED_TEXT_FIELD]
+            if fields[_STORED_TAG_TEXT_FIELD]:
+                fields["tag_text"] = fields[_STORED_TAG_TEXT_FIELD]
+            if "name" in fields:
+                fields["name_prefix"] = fields["name"]
+            fields["is_community_content"] = CmisObject.is_community_content
+            updates.append(fields)
+
+    if updates:
+        with index.writer() as writer:
+            for fields in updates:
+                writer.delete_by_term("object_key", fields["object_key"])
+                writer.add_document(**fields)
+
+    return stale_ids
+
+
+_PENDING_INDEX_UPDATES = "abilian.sbe.documents.pending_index_updates"
+
+
+def index_after_commit(session: Session, items: Iterable[tuple[str, str, int]]):
+    """Schedule an index update of objects not loaded in the session.
+
+    `items` are `(operation, class fqcn, primary key)` tuples. They are sent
+    in a single indexing task once the session is committed.
+    """
+    session.info.setdefault(_PENDING_INDEX_UPDATES, []).extend(items)
+
+
+@listens_for(Session, "after_commit")
+def _send_pending_index_updates(session: Session):
+    if session.transaction.nested:
+        return
+
+    items = session.info.pop(_PENDING_INDEX_UPDATES, None)
+    if not items or not get_service("indexing").running:
+        return
+
+    items = [(op, cls_name, pk, {}) for op, cls_name, pk in items]
+    index_update.apply_async(kwargs={"index": "default", "items": items})
+
 
-    for item in query.yield_per(1000):
-        to_update.append((key, item))
+@listens_for(Session, "after_soft_rollback")
+def _clear_pending_index_updates(session: Session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING_INDEX_UPDATES, None)
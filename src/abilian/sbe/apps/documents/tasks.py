@@ -1,22 +1,62 @@
 """Celery tasks related to document transformation and preview."""
 from __future__ import annotations
 
+import json
 import logging
+import time
 from contextlib import contextmanager
-from typing import TYPE_CHECKING, Iterator
+from datetime import timedelta
+from typing import TYPE_CHECKING, Iterator, Sequence
 
-from celery import shared_task
-from sqlalchemy.orm import Session
+from celery import group, shared_task
+from flask import current_app
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session, object_session
 
 from abilian.core.extensions import db
 from abilian.services import converter, get_service
 from abilian.services.conversion import ConversionError, HandlerNotFound
 
+from . import lock, verdicts
+
 if TYPE_CHECKING:
     from .models import Document
 
 logger = logging.getLogger(__package__)
 
+_AFTER_COMMIT_TASKS = "abilian.sbe.documents.after_commit_tasks"
+
+LOCK_REAPER_TASK_NAME = f"{__name__}.delete_expired_locks"
+DEFAULT_LOCK_REAPER_SCHEDULE = {
+    "task": LOCK_REAPER_TASK_NAME,
+    "schedule": timedelta(minutes=10),
+}
+
+
+def apply_async_after_commit(session: Session, task, *args, **kwargs):
+    """Schedule `task` once `session` is committed.
+
+    Identical calls are sent once.
+    """
+    pending = session.info.setdefault(_AFTER_COMMIT_TASKS, [])
+    if (task, args, kwargs) not in pending:
+        pending.append((task, args, kwargs))
+
+
+@listens_for(Session, "after_commit")
+def _send_after_commit_tasks(session: Session):
+    if session.transaction.nested:
+        return
+
+    for task, args, kwargs in session.info.pop(_AFTER_COMMIT_TASKS, []):
+        task.apply_async(args, kwargs)
+
+
+@listens_for(Session, "after_soft_rollback")
+def _clear_after_commit_tasks(session: Session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_AFTER_COMMIT_TASKS, None)
+
 
 @contextmanager
 def get_document(
@@ -41,26 +81,192 @@ def get_document(
         doc_session.close()
 
 
+#: processing stages run after the antivirus scan, in order
+STAGES = ("pdf", "text", "metadata", "preview")
+
+#: failed processing stages are retried up to this number of times
+MAX_RETRIES = 3
+
+#: delay before retrying failed stages, in seconds
+RETRY_DELAY = 60
+
+#: maximum number of documents processed by a single task, when many
+#: documents are committed at once
+PROCESS_BATCH_SIZE = 50
+
+#: number of characters of text used to detect the document language
+LANGUAGE_SAMPLE_SIZE = 10000
+
+
 @shared_task
-def process_document(document_id: int):
-    """Run document processing chain."""
+def process_document(
+    document_id: int,
+    stages: Sequence[str] = STAGES,
+    retries: int = 0,
+    scan: bool = True,
+):
+    """Run document processing chain.
+
+    The content is scanned by the antivirus, unless `scan` is false or its
+    verdict is already known, then read once for all the processing
+    `stages`. A stage failing doesn't prevent the others from running;
+    failed stages are retried later on their own, without scanning again.
+
+    Return the duration of each stage, in seconds.
+    """
     with get_document(document_id) as (session, document):
         if document is None:
+            # deleted after task queued, but before task run
             return
 
-        # True = Ok, None means no check performed (no antivirus present)
-        is_clean = _run_antivirus(document)
+        # True = Ok, None means no check performed (no antivirus present).
+        # A verdict is already known for content shared with other documents
+        is_clean = document.antivirus_status
+        if scan and is_clean is None:
+            is_clean = _run_antivirus(document)
         if is_clean is False:
             return
 
-    preview_document.delay(document_id)
-    convert_document_content.delay(document_id)
+        timings, failed = run_stages(document, stages)
+
+    if failed and retries < MAX_RETRIES:
+        process_document.apply_async(
+            (document_id, failed, retries + 1),
+            {"scan": False},
+            countdown=RETRY_DELAY,
+        )
+
+    return timings
+
+
+@shared_task
+def process_documents(documents: Sequence[tuple[int, str | None]]):
+    """Run document processing chain on several documents, given as
+    (document id, task id) pairs, one after the other.
+
+    The outcome for each document is stored as the result of its task id,
+    as if it had been processed by its own :func:`process_document` task:
+    see :meth:`Document.ensure_antivirus_scheduled`.
+    """
+    backend = process_document.backend
+    for document_id, task_id in documents:
+        try:
+            timings = process_document(document_id)
+        except Exception as e:
+            logger.error(
+                "Processing failed for document %s", document_id, exc_info=True
+            )
+            if task_id is not None:
+                backend.mark_as_failure(task_id, e)
+        else:
+            if task_id is not None:
+                backend.mark_as_done(task_id, timings)
+
+
+def dispatch_processing(documents: dict[int, str | None]):
+    """Schedule processing of documents, given as {document id: task id}.
+
+    A single document is processed by its own :func:`process_document`
+    task, with the given task id. Otherwise, documents are processed by
+    :func:`process_documents` tasks of up to `SBE_PROCESS_BATCH_SIZE`
+    documents each, sent at once.
+    """
+    if len(documents) == 1:
+        [(document_id, task_id)] = documents.items()
+        process_document.apply_async((document_id,), task_id=task_id)
+        return
+
+    items = sorted(documents.items())
+    size = current_app.config["SBE_PROCESS_BATCH_SIZE"]
+    batches = group(
+        process_documents.s(items[start : start + size])
+        for start in range(0, len(items), size)
+    )
+    batches.apply_async()
+
+
+def run_stages(
+    document: Document, stages: Sequence[str]
+) -> tuple[dict[str, float], list[str]]:
+    """Run processing `stages` on `document`, reading its content at most
+    once.
+
+    Return the duration of each stage, and the stages that failed.
+    """
+    from .models import find_converted_document
+
+    # conversion results of the same content, if already converted
+    source = find_converted_document(document)
+    content = None
+    timings = {}
+    failed = []
+    for stage in stages:
+        start = time.perf_counter()
+        try:
+            if not _reuse_result(document, source, stage):
+                if content is None:
+                    content = document.content
+                _STAGE_FUNCS[stage](document, content)
+        except Exception:
+            logger.error(
+                "Processing stage %r failed for document %s",
+                stage,
+                document.id,
+                exc_info=True,
+            )
+            failed.append(stage)
+        timings[stage] = time.perf_counter() - start
+        logger.debug(
+            "Processing stage %r done for document %s in %.3fs",
+            stage,
+            document.id,
+            timings[stage],
+        )
+    return timings, failed
+
+
+def _reuse_result(document: Document, source: Document | None, stage: str) -> bool:
+    """Reuse the result of `stage` from `source`, a document with the same
+    content.
+
+    Return `False` if the stage must be run.
+    """
+    if stage == "preview":
+        # preview images are cached by content digest
+        return converter.has_image(
+            document.content_digest, document.content_type, 0, document.preview_size
+        )
+
+    if source is None:
+        return False
+
+    if stage == "pdf":
+        document.pdf_blob = source.pdf_blob
+    elif stage == "text":
+        document.text_blob = source.text_blob
+    elif stage == "metadata":
+        document.extra_metadata = json.loads(source.extra_metadata_json)
+        document.language = source.language
+        document.page_num = source.page_num
+    else:
+        return False
+
+    logger.debug(
+        "Processing stage %r of document %s reused from document %s",
+        stage,
+        document.id,
+        source.id,
+    )
+    return True
 
 
 def _run_antivirus(document: Document) -> bool | None:
     antivirus = get_service("antivirus")
     if antivirus and antivirus.running:
-        is_clean = antivirus.scan(document.content_blob)
+        session = object_session(document)
+        is_clean = verdicts.scan(
+            session, document.content_blob, document.content_digest
+        )
         if "antivirus_task" in document.content_blob.meta:
             del document.content_blob.meta["antivirus_task"]
         return is_clean
@@ -84,18 +290,7 @@ def preview_document(document_id: int):
             # deleted after task queued, but before task run
             return
 
-        try:
-            converter.to_image(
-                document.content_digest,
-                document.content,
-                document.content_type,
-                0,
-                document.preview_size,
-            )
-        except ConversionError as e:
-            logger.info(
-                "Preview failed: %s", str(e), exc_info=True, extra={"stack": True}
-            )
+        run_stages(document, ("preview",))
 
 
 @shared_task
@@ -106,21 +301,31 @@ def convert_document_content(document_id: int):
             # deleted after task queued, but before task run
             return
 
-        convert_to_pdf(doc)
-        convert_to_text(doc)
-        extract_metadata(doc)
+        run_stages(doc, ("pdf", "text", "metadata"))
+
 
+def make_preview(doc: Document, content: bytes | None = None):
+    if content is None:
+        content = doc.content
 
-def convert_to_pdf(doc: Document):
+    try:
+        converter.to_image(
+            doc.content_digest, content, doc.content_type, 0, doc.preview_size
+        )
+    except ConversionError as e:
+        logger.info("Preview failed: %s", str(e), exc_info=True, extra={"stack": True})
+
+
+def convert_to_pdf(doc: Document, content: bytes | None = None):
     error_kwargs = {"exc_info": True, "extra": {"stack": True}}
+    if content is None:
+        content = doc.content
 
     if doc.content_type == "application/pdf":
-        doc.pdf = doc.content
+        doc.pdf = content
     else:
         try:
-            doc.pdf = converter.to_pdf(
-                doc.content_digest, doc.content, doc.content_type
-            )
+            doc.pdf = converter.to_pdf(doc.content_digest, content, doc.content_type)
         except HandlerNotFound:
             doc.pdf = b""
         except ConversionError as e:
@@ -133,11 +338,13 @@ def convert_to_pdf(doc: Document):
             )
 
 
-def convert_to_text(doc: Document):
+def convert_to_text(doc: Document, content: bytes | None = None):
     error_kwargs = {"exc_info": True, "extra": {"stack": True}}
+    if content is None:
+        content = doc.content
 
     try:
-        doc.text = converter.to_text(doc.content_digest, doc.content, doc.content_type)
+        doc.text = converter.to_text(doc.content_digest, content, doc.content_type)
     except ConversionError as e:
         doc.text = ""
         logger.info(
@@ -145,13 +352,15 @@ def convert_to_text(doc: Document):
         )
 
 
-def extract_metadata(doc: Document):
+def extract_metadata(doc: Document, content: bytes | None = None):
     error_kwargs = {"exc_info": True, "extra": {"stack": True}}
+    if content is None:
+        content = doc.content
 
     doc.extra_metadata = {}
     try:
         doc.extra_metadata = converter.get_metadata(
-            doc.content_digest, doc.content, doc.content_type
+            doc.content_digest, content, doc.content_type
         )
     except ConversionError as e:
         logger.warning(
@@ -162,9 +371,68 @@ def extract_metadata(doc: Document):
     except Exception as e:
         logger.error("Other issue on document %s: %s", doc.name, e, **error_kwargs)
 
-    if doc.text:
+    # language is detected on a sample, the text may be large
+    sample = doc.text_head(LANGUAGE_SAMPLE_SIZE)
+    if sample:
         import langid
 
-        doc.language = langid.classify(doc.text)[0]
+        doc.language = langid.classify(sample)[0]
 
     doc.page_num = doc.extra_metadata.get("PDF:Pages", 1)
+
+
+_STAGE_FUNCS = {
+    "pdf": convert_to_pdf,
+    "text": convert_to_text,
+    "metadata": extract_metadata,
+    "preview": make_preview,
+}
+
+
+@shared_task(bind=True)
+def delete_tree(self, object_id: int, user_id: int = 0):
+    """Delete a folder and all its descendants, committing after each batch.
+
+    Progress is reported as a "PROGRESS" state, with the number of `done`
+    and `total` objects.
+    """
+    from .repository import repository
+
+    session = db.create_scoped_session()
+    try:
+        for done, total in repository.iter_delete_tree(session, object_id, user_id):
+            session.commit()
+            if not self.request.is_eager:
+                self.update_state(state="PROGRESS", meta={"done": done, "total": total})
+    finally:
+        session.close()
+
+
+@shared_task
+def reindex_pending():
+    """Reindex the folder trees waiting for it, once their security has
+    changed."""
+    from .search import reindex_pending_trees
+
+    session = db.create_scoped_session()
+    try:
+        remaining = reindex_pending_trees(session)
+    finally:
+        session.close()
+
+    if remaining:
+        delay = current_app.config["SBE_REINDEX_DELAY"]
+        reindex_pending.apply_async(countdown=delay)
+
+
+@shared_task
+def delete_expired_locks():
+    """Remove expired document locks."""
+    session = db.create_scoped_session()
+    try:
+        count = lock.delete_expired(session)
+        session.commit()
+    finally:
+        session.close()
+
+    logger.debug("%d expired locks removed", count)
@@ -1,21 +1,34 @@
 from __future__ import annotations
 
+import hashlib
+import queue
 import sys
+from io import BytesIO
 from pathlib import Path
 from typing import IO, cast
 
+import click
 import pytest
 from flask.ctx import RequestContext
 from sqlalchemy.orm import Session
+from whoosh.query import Term
 
+from abilian.core.models.blob import Blob
 from abilian.core.models.subjects import User
 from abilian.sbe.app import Application
 from abilian.sbe.apps.communities.models import Community
+from abilian.sbe.apps.documents import cli, tasks, verdicts
 from abilian.sbe.apps.documents.models import Document, Folder
+from abilian.sbe.apps.documents.search import (
+    reindex_requested_at,
+    reindex_tree,
+    update_indexed_security,
+)
 from abilian.sbe.apps.documents.views.folders import explore_archive
 from abilian.sbe.testing import start_services
-from abilian.services import get_service
+from abilian.services import converter, get_service
 from abilian.services.indexing.service import WhooshIndexService
+from abilian.services.security import Reader, security
 from abilian.testing.util import login
 
 
@@ -37,6 +50,318 @@ def test_document(app: Application, session: Session, req_ctx: RequestContext):
     doc.ensure_antivirus_scheduled()
 
 
+def test_process_document(
+    app: Application, session: Session, req_ctx: RequestContext, monkeypatch
+):
+    root = Folder(title="root")
+    doc = Document(parent=root, title="test.txt")
+    doc.set_content(b"some text", "text/plain")
+    session.add(doc)
+    session.commit()
+
+    result = tasks.process_document.apply((doc.id,))
+    assert set(result.get()) == set(tasks.STAGES)
+
+    # only failed stages are retried
+    calls = []
+
+    def make_preview(doc, content):
+        calls.append(content)
+        if len(calls) == 1:
+            raise RuntimeError()
+
+    monkeypatch.setitem(tasks._STAGE_FUNCS, "preview", make_preview)
+    result = tasks.process_document.apply((doc.id,))
+    assert set(result.get()) == set(tasks.STAGES)
+    assert calls == [b"some text", b"some text"]
+
+    # retries don't scan the content again, even when every stage failed
+    scans = []
+    monkeypatch.setattr(tasks, "_run_antivirus", lambda doc: scans.append(doc.id))
+    failures: list[bytes] = []
+
+    def fail_once(doc, content):
+        if len(failures) < len(tasks.STAGES):
+            failures.append(content)
+            raise RuntimeError()
+
+    for stage in tasks.STAGES:
+        monkeypatch.setitem(tasks._STAGE_FUNCS, stage, fail_once)
+    monkeypatch.setattr(converter, "has_image", lambda *args: False)
+    tasks.process_document.apply((doc.id,))
+    assert len(failures) == len(tasks.STAGES)
+    assert scans == [doc.id]
+
+
+def test_dispatch_processing(
+    app: Application, session: Session, req_ctx: RequestContext, monkeypatch
+):
+    dispatched: list[dict[int, str | None]] = []
+    monkeypatch.setattr(tasks, "dispatch_processing", dispatched.append)
+    root = Folder(title="root")
+    doc1 = Document(parent=root, title="test.txt")
+    doc1.set_content(b"some text", "text/plain")
+    doc1.set_content(b"other text", "text/plain")
+    doc2 = Document(parent=root, title="other.txt")
+    doc2.set_content(b"more text", "text/plain")
+    session.add_all([doc1, doc2])
+    session.commit()
+
+    # one dispatch, each document once
+    assert len(dispatched) == 1
+    assert sorted(dispatched[0]) == sorted([doc1.id, doc2.id])
+
+    monkeypatch.undo()
+    app.config["SBE_PROCESS_BATCH_SIZE"] = 1
+    tasks.dispatch_processing(dispatched[0])
+    session.expire_all()
+    assert doc1._pdf_id is not None
+    assert doc2._pdf_id is not None
+
+
+def test_process_documents_results(
+    app: Application, session: Session, req_ctx: RequestContext, monkeypatch
+):
+    root = Folder(title="root")
+    doc1 = Document(parent=root, title="test.txt")
+    doc1.set_content(b"some text", "text/plain")
+    doc2 = Document(parent=root, title="other.txt")
+    doc2.set_content(b"more text", "text/plain")
+    session.add_all([doc1, doc2])
+    session.commit()
+
+    run_stages = tasks.run_stages
+
+    def fail_doc2(document, stages):
+        if document.id == doc2.id:
+            raise RuntimeError()
+        return run_stages(document, stages)
+
+    states = {}
+
+    def store_result(task_id, result, state, **kwargs):
+        states[task_id] = state
+
+    monkeypatch.setattr(tasks, "run_stages", fail_doc2)
+    monkeypatch.setattr(tasks.process_document.backend, "store_result", store_result)
+
+    # each document has the result of its own task id
+    tasks.process_documents([(doc1.id, "task1"), (doc2.id, "task2")])
+    assert states == {"task1": "SUCCESS", "task2": "FAILURE"}
+
+
+def test_shared_blob_keeps_antivirus_verdict(
+    app: Application, session: Session, req_ctx: RequestContext, monkeypatch
+):
+    root = Folder(title="root")
+    doc1 = Document(parent=root, title="test.txt")
+    doc1.set_content(b"some text", "text/plain")
+    session.add(doc1)
+    session.commit()
+    blob = doc1.content_blob
+    blob.meta["antivirus"] = True
+    task_id = blob.meta["antivirus_task_id"]
+    session.commit()
+
+    doc2 = Document(parent=root, title="copy.txt")
+    doc2.set_content(b"some text", "text/plain")
+    session.add(doc2)
+    session.commit()
+    assert doc2.content_blob is blob
+    assert blob.meta["antivirus_task_id"] == task_id
+    assert doc2.antivirus_status is True
+
+    # the verdict is reused, not computed again
+    scans: list[Document] = []
+    monkeypatch.setattr(tasks, "_run_antivirus", scans.append)
+    tasks.process_document.apply((doc2.id,))
+    assert scans == []
+
+
+def test_reuse_conversions(
+    app: Application, session: Session, req_ctx: RequestContext, monkeypatch
+):
+    root = Folder(title="root")
+    doc1 = Document(parent=root, title="test.txt")
+    doc1.set_content(b"some text", "text/plain")
+    session.add(doc1)
+    session.commit()
+    tasks.process_document.apply((doc1.id,))
+
+    doc2 = Document(parent=root, title="copy.txt")
+    doc2.set_content(b"some text", "text/plain")
+    session.add(doc2)
+    session.commit()
+
+    def convert(*args, **kwargs):
+        raise AssertionError("should not be called")
+
+    for name in ("to_pdf", "to_text", "get_metadata"):
+        monkeypatch.setattr(converter, name, convert)
+    tasks.process_document.apply((doc2.id,))
+
+    session.expire_all()
+    assert doc1._pdf_id is not None
+    assert doc2._pdf_id == doc1._pdf_id
+    assert doc2._text_id == doc1._text_id
+    assert doc2.extra_metadata_json == doc1.extra_metadata_json
+    assert doc2.page_num == doc1.page_num
+
+
+def test_reprocess(
+    app: Application, session: Session, req_ctx: RequestContext, tmp_path: Path
+):
+    root = Folder(title="root")
+    doc = Document(parent=root, title="test.txt")
+    doc.set_content(b"some text", "text/plain")
+    session.add(doc)
+    session.commit()
+    doc.pdf_blob = doc.text_blob = None
+    session.commit()
+    doc_id = doc.id
+
+    checkpoint = tmp_path / "checkpoint"
+    args = ["documents", "reprocess", "-j", "1", "--checkpoint", str(checkpoint)]
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0, result.output
+    assert "1 documents processed" in result.output
+    assert checkpoint.read_text() == str(doc_id)
+
+    doc = Document.query.get(doc_id)
+    assert doc._pdf_id is not None
+    assert doc._text_id is not None
+
+    # resumes after the checkpoint
+    result = app.test_cli_runner().invoke(args=args)
+    assert "0 documents processed" in result.output
+
+
+def test_reprocess_skips_infected(
+    app: Application, session: Session, req_ctx: RequestContext, tmp_path: Path
+):
+    root = Folder(title="root")
+    doc = Document(parent=root, title="test.txt")
+    doc.set_content(b"some text", "text/plain")
+    session.add(doc)
+    session.commit()
+    doc.pdf_blob = doc.text_blob = None
+    doc.content_blob.meta["antivirus"] = False
+    session.commit()
+    doc_id = doc.id
+
+    checkpoint = tmp_path / "checkpoint"
+    args = ["documents", "reprocess", "-j", "1", "--checkpoint", str(checkpoint)]
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0, result.output
+    assert "1 documents processed" in result.output
+
+    doc = Document.query.get(doc_id)
+    assert doc._pdf_id is None
+    assert doc._text_id is None
+
+
+def test_reprocess_worker_errors(app: Application, tmp_path: Path, monkeypatch):
+    checkpoint = tmp_path / "checkpoint"
+    progress = cli._Progress(checkpoint, 0)
+    results: queue.Queue[tuple[int, list[str]]] = queue.Queue()
+
+    # a failed worker reports all the stages as failed
+    cli._worker_failed(results, 1, ["pdf", "text"], RuntimeError())
+    assert cli._next_result(results, progress) == (1, ["pdf", "text"])
+
+    # don't wait forever for a lost result
+    monkeypatch.setattr(cli, "RESULT_TIMEOUT", 0.01)
+    with pytest.raises(click.ClickException):
+        cli._next_result(results, progress)
+    assert checkpoint.read_text() == "0"
+
+
+def test_text(app: Application, session: Session, req_ctx: RequestContext):
+    root = Folder(title="root")
+    doc = Document(parent=root, title="test.txt")
+    session.add(doc)
+    text = "Texte accentué. " * 10000
+    doc.text = text
+    assert doc.text_blob.size < len(text)
+    assert doc.text == text
+    assert "".join(doc.iter_text(chunk_size=1000)) == text
+    assert doc.text_head(20) == text[:20]
+
+    app.config["SBE_INDEXED_TEXT_LIMIT"] = 100
+    assert doc.indexed_text == text[:100]
+
+    # uncompressed text
+    doc.text_blob = Blob(text.encode("utf8"))
+    assert doc.text == text
+
+
+def test_set_content_from_file(
+    app: Application, session: Session, req_ctx: RequestContext
+):
+    root = Folder(title="root")
+    doc = Document(parent=root, title="test.txt")
+    session.add(doc)
+    data = b"some content " * 10000
+    doc.set_content_from_file(BytesIO(data), "")
+    assert doc.content_digest == hashlib.md5(data).hexdigest()
+    assert doc.content_blob.meta["md5"] == doc.content_digest
+    assert doc.content_length == len(data)
+    assert doc.content_type == "text/plain"
+    assert doc.content == data
+    session.commit()
+    assert doc.content == data
+
+    # file is removed on rollback
+    doc.set_content_from_file(BytesIO(b"other content"), "text/plain")
+    path = doc.content_blob.file
+    assert path.exists()
+    session.rollback()
+    assert not path.exists()
+    assert doc.content == data
+
+
+def test_antivirus_verdicts(
+    app: Application, session: Session, req_ctx: RequestContext, monkeypatch
+):
+    root = Folder(title="root")
+    doc1 = Document(parent=root, title="test.txt")
+    doc1.set_content(b"content", "text/plain")
+    doc2 = Document(parent=root, title="copy.txt")
+    doc2.set_content(b"content", "text/plain")
+    session.add_all([doc1, doc2])
+    session.flush()
+
+    calls = []
+
+    def scan(blob):
+        calls.append(blob)
+        blob.meta["antivirus"] = True
+        return True
+
+    antivirus = get_service("antivirus")
+    monkeypatch.setattr(antivirus, "scan", scan)
+    monkeypatch.setattr(verdicts, "signature_version", lambda: "0.103/1")
+
+    assert verdicts.scan(session, doc1.content_blob, doc1.content_digest) is True
+    assert verdicts.scan(session, doc2.content_blob, doc2.content_digest) is True
+    assert calls == [doc1.content_blob]
+    assert doc2.antivirus_status is True
+
+    # new signatures: scanned again
+    monkeypatch.setattr(verdicts, "signature_version", lambda: "0.103/2")
+    verdicts.scan(session, doc2.content_blob, doc2.content_digest)
+    assert calls == [doc1.content_blob, doc2.content_blob]
+
+    # bulk scan
+    for doc in (doc1, doc2):
+        del doc.content_blob.meta["antivirus"]
+    session.flush()
+    args = ["antivirus", "--chunk-size", "1"]
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0, result.output
+    assert "2/2 documents scheduled" in result.output
+
+
 def test_antivirus_properties(
     app: Application, session: Session, req_ctx: RequestContext
 ):
@@ -150,6 +475,125 @@ def test_folder_indexed(
         assert hit["community_slug"] == community2.slug
 
 
+def test_reindex_tree(
+    app: Application, session: Session, community1: Community, req_ctx: RequestContext
+):
+    start_services(["security", "indexing"])
+    index_service = cast(WhooshIndexService, get_service("indexing"))
+    app.config["SBE_REINDEX_BATCH_SIZE"] = 2
+
+    folder = Folder(title="Folder 1", parent=community1.folder)
+    subfolder = Folder(title="Folder 1.1", parent=folder)
+    doc = Document(title="folder doc.txt", parent=subfolder)
+    doc.set_content(b"some text", "text/plain")
+    session.add_all([folder, subfolder, doc])
+    session.commit()
+
+    def indexed_keys():
+        with login(community1.test_user):
+            return {hit["object_key"] for hit in index_service.search("folder")}
+
+    assert indexed_keys() == {folder.object_key, subfolder.object_key, doc.object_key}
+
+    # nobody has a role on folder: only admins can access it
+    folder.inherit_security = False
+    session.commit()
+    # descendants have not been reindexed
+    assert indexed_keys() == {subfolder.object_key, doc.object_key}
+
+    reindex_tree(folder)
+    session.commit()
+    assert indexed_keys() == set()
+
+    # requests are coalesced, and run once committed
+    security.grant_role(community1.test_user, Reader, folder)
+    reindex_tree(folder)
+    reindex_tree(subfolder)
+    reindex_tree(folder)
+    assert reindex_requested_at(subfolder) is not None
+
+    session.commit()
+    assert reindex_requested_at(subfolder) is None
+    assert indexed_keys() == {folder.object_key, subfolder.object_key, doc.object_key}
+
+
+def test_update_indexed_security(
+    app: Application,
+    session: Session,
+    community1: Community,
+    req_ctx: RequestContext,
+    monkeypatch,
+):
+    start_services(["security", "indexing"])
+    index_service = cast(WhooshIndexService, get_service("indexing"))
+
+    folder = Folder(title="Folder 1", parent=community1.folder)
+    doc = Document(title="doc.txt", parent=folder)
+    doc.set_content(b"some text", "text/plain")
+    session.add_all([folder, doc])
+    session.commit()
+
+    def search(text):
+        with login(community1.test_user):
+            return {hit["object_key"] for hit in index_service.search(text)}
+
+    assert search("doc") == {doc.object_key}
+
+    folder.inherit_security = False
+    session.commit()
+    indexed: list[Document] = []
+    monkeypatch.setattr(index_service, "index_objects", indexed.extend)
+    update_indexed_security(session, folder.id)
+    session.commit()
+
+    # entries have been rewritten, not indexed again
+    assert indexed == []
+    assert search("doc") == set()
+
+    security.grant_role(community1.test_user, Reader, folder)
+    session.commit()
+    update_indexed_security(session, folder.id)
+    session.commit()
+    assert search("doc") == {doc.object_key}
+    assert indexed == []
+
+
+def test_update_indexed_security_keeps_tags(
+    app: Application,
+    session: Session,
+    community1: Community,
+    req_ctx: RequestContext,
+    monkeypatch,
+):
+    start_services(["security", "indexing"])
+    index_service = cast(WhooshIndexService, get_service("indexing"))
+    monkeypatch.setattr(Document, "_indexable_tag_text", "sometag", raising=False)
+
+    folder = Folder(title="Folder 1", parent=community1.folder)
+    doc = Document(title="doc.txt", parent=folder)
+    doc.set_content(b"some text", "text/plain")
+    session.add_all([folder, doc])
+    session.commit()
+
+    def search_tags(text):
+        index = index_service.app_state.indexes["default"]
+        with index.searcher() as searcher:
+            hits = searcher.search(Term("tag_text", text))
+            return {hit["object_key"] for hit in hits}
+
+    assert search_tags("sometag") == {doc.object_key}
+
+    folder.inherit_security = False
+    session.commit()
+    indexed: list[Document] = []
+    monkeypatch.setattr(index_service, "index_objects", indexed.extend)
+    update_indexed_security(session, folder.id)
+    session.commit()
+
+    assert indexed == []
+    assert search_tags("sometag") == {doc.object_key}
+
+
 @pytest.mark.skipif(sys.version_info >= (3, 0), reason="Doesn't work yet on Py3k")
 def test_explore_archive():
     fd = open_file("content.zip")
@@ -3,7 +3,7 @@ from __future__ import annotations
 from io import BytesIO
 from pathlib import Path
 from typing import IO
-from zipfile import ZipFile
+from zipfile import ZIP_STORED, ZipFile
 
 import flask_mail
 import pytest
@@ -19,6 +19,7 @@ from abilian.sbe.app import Application
 from abilian.sbe.apps.communities.models import WRITER, Community
 from abilian.sbe.apps.communities.presenters import CommunityPresenter
 from abilian.sbe.apps.documents.models import Folder
+from abilian.sbe.apps.documents.renditions import RenditionKey, renditions
 from abilian.sbe.apps.documents.views import util as view_util
 from abilian.testing.util import client_login, path_from_url
 from abilian.web.util import url_for
@@ -79,6 +80,20 @@ def test_util_create(
         messages = get_flashed_messages()
         assert len(messages) == 1
 
+        folder.create_document(f"{name}-9")
+        folder.create_document(f"{name}-10")
+        db.session.flush()
+        assert view_util.get_new_filename(folder, "other") == "other"
+        assert view_util.get_new_filename(folder, name) == f"{name}-11"
+        assert view_util.get_new_filename(folder, f"{name}.txt") == f"{name}.txt"
+
+        url = url_for("documents.check_valid_name", community_id=community.slug)
+        args = {"object_id": doc.id, "action": "document-edit", "title": name}
+        assert client.get(url, query_string=args).json == {"valid": True}
+        args["title"] = f"{name}-1"
+        response = client.get(url, query_string=args)
+        assert response.json["valid"] is False
+
 
 def test_home(
     app: Application,
@@ -98,6 +113,121 @@ def test_home(
         assert path == expected
 
 
+def test_folder_listing(
+    app: Application,
+    client: FlaskClient,
+    db: SQLAlchemy,
+    community: Community,
+    req_ctx: RequestContext,
+):
+    folder = community.folder
+    user = community.test_user
+    for name in ["doc-c", "doc-a", "doc-b"]:
+        folder.create_document(name).owner = user
+    folder.create_subfolder("subfolder").owner = user
+    db.session.commit()
+    app.config["SBE_FOLDER_PAGE_SIZE"] = 2
+
+    with client_login(client, user):
+        url = url_for(
+            "documents.folder_view", community_id=community.slug, folder_id=folder.id
+        )
+        response = client.get(url)
+        assert response.status_code == 200
+
+        url = url_for(
+            "documents.folder_children",
+            community_id=community.slug,
+            folder_id=folder.id,
+        )
+        response = client.get(url)
+        assert response.status_code == 200
+        assert [item["title"] for item in response.json["items"]] == [
+            "subfolder",
+            "doc-a",
+        ]
+        assert response.json["next"]
+
+        response = client.get(response.json["next"])
+        assert [item["title"] for item in response.json["items"]] == [
+            "doc-b",
+            "doc-c",
+        ]
+        assert response.json["next"] is None
+
+
+def test_download(
+    app: Application,
+    client: FlaskClient,
+    db: SQLAlchemy,
+    community: Community,
+    req_ctx: RequestContext,
+):
+    user = community.test_user
+    doc = community.folder.create_document("doc.txt")
+    doc.set_content(b"some content", "text/plain")
+    db.session.commit()
+
+    with client_login(client, user):
+        url = url_for(
+            "documents.document_download", community_id=community.slug, doc_id=doc.id
+        )
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.data == b"some content"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        etag = response.headers["ETag"]
+        assert etag == f'"{doc.content_digest}"'
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        response = client.get(url, headers={"Range": "bytes=5-"})
+        assert response.status_code == 206
+        assert response.data == b"content"
+        assert response.headers["Content-Range"] == "bytes 5-11/12"
+
+
+def test_preview_image(
+    app: Application,
+    client: FlaskClient,
+    db: SQLAlchemy,
+    community: Community,
+    req_ctx: RequestContext,
+    tmp_path: Path,
+):
+    app.config["SBE_RENDITION_CACHE_DIR"] = str(tmp_path)
+    user = community.test_user
+    doc = community.folder.create_document("picture.jpg")
+    doc.set_content(open_file("picture.jpg").read(), "image/jpeg")
+    db.session.commit()
+
+    with client_login(client, user):
+        url = url_for(
+            "documents.document_preview_image",
+            community_id=community.slug,
+            doc_id=doc.id,
+            size=100,
+        )
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "image/jpeg"
+        assert "immutable" in response.headers["Cache-Control"]
+        etag = response.headers["ETag"]
+        image = response.data
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        # served from the cache
+        key = RenditionKey(doc.content_digest, 0, 100, "jpeg")
+        assert renditions.get(key) is not None
+        doc.content_blob.file.unlink()
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.data == image
+
+
 def _test_upload(
     community: Community,
     client: FlaskClient,
@@ -148,6 +278,17 @@ def _test_upload(
             assert response.status_code == 302
             assert response.headers["Cache-Control"] == "no-cache"
 
+    url = url_for(
+        "documents.checkin_checkout", community_id=community.slug, doc_id=doc.id
+    )
+    response = client.post(url, data={"action": "lock"})
+    assert response.status_code == 302
+    assert doc.lock is not None
+    url = url_for("documents.document_view", community_id=community.slug, doc_id=doc.id)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert "Locked for edition" in response.get_data(as_text=True)
+
     url = url_for(
         "documents.document_delete", community_id=community.slug, doc_id=doc.id
     )
@@ -249,6 +390,10 @@ def test_zip(community: Community, client: FlaskClient, req_ctx: RequestContext)
 
         zipfile = ZipFile(BytesIO(response.data))
         assert [zipfile.namelist()[0]] == [title]
+        assert zipfile.read(title) == open_file(title).read()
+        # PDF files are not compressed again
+        assert zipfile.getinfo(title).compress_type == ZIP_STORED
+        assert zipfile.getinfo(title).external_attr >> 16 == 0o644
 
 
 def test_recursive_zip(
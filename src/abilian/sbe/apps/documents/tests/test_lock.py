@@ -3,6 +3,7 @@ from __future__ import annotations
 from datetime import datetime, timedelta
 from unittest import mock
 
+import pytest
 from flask.ctx import RequestContext
 from flask_login import login_user
 from pytz import UTC
@@ -12,6 +13,14 @@ from abilian.core.models.subjects import User
 from abilian.sbe.app import Application
 from abilian.sbe.apps.documents import lock
 from abilian.sbe.apps.documents.lock import Lock
+from abilian.sbe.apps.documents.models import Document, Folder
+from abilian.sbe.apps.documents.repository import repository
+from abilian.sbe.apps.documents.webdav import views as webdav_views
+from abilian.sbe.apps.documents.webdav.constants import (
+    HTTP_BAD_REQUEST,
+    HTTP_CONFLICT,
+    HTTP_NO_CONTENT,
+)
 
 
 def test_lock():
@@ -60,3 +69,95 @@ def test_lock2(app: Application, session: Session, req_ctx: RequestContext):
 
         login_user(other)
         assert not lock_.is_owner()
+
+
+def test_lock_store(app: Application, session: Session, req_ctx: RequestContext):
+    user = User(email="test@example.com", first_name="Joe", last_name="Smith")
+    other = User(email="other@example.com")
+    root = Folder(title="root")
+    doc = Document(parent=root, title="doc")
+    session.add_all([user, other, doc])
+    session.flush()
+
+    app.config["SBE_LOCK_LIFETIME"] = 30
+    assert doc.lock is None
+    lock_ = doc.set_lock(user)
+    assert lock_.user == "Joe Smith"
+    assert lock_.depth == lock.DEPTH_ZERO
+    assert lock_.timeout == 30
+    stored = doc.lock
+    assert stored is not None
+    assert stored.token == lock_.token
+    assert repository.locked_by(user) == [doc]
+    assert repository.locked_by(other) == []
+
+    # locking again refreshes the lock
+    assert repository.lock(doc, user, timeout=10).token == lock_.token
+    stored = doc.lock
+    assert stored is not None
+    assert stored.timeout == 10
+    with pytest.raises(lock.LockedError):
+        doc.lock = other
+    assert not repository.can_unlock(doc, other)
+
+    assert repository.refresh_lock(doc, "other token") is None
+    assert not repository.unlock(doc, "other token")
+    assert repository.unlock(doc, lock_.token)
+    assert doc.lock is None
+
+    # expired locks
+    doc.lock = other
+    later = lock.utcnow() + timedelta(seconds=40)
+    with mock.patch.object(lock, "utcnow", return_value=later):
+        assert doc.lock is None
+        assert repository.locked_by(other) == []
+        assert lock.delete_expired(session) == 1
+        doc.lock = user
+
+    del doc.lock
+    assert doc.lock is None
+
+
+def test_acquire_expired_meanwhile(
+    app: Application, session: Session, req_ctx: RequestContext
+):
+    user = User(email="test@example.com")
+    root = Folder(title="root")
+    doc = Document(parent=root, title="doc")
+    session.add_all([user, doc])
+    session.flush()
+
+    app.config["SBE_LOCK_LIFETIME"] = 30
+    old = lock.acquire(session, doc.id, user)
+    # the lock expires between its lookup and its refresh
+    later = lock.utcnow() + timedelta(seconds=40)
+    with mock.patch.object(lock, "get_lock", return_value=old):
+        with mock.patch.object(lock, "utcnow", return_value=later):
+            new = lock.acquire(session, doc.id, user)
+
+    assert new.token != old.token
+    assert new.user_id == user.id
+
+
+def test_webdav_unlock(app: Application, session: Session, req_ctx: RequestContext):
+    user = User(email="test@example.com")
+    doc = Document(parent=repository.root_folder, title="doc")
+    session.add_all([user, doc])
+    session.flush()
+    lock_ = doc.set_lock(user)
+
+    def unlock(token=None):
+        headers = {"Lock-Token": f"<urn:uuid:{token}>"} if token else {}
+        with app.test_request_context("/webdav/doc", method="UNLOCK", headers=headers):
+            return webdav_views.unlock("doc")
+
+    assert unlock()[1] == HTTP_BAD_REQUEST
+
+    body, status, _headers = unlock("other-token")
+    assert status == HTTP_CONFLICT
+    assert "<D:lock-token-matches-request-uri/>" in body
+    assert doc.lock is not None
+
+    assert unlock(lock_.token)[1] == HTTP_NO_CONTENT
+    assert doc.lock is None
+    assert unlock(lock_.token)[1] == HTTP_CONFLICT
@@ -1,13 +1,31 @@
 from __future__ import annotations
 
+from unittest import mock
+
 import pytest
+import sqlalchemy as sa
 from pytest import fixture
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+from abilian.core.models.blob import Blob
+from abilian.core.models.subjects import Group, User
 from abilian.sbe.app import Application
-from abilian.sbe.apps.documents.models import Document, Folder
+from abilian.sbe.apps.documents import tasks
+from abilian.sbe.apps.documents.models import (
+    CmisObject,
+    Document,
+    Folder,
+    effective_principals,
+    fill_ancestor_paths,
+    folder_acl,
+    subtree_principals,
+)
 from abilian.sbe.apps.documents.repository import Repository
+from abilian.sbe.testing import start_services
+from abilian.services.audit import CREATION, UPDATE, AuditEntry
+from abilian.services.security import READ, WRITE, Creator, Reader, Writer, security
+from abilian.testing.util import login
 
 
 @fixture
@@ -74,6 +92,8 @@ def test_copy_nested_folders(root: Folder, repository: Repository):
     folder1 = root.create_subfolder("folder1")
     folder2 = root.create_subfolder("folder2")
     subfolder = folder1.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    doc.set_content(b"content", "text/plain")
 
     folder1_copy = repository.copy_object(folder1, folder2)
 
@@ -87,6 +107,42 @@ def test_copy_nested_folders(root: Folder, repository: Repository):
     assert len(folder2.children) == 1
     assert folder1_copy in folder2.children
 
+    doc_copy = folder1_copy.get_object_by_path("/subfolder/doc")
+    assert doc_copy is not None
+    assert doc_copy is not doc
+    assert doc_copy.path == "/folder2/folder1/subfolder/doc"
+    assert doc_copy.content_blob is doc.content_blob
+    assert doc_copy.content == b"content"
+
+
+def test_copy_slugs_and_audit(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    user = User(email="user@example.com")
+    session.add(user)
+    session.flush()
+    start_services(["audit"])
+    with login(user):
+        folder1 = root.create_subfolder("folder1")
+        folder2 = root.create_subfolder("folder2")
+        doc = folder1.create_document("My Doc")
+        session.flush()
+        assert (folder1.slug, doc.slug) == ("folder1", "my-doc")
+
+        folder1_copy = repository.copy_object(folder1, folder2)
+
+    doc_copy = folder1_copy.get_object_by_path("/My Doc")
+    assert doc_copy is not None
+    # numbered like the slugs of objects created with the same name
+    assert folder1_copy.slug == "folder1-1"
+    assert doc_copy.slug == "my-doc-1"
+
+    entries = AuditEntry.query.filter(AuditEntry.type == CREATION).all()
+    names = {entry.entity_id: entry.entity_name for entry in entries}
+    assert {entry.user_id for entry in entries} == {user.id}
+    assert names[folder1_copy.id] == "/folder2/folder1"
+    assert names[doc_copy.id] == "/folder2/folder1/My Doc"
+
 
 def test_move_nested_folders(root: Folder, repository: Repository):
     folder1 = root.create_subfolder("folder1")
@@ -155,3 +211,459 @@ def test_no_duplicate_name(root: Folder, session: Session):
     root.create_subfolder("folder_1")
     with pytest.raises(IntegrityError):
         session.flush()
+
+
+def test_ancestor_path(root: Folder, session: Session):
+    folder = root.create_subfolder("folder")
+    subfolder = folder.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    session.flush()
+
+    assert root._ancestor_path == "/"
+    assert folder._ancestor_path == f"/{root.id}/"
+    assert doc._ancestor_path == f"/{root.id}/{folder.id}/{subfolder.id}/"
+    assert doc.ancestor_ids == [root.id, folder.id, subfolder.id]
+    assert doc.ancestors == [root, folder, subfolder]
+    assert subfolder.depth == 2
+    assert doc.path == "/folder/subfolder/doc"
+
+
+def clear_ancestor_paths(session: Session):
+    """Make all objects look created before materialized paths existed."""
+    session.flush()
+    table = CmisObject.__table__
+    session.execute(table.update().values(ancestor_path=None))
+    session.expire_all()
+
+
+def test_fill_ancestor_paths(app: Application, root: Folder, session: Session):
+    folder = root.create_subfolder("folder")
+    subfolder = folder.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    clear_ancestor_paths(session)
+
+    # subtree queries fill missing paths first
+    principals = subtree_principals(session, folder)
+    assert set(principals) == {folder.id, subfolder.id, doc.id}
+    assert doc._ancestor_path == f"/{root.id}/{folder.id}/{subfolder.id}/"
+
+    clear_ancestor_paths(session)
+    assert fill_ancestor_paths(session) == 4
+    assert root._ancestor_path == "/"
+    assert subfolder._ancestor_path == f"/{root.id}/{folder.id}/"
+    assert fill_ancestor_paths(session) == 0
+
+    clear_ancestor_paths(session)
+    result = app.test_cli_runner().invoke(args=["documents", "fill-ancestor-paths"])
+    assert "4 objects updated" in result.output
+
+
+def test_copy_without_ancestor_paths(
+    root: Folder, repository: Repository, session: Session
+):
+    folder1 = root.create_subfolder("folder1")
+    folder2 = root.create_subfolder("folder2")
+    subfolder = folder1.create_subfolder("subfolder")
+    subfolder.create_document("doc")
+    clear_ancestor_paths(session)
+
+    folder1_copy = repository.copy_object(folder1, folder2)
+    doc_copy = folder1_copy.get_object_by_path("/subfolder/doc")
+    assert doc_copy is not None
+    assert doc_copy.path == "/folder2/folder1/subfolder/doc"
+
+
+def test_delete_without_ancestor_paths(
+    root: Folder, repository: Repository, session: Session
+):
+    folder = root.create_subfolder("folder")
+    subfolder = folder.create_subfolder("subfolder")
+    subfolder.create_document("doc")
+    clear_ancestor_paths(session)
+
+    repository.delete_object(folder)
+    session.flush()
+    assert session.query(CmisObject).all() == [root]
+
+
+def test_move_without_ancestor_paths(
+    root: Folder, repository: Repository, session: Session
+):
+    folder1 = root.create_subfolder("folder1")
+    folder2 = root.create_subfolder("folder2")
+    subfolder = folder1.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    clear_ancestor_paths(session)
+
+    repository.move_objects([folder1], folder2)
+    session.flush()
+    session.expire_all()
+    assert doc._ancestor_path == f"/{root.id}/{folder2.id}/{folder1.id}/{subfolder.id}/"
+    assert doc.path == "/folder2/folder1/subfolder/doc"
+
+
+def test_move_updates_ancestor_path(
+    root: Folder, repository: Repository, session: Session
+):
+    folder1 = root.create_subfolder("folder1")
+    folder2 = root.create_subfolder("folder2")
+    subfolder = folder1.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    session.flush()
+
+    repository.move_object(folder1, folder2)
+    # not yet flushed: computed from in-memory parents
+    assert doc.path == "/folder2/folder1/subfolder/doc"
+
+    session.flush()
+    expected = f"/{root.id}/{folder2.id}/{folder1.id}/{subfolder.id}/"
+    assert doc._ancestor_path == expected
+    assert doc.path == "/folder2/folder1/subfolder/doc"
+
+    session.expire_all()
+    assert doc._ancestor_path == expected
+    assert folder1.depth == 2
+
+
+def test_move_objects(root: Folder, repository: Repository, session: Session):
+    folder1 = root.create_subfolder("folder1")
+    subfolder = folder1.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    doc1 = root.create_document("doc1")
+    doc2 = root.create_document("doc2")
+    folder2 = root.create_subfolder("folder2")
+    folder2.create_document("doc2")
+    session.flush()
+
+    objects: list[CmisObject] = [folder1, doc1, doc2]
+    assert repository.conflicting_objects(objects, folder2) == [doc2]
+    # moving objects to their own folder is a no-op, not a conflict
+    assert repository.conflicting_objects(objects, root) == []
+
+    repository.move_objects([folder1, doc1], folder2)
+    assert root.children == [folder2, doc2]
+    assert folder1.parent is folder2
+    assert doc1.path == "/folder2/doc1"
+    expected = f"/{root.id}/{folder2.id}/{folder1.id}/{subfolder.id}/"
+    assert doc._ancestor_path == expected
+    assert doc.path == "/folder2/folder1/subfolder/doc"
+
+    session.flush()
+    session.expire_all()
+    assert doc._ancestor_path == expected
+    assert {c.title for c in folder2.children} == {"doc1", "doc2", "folder1"}
+
+
+def test_move_updated_at_and_audit(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    user = User(email="user@example.com")
+    session.add(user)
+    session.flush()
+    start_services(["audit"])
+    with login(user):
+        folder1 = root.create_subfolder("folder1")
+        folder2 = root.create_subfolder("folder2")
+        doc = root.create_document("doc")
+        session.flush()
+        updated_at = doc.updated_at
+
+        repository.move_objects([folder1, doc], folder2)
+        session.flush()
+
+    session.expire_all()
+    assert doc.updated_at > updated_at
+    entries = AuditEntry.query.filter(
+        AuditEntry.type == UPDATE, AuditEntry.entity_id.in_([folder1.id, doc.id])
+    ).all()
+    assert sorted(entry.entity_id for entry in entries) == [folder1.id, doc.id]
+    entry = next(entry for entry in entries if entry.entity_id == doc.id)
+    assert entry.entity_name == "/folder2/doc"
+    assert entry.user_id == user.id
+    assert entry.changes.columns["_parent_id"] == (root.id, folder2.id)
+
+
+def test_get_object_by_path(root: Folder, repository: Repository, session: Session):
+    folder = root.create_subfolder("folder")
+    subfolder = folder.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    root.create_document("doc")
+    session.flush()
+
+    assert root.get_object_by_path("/") is root
+    assert root.get_object_by_path("/folder") is folder
+    assert root.get_object_by_path("/folder/subfolder/doc") is doc
+    assert root.get_object_by_path("/folder/doc") is None
+    assert root.get_object_by_path("/missing/subfolder") is None
+
+    assert repository.get_object_by_path("/folder/subfolder") is subfolder
+    assert repository.get_folder_by_path("/folder/subfolder") is subfolder
+    assert repository.get_folder_by_path("/folder/subfolder/doc") is None
+    assert repository.get_document_by_path("/folder/subfolder/doc") is doc
+
+
+def test_list_children(root: Folder, repository: Repository, session: Session):
+    folder = root.create_subfolder("folder")
+    for idx, name in enumerate(["b", "d", "a", "c"]):
+        doc = folder.create_document(name)
+        doc.content = b"x" * (idx + 1)
+    folder.create_subfolder("z")
+    session.flush()
+
+    def titles(objs):
+        return [obj.title for obj in objs]
+
+    items, after = repository.list_children(folder, limit=10)
+    assert titles(items) == ["z", "a", "b", "c", "d"]
+    assert after is None
+
+    pages = []
+    after = None
+    while True:
+        items, after = repository.list_children(folder, limit=2, after=after)
+        pages.append(titles(items))
+        if after is None:
+            break
+    assert pages == [["z", "a"], ["b", "c"], ["d"]]
+
+    items, after = repository.list_children(folder, sort="size", reverse=True)
+    assert titles(items) == ["z", "c", "a", "d", "b"]
+
+    items, after = repository.list_children(folder, search="A")
+    assert titles(items) == ["a"]
+
+    items, after = repository.list_children(folder, object_type="document", limit=3)
+    assert titles(items) == ["a", "b", "c"]
+    items, after = repository.list_children(
+        folder, object_type="document", limit=3, after=after
+    )
+    assert titles(items) == ["d"]
+    assert after is None
+
+
+def test_content_blob_deduplication(
+    root: Folder, repository: Repository, session: Session
+):
+    doc1 = root.create_document("doc1")
+    doc1.set_content(b"content", "text/plain")
+    doc2 = root.create_document("doc2")
+    session.flush()
+    doc2.set_content(b"content", "text/plain")
+    session.flush()
+    assert doc2.content_blob is doc1.content_blob
+
+    copy = repository.copy_object(doc1, root, "copy")
+    session.flush()
+    assert copy.content_blob is doc1.content_blob
+    blob = doc1.content_blob
+
+    # still referenced by doc2 and copy
+    repository.delete_object(doc1)
+    doc2.set_content(b"new content", "text/plain")
+    session.flush()
+    assert sa.inspect(blob).persistent
+    assert copy.content == b"content"
+
+    # not referenced anymore: deleted during next flush
+    repository.delete_object(copy)
+    session.flush()
+    assert blob in session.deleted
+    session.flush()
+    assert sa.inspect(blob).deleted
+
+
+def test_delete_tree(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    folder = root.create_subfolder("folder")
+    subfolder = folder.create_subfolder("subfolder")
+    doc1 = subfolder.create_document("doc1")
+    doc1.set_content(b"content", "text/plain")
+    doc2 = root.create_document("doc2")
+    doc2.set_content(b"content", "text/plain")
+    doc3 = folder.create_document("doc3")
+    doc3.set_content(b"other content", "text/plain")
+    session.flush()
+    ids = [folder.id, subfolder.id, doc1.id, doc3.id]
+    shared_blob = doc2.content_blob
+    blob_id = doc3.content_blob.id
+
+    repository.delete_object(folder)
+    session.flush()
+    assert root.children == [doc2]
+    session.expire_all()
+    assert session.query(CmisObject).filter(CmisObject.id.in_(ids)).count() == 0
+    assert session.query(Blob).get(blob_id) is None
+    # still used by doc2
+    assert doc2.content_blob is shared_blob
+    assert doc2.content == b"content"
+
+
+def test_delete_tree_task(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    app.config["SBE_DELETE_TASK_THRESHOLD"] = 1
+    folder = root.create_subfolder("folder")
+    doc = folder.create_subfolder("subfolder").create_document("doc")
+    doc.set_content(b"content", "text/plain")
+    session.commit()
+    folder_id = folder.id
+
+    repository.delete_object(folder)
+    # deleted after commit
+    assert session.query(Folder).get(folder_id) is not None
+    with mock.patch.object(tasks.delete_tree, "apply_async") as apply_async:
+        session.commit()
+    apply_async.assert_called_once_with((folder_id, 0), {})
+
+    tasks.delete_tree.apply((folder_id, 0))
+    session.expire_all()
+    assert session.query(Folder).get(folder_id) is None
+    assert root.children == []
+
+
+def test_has_access(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    start_services(["security"])
+    user = User(email="user@example.com")
+    session.add(user)
+    folder = root.create_subfolder("folder")
+    subfolder = folder.create_subfolder("subfolder")
+    doc = subfolder.create_document("doc")
+    other = root.create_document("other")
+    session.flush()
+    objects: list[CmisObject] = [folder, subfolder, doc, other]
+
+    assert repository.filter_accessible(user, objects) == []
+    assert repository.has_access(user, root)
+
+    security.grant_role(user, Reader, folder)
+    assert repository.filter_accessible(user, objects) == [folder, subfolder, doc]
+    assert repository.filter_with_permission(user, READ, root.children) == [folder]
+    assert repository.readable_children_counts(user, [root, folder, subfolder]) == {
+        root.id: 1,
+        folder.id: 1,
+        subfolder.id: 1,
+    }
+    assert repository.check_permission(user, WRITE, objects) == [False] * 4
+
+    # security isn't inherited anymore
+    security.set_inherit_security(subfolder, False)
+    assert repository.filter_accessible(user, objects) == [folder]
+
+    security.grant_role(user, Writer, subfolder)
+    assert repository.check_permission(user, WRITE, objects) == [
+        False,
+        True,
+        True,
+        False,
+    ]
+    for obj in objects:
+        for permission in (READ, WRITE):
+            expected = security.has_permission(user, permission, obj, inherit=True)
+            assert repository.has_permission(user, permission, obj) == expected
+
+
+def test_readable_children_counts(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    start_services(["security"])
+    user = User(email="user@example.com")
+    group = Group(name="group")
+    user.groups.add(group)
+    session.add_all([user, group])
+    folder = root.create_subfolder("folder")
+    private = folder.create_subfolder("private")
+    shared = folder.create_document("shared")
+    mine = folder.create_document("mine")
+    hidden = folder.create_document("hidden")
+    session.flush()
+    for obj in (private, shared, mine, hidden):
+        security.set_inherit_security(obj, False)
+    security.grant_role(group, Reader, shared)
+    security.add_permission(READ, Creator, mine)
+    mine.creator = user
+    session.flush()
+    parents = [root, folder]
+
+    def expected():
+        return {
+            parent.id: len(
+                repository.filter_with_permission(user, READ, parent.children)
+            )
+            for parent in parents
+        }
+
+    # children are counted without loading them
+    loaded = []
+
+    def on_load(obj, context):
+        loaded.append(obj)
+
+    session.expunge(private)
+    session.expunge(hidden)
+    sa.event.listen(CmisObject, "load", on_load, propagate=True)
+    try:
+        counts = repository.readable_children_counts(user, parents)
+    finally:
+        sa.event.remove(CmisObject, "load", on_load)
+    assert loaded == []
+    assert counts == {root.id: 0, folder.id: 2} == expected()
+
+    security.grant_role(user, Reader, folder)
+    assert repository.readable_children_counts(user, parents) == {
+        root.id: 1,
+        folder.id: 2,
+    }
+    session.add(private)
+    security.set_inherit_security(private, True)
+    counts = repository.readable_children_counts(user, parents)
+    assert counts == {root.id: 1, folder.id: 3} == expected()
+
+
+def test_folder_acl(
+    app: Application, root: Folder, repository: Repository, session: Session
+):
+    start_services(["security"])
+    user1 = User(email="user1@example.com")
+    user2 = User(email="user2@example.com")
+    session.add_all([user1, user2])
+    top = root.create_subfolder("top")
+    sub = top.create_subfolder("sub")
+    doc = sub.create_document("doc")
+    other = root.create_subfolder("other")
+    session.flush()
+
+    def stored(folder):
+        query = sa.select([folder_acl.c.principal]).where(
+            folder_acl.c.folder_id == folder.id
+        )
+        return {row[0] for row in session.execute(query)}
+
+    security.grant_role(user1, Reader, top)
+    security.grant_role(user2, Reader, top)
+    session.flush()
+    both = {"role:admin", f"user:{user1.id}", f"user:{user2.id}"}
+    assert stored(top) == stored(sub) == both
+    assert effective_principals(doc) == both
+
+    security.set_inherit_security(sub, False)
+    security.grant_role(user2, Writer, sub)
+    session.flush()
+    assert stored(top) == both
+    assert stored(sub) == {"role:admin", f"user:{user2.id}"}
+    assert effective_principals(doc) == {"role:admin", f"user:{user2.id}"}
+
+    security.ungrant_role(user2, Writer, sub)
+    session.flush()
+    assert stored(sub) == {"role:admin"}
+
+    security.set_inherit_security(sub, True)
+    session.flush()
+    assert stored(sub) == both
+
+    # moved folders get the principals of their new parent
+    security.grant_role(user1, Reader, other)
+    repository.move_objects([sub], other)
+    assert stored(sub) == {"role:admin", f"user:{user1.id}"}
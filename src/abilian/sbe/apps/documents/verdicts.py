@@ -0,0 +1,101 @@
+"""Antivirus verdicts, cached by content digest and signature database
+version."""
+from __future__ import annotations
+
+import logging
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import Column
+from sqlalchemy.types import Boolean, DateTime, String
+
+from abilian.core.extensions import db
+from abilian.core.models.blob import Blob
+from abilian.core.util import utcnow
+from abilian.services import get_service
+from abilian.services.antivirus.service import clamd
+
+logger = logging.getLogger(__name__)
+
+#: seconds during which the signature database version is not asked again
+VERSION_TTL = 60
+
+#: verdicts of already scanned contents, see :func:`scan`
+antivirus_verdict = sa.Table(
+    "antivirus_verdict",
+    db.metadata,
+    Column("digest", String(64), primary_key=True),
+    Column("signature_version", String(64), primary_key=True),
+    Column("clean", Boolean, nullable=False),
+    Column("scanned_at", DateTime, nullable=False),
+)
+
+# (expiry time, version)
+_version: tuple[float, str | None] = (0.0, None)
+
+
+def signature_version() -> str | None:
+    """Return the engine and signature database version of the antivirus,
+    e.g. "0.103.8/26940", or `None` if it is not available."""
+    global _version
+
+    expires, version = _version
+    if time.monotonic() < expires:
+        return version
+
+    version = None
+    # `clamd` is None when the client library is not installed
+    if clamd is not None:
+        try:
+            # "ClamAV 0.103.8/26940/Fri Jun 16 07:26:49 2023"
+            full_version = clamd.version()
+        except Exception as e:
+            logger.warning("Can't get antivirus version: %r", e)
+        else:
+            version = "/".join(full_version.split(" ", 1)[-1].split("/")[:2])
+
+    _version = (time.monotonic() + VERSION_TTL, version)
+    return version
+
+
+def scan(session: Session, blob: Blob, digest: str | None) -> bool | None:
+    """Scan `blob`, unless a content with the same `digest` was already
+    scanned with the current signature database.
+
+    Return the verdict, like :meth:`AntiVirusService.scan`: True if clean,
+    False if a virus is detected, None if the content could not be scanned.
+    """
+    antivirus = get_service("antivirus")
+    version = signature_version() if digest else None
+    if version is None:
+        return antivirus.scan(blob)
+
+    query = sa.select([antivirus_verdict.c.clean]).where(
+        sa.and_(
+            antivirus_verdict.c.digest == digest,
+            antivirus_verdict.c.signature_version == version,
+        )
+    )
+    clean = session.execute(query).scalar()
+    if clean is not None:
+        blob.meta["antivirus"] = clean
+        return clean
+
+    clean = antivirus.scan(blob)
+    if clean is not None:
+        try:
+            with session.begin_nested():
+                session.execute(
+                    antivirus_verdict.insert().values(
+                        digest=digest,
+                        signature_version=version,
+                        clean=clean,
+                        scanned_at=utcnow(),
+                    )
+                )
+        except sa.exc.IntegrityError:
+            # scanned concurrently
+            pass
+
+    return clean
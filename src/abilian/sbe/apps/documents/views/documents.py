@@ -1,19 +1,10 @@
 from __future__ import annotations
 
-from datetime import datetime
 from urllib.parse import quote
 
 import sqlalchemy as sa
 import sqlalchemy.orm
-from flask import (
-    current_app,
-    flash,
-    g,
-    make_response,
-    redirect,
-    render_template,
-    request,
-)
+from flask import current_app, flash, g, redirect, render_template, request, send_file
 from flask_login import current_user
 from flask_mail import Message
 from werkzeug.exceptions import BadRequest, NotFound
@@ -25,7 +16,9 @@ from abilian.core.util import unwrap
 from abilian.i18n import _, render_template_i18n
 from abilian.sbe.apps.communities.common import object_viewers
 from abilian.sbe.apps.communities.views import default_view_kw
+from abilian.sbe.apps.documents.lock import LockedError
 from abilian.sbe.apps.documents.models import Document
+from abilian.sbe.apps.documents.renditions import RenditionKey, renditions
 from abilian.sbe.apps.documents.repository import repository
 from abilian.sbe.apps.documents.tasks import convert_document_content, preview_document
 from abilian.services import audit_service
@@ -53,6 +46,9 @@ route = blueprint.route
 
 MAX_PREVIEW_SIZE = 1000
 
+#: seconds during which browsers can use a cached preview image
+RENDITION_MAX_AGE = 365 * 24 * 3600
+
 __all__ = ()
 
 
@@ -165,7 +161,7 @@ def document_upload(doc_id):
     check_write_access(doc)
 
     fd = request.files["file"]
-    doc.set_content(fd.read(), fd.content_type)
+    doc.set_content_from_file(fd, fd.content_type)
     del doc.lock
 
     self = unwrap(current_app)
@@ -177,12 +173,35 @@ def document_upload(doc_id):
 
 @route("/doc/<int:doc_id>/download")
 def document_download(doc_id: int, attach: bool = False) -> Response:
-    """Download the file content."""
+    """Download the file content.
+
+    The content is streamed from the blob store (or handed off to the
+    front server if `USE_X_SENDFILE` is set), and supports conditional
+    and range requests.
+    """
     doc = get_document(doc_id)
+    blob = doc.content_blob
+    path = blob.file if blob is not None else None
+    if path is None or not path.exists():
+        raise NotFound()
 
-    response = make_response(doc.content)
-    response.headers["content-length"] = doc.content_length
+    response = send_file(str(path), add_etags=False, conditional=False)
     response.headers["content-type"] = doc.content_type
+    # send_file() marks the response as public: documents are not.
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = None
+    response.expires = None
+
+    response.set_etag(doc.content_digest or blob.md5)
+    response.last_modified = doc.updated_at
+    # when using X-Sendfile, the front server handles range requests itself
+    response.make_conditional(
+        request,
+        accept_ranges=not current_app.use_x_sendfile,
+        complete_length=path.stat().st_size,
+    )
 
     if not attach:
         attach = request.args.get("attach", False)
@@ -210,12 +229,11 @@ def checkin_checkout(doc_id):
     session = sa.orm.object_session(doc)
 
     if action in ("lock", "checkout"):
-        doc.lock = current_user
-        d = doc.updated_at
-        # prevent change of last modification date
-        doc.updated_at = datetime.utcnow()
-        session.flush()
-        doc.updated_at = d
+        try:
+            doc.lock = current_user
+        except LockedError:
+            flash(_("This document is locked by another user."), "error")
+            return redirect(url_for(doc))
         session.commit()
 
         if action == "lock":
@@ -225,11 +243,6 @@ def checkin_checkout(doc_id):
 
     if action == "unlock":
         del doc.lock
-        d = doc.updated_at
-        # prevent change of last modification date
-        doc.updated_at = datetime.utcnow()
-        session.flush()
-        doc.updated_at = d
         session.commit()
         return redirect(url_for(doc))
 
@@ -244,11 +257,15 @@ def preview_missing_image():
 
 @route("/doc/<int:doc_id>/preview_image")
 def document_preview_image(doc_id: int) -> Response:
-    """Returns a preview (image) for the file given by its id."""
+    """Returns a preview (image) for the file given by its id.
+
+    Renditions are cached on disk: once computed, they are served without
+    loading the document content.
+    """
 
     doc = get_document(doc_id)
 
-    if not doc.antivirus_ok:
+    if not doc.antivirus_ok or not doc.content_digest:
         return preview_missing_image()
 
     size = int(request.args.get("size", 0))
@@ -257,34 +274,58 @@ def document_preview_image(doc_id: int) -> Response:
     if size > MAX_PREVIEW_SIZE:
         size = MAX_PREVIEW_SIZE
 
-    # compute image if size != standard document size
-    get_image = converter.get_image if size == doc.preview_size else converter.to_image
-
-    content_type = "image/jpeg"
+    page = int(request.args.get("page", 0))
 
     if doc.content_type.startswith("image/svg"):
-        image = doc.content
+        key = RenditionKey(doc.content_digest, 0, 0, "svg")
         content_type = doc.content_type
     elif doc.content_type.startswith("image/"):
-        image = doc.content
-        if size:
-            image = resize(image, size, size, mode=FIT)
+        key = RenditionKey(doc.content_digest, 0, size, "jpeg")
+        content_type = "image/jpeg"
     else:
-        page = int(request.args.get("page", 0))
-        try:
-            image = get_image(doc.digest, doc.content, doc.content_type, page, size)
-        except BaseException:
-            # TODO: use generic "conversion failed" image
-            image = ""
+        key = RenditionKey(doc.content_digest, page, size, "jpeg")
+        content_type = "image/jpeg"
 
-    if not image:
-        return preview_missing_image()
+    if key.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        path = renditions.get(key)
+        if path is None:
+            image = _preview_image(doc, page, size)
+            if not image:
+                return preview_missing_image()
+            path = renditions.put(key, image)
+
+        response = send_file(
+            str(path), mimetype=content_type, add_etags=False, conditional=False
+        )
 
-    response = make_response(image)
-    response.headers["content-type"] = content_type
+    response.set_etag(key.etag)
+    # the digest is part of the etag: a rendition never changes
+    cache_control = f"private, max-age={RENDITION_MAX_AGE}, immutable"
+    response.headers["Cache-Control"] = cache_control
     return response
 
 
+def _preview_image(doc: Document, page: int, size: int) -> bytes:
+    if doc.content_type.startswith("image/svg"):
+        return doc.content
+
+    if doc.content_type.startswith("image/"):
+        image = doc.content
+        if size:
+            image = resize(image, size, size, mode=FIT)
+        return image
+
+    # compute image if size != standard document size
+    get_image = converter.get_image if size == doc.preview_size else converter.to_image
+    try:
+        return get_image(doc.digest, doc.content, doc.content_type, page, size)
+    except BaseException:
+        # TODO: use generic "conversion failed" image
+        return b""
+
+
 @route("/doc/<int:doc_id>/refresh_preview")
 def refresh_preview(doc_id):
     """Force to compute a new preview."""
@@ -3,15 +3,14 @@ from __future__ import annotations
 import fnmatch
 import itertools
 import logging
-import os
 import re
-import tempfile
 from datetime import datetime
 from functools import partial
-from io import StringIO
-from typing import IO, Any, Iterator
+from io import RawIOBase, StringIO
+from pathlib import Path
+from typing import IO, Any, Iterator, cast
 from urllib.parse import quote
-from zipfile import ZipFile, is_zipfile
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo, is_zipfile
 
 import sqlalchemy as sa
 import whoosh.query as wq
@@ -26,7 +25,6 @@ from flask import (
     render_template,
     render_template_string,
     request,
-    send_file,
     session,
 )
 from flask_login import current_user
@@ -43,8 +41,8 @@ from abilian.core.util import unwrap
 from abilian.i18n import _, _n
 from abilian.sbe.apps.communities.views import default_view_kw
 from abilian.sbe.apps.documents.models import Document, Folder, icon_for, icon_url
-from abilian.sbe.apps.documents.repository import repository
-from abilian.sbe.apps.documents.search import reindex_tree
+from abilian.sbe.apps.documents.repository import LISTING_SORT_KEYS, repository
+from abilian.sbe.apps.documents.search import reindex_requested_at, reindex_tree
 from abilian.services import get_service
 from abilian.services.security import READ, WRITE, Role, security
 from abilian.web import csrf, http, url_for
@@ -83,7 +81,17 @@ def folder_view(folder_id):
     folder = get_folder(folder_id)
     bc = breadcrumbs_for(folder)
     actions.context["object"] = folder
-    ctx = {"folder": folder, "children": folder.filtered_children, "breadcrumbs": bc}
+    children, next_url = list_children(folder, ".folder_view")
+    subfolders = [obj for obj in children if obj.is_folder]
+    ctx = {
+        "folder": folder,
+        "children": children,
+        "children_counts": repository.readable_children_counts(
+            current_user, subfolders
+        ),
+        "next_url": next_url,
+        "breadcrumbs": bc,
+    }
 
     view_style = session.get("sbe_doc_view_style", "thumbnail_view")
     if view_style == "thumbnail_view":
@@ -96,6 +104,67 @@ def folder_view(folder_id):
     return resp
 
 
+@route("/folder/<int:folder_id>/children")
+def folder_children(folder_id):
+    """Return a page of the folder content, as JSON."""
+    folder = get_folder(folder_id)
+    children, next_url = list_children(folder, ".folder_children")
+    community_id = folder.community.slug
+    items = []
+    for obj in children:
+        item = {
+            "id": obj.id,
+            "type": obj.sbe_type,
+            "title": obj.title,
+            "created_at": obj.created_at.isoformat(),
+            "url": url_for(obj, community_id=community_id),
+        }
+        if obj.is_document:
+            item["content_type"] = obj.content_type
+            item["content_length"] = obj.content_length
+        items.append(item)
+
+    return jsonify(items=items, next=next_url)
+
+
+def list_children(folder: Folder, endpoint: str) -> tuple[list[Any], str | None]:
+    """Return the page of `folder` children requested by the query string,
+    and the URL of the next page (if any) on `endpoint`."""
+    args = {
+        "sort": request.args.get("sort", "title"),
+        "order": request.args.get("order", "asc"),
+        "q": request.args.get("q", "").strip(),
+        "type": request.args.get("type") or None,
+    }
+    if args["sort"] not in LISTING_SORT_KEYS:
+        args["sort"] = "title"
+    if args["type"] not in (None, "folder", "document"):
+        args["type"] = None
+
+    children, after = repository.list_children(
+        folder,
+        user=current_user,
+        sort=args["sort"],
+        reverse=args["order"] == "desc",
+        after=request.args.get("after", type=int),
+        limit=current_app.config["SBE_FOLDER_PAGE_SIZE"],
+        search=args["q"],
+        object_type=args["type"],
+    )
+
+    next_url = None
+    if after is not None:
+        args = {k: v for k, v in args.items() if v}
+        next_url = url_for(
+            endpoint,
+            community_id=g.community.slug,
+            folder_id=folder.id,
+            after=after,
+            **args,
+        )
+    return children, next_url
+
+
 @route("/folder/change_view_style/<int:folder_id>", methods=["GET", "POST"])
 @csrf.protect
 def change_view_style(folder_id):
@@ -126,18 +195,13 @@ def folder_json(folder_id):
     folder = get_folder(folder_id)
     folder_url = partial(url_for, ".folder_json")
     result = {}
-    has_permission = security.has_permission
-    result["current_folder_selectable"] = has_permission(
-        current_user, WRITE, folder, inherit=True
+    result["current_folder_selectable"] = repository.has_permission(
+        current_user, WRITE, folder
     )
     folders = result["folders"] = []
     bc = result["breadcrumbs"] = []
     subfolders = sorted(
-        (
-            f
-            for f in folder.subfolders
-            if has_permission(current_user, READ, f, inherit=True)
-        ),
+        repository.filter_with_permission(current_user, READ, folder.subfolders),
         key=lambda f: f.title,
     )
 
@@ -282,6 +346,7 @@ def permissions(folder_id):
         "audit_entries": audit_entries,
         "all_groups": all_groups,
         "breadcrumbs": bc,
+        "reindex_requested_at": reindex_requested_at(folder),
     }
     return render_template("documents/permissions.html", **ctx)
 
@@ -730,6 +795,81 @@ def upload_new(folder: Folder) -> Response:
     return redirect(url_for(folder))
 
 
+#: Size of the chunks read from the blob store when building a zip file.
+ZIP_CHUNK_SIZE = 64 * 1024
+
+#: Content types which are already compressed: they are stored as is in zip
+#: files.
+COMPRESSED_CONTENT_TYPES = (
+    "application/gzip",
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.*",
+    "application/vnd.oasis.opendocument.*",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-gzip",
+    "application/x-rar-compressed",
+    "application/zip",
+    "audio/*",
+    "image/*",
+    "video/*",
+)
+
+
+class ZipStream(RawIOBase):
+    """Unseekable file object collecting what a :class:`ZipFile` writes, so
+    that it can be sent while the archive is being built."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        """Return data written since last call."""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_entry(path: str, doc: Document) -> tuple[ZipInfo, Path | None]:
+    """Return the zip entry for `doc`, and the file holding its content."""
+    info = ZipInfo(path, doc.updated_at.timetuple()[:6])
+    content_type = doc.content_type or ""
+    is_compressed = any(
+        fnmatch.fnmatch(content_type, pattern) for pattern in COMPRESSED_CONTENT_TYPES
+    )
+    info.compress_type = ZIP_STORED if is_compressed else ZIP_DEFLATED
+    # rw-r--r--, instead of no permission at all when unzipped on Unix
+    info.external_attr = 0o644 << 16
+    blob = doc.content_blob
+    return info, blob.file if blob is not None else None
+
+
+def iter_zip(entries: list[tuple[ZipInfo, Path | None]]) -> Iterator[bytes]:
+    """Generate a zip file from `entries`, reading files by chunks."""
+    stream = ZipStream()
+    with ZipFile(cast(IO[bytes], stream), "w", ZIP_DEFLATED) as zipfile:
+        for info, blob_path in entries:
+            size = blob_path.stat().st_size if blob_path is not None else 0
+
+            with zipfile.open(info, "w", force_zip64=size > ZIP64_LIMIT) as dest:
+                if blob_path is not None:
+                    with blob_path.open("rb") as src:
+                        for chunk in iter(partial(src.read, ZIP_CHUNK_SIZE), b""):
+                            dest.write(chunk)
+                            yield stream.pop()
+            yield stream.pop()
+
+    yield stream.pop()
+
+
 def download_multiple(folder: Folder) -> Response:
     folders, docs = get_selected_objects(folder)
     if not folders:
@@ -738,42 +878,22 @@ def download_multiple(folder: Folder) -> Response:
     def rel_path(path: str, content: Document) -> str:
         return f"{path}/{content.title}"
 
-    def zip_folder(zipfile: ZipFile, folder: Folder, path: str = "") -> ZipFile:
+    def list_folder(folder: Folder, path: str = "") -> Iterator[Any]:
         for doc in folder.documents:
-            doc_path = rel_path(path, doc)
-            zipfile.writestr(doc_path, doc.content or b"")
+            yield zip_entry(rel_path(path, doc), doc)
 
         for subfolder in folder.filtered_subfolders:
-            zip_folder(zipfile, subfolder, rel_path(path, subfolder))
-        return zipfile
-
-    # if using upstream send file: just create a temps file.
-    # if app is streaming itself: use NamedTemporaryFile so that file is removed
-    # on close()
-    temp_factory = (
-        tempfile.mktemp if current_app.use_x_sendfile else tempfile.NamedTemporaryFile
-    )
-    zip_fn = temp_factory(prefix=f"tmp-{current_app.name}-", suffix=".zip")
-    with ZipFile(zip_fn, "w") as zipfile:
-        for doc in docs:
-            zipfile.writestr(doc.title, doc.content or b"")
-        for subfolder in folders:
-            zip_folder(zipfile, subfolder, subfolder.title)
-
-    if not isinstance(zip_fn, str):
-        zip_fn.seek(0, os.SEEK_END)
-        size = zip_fn.tell()
-        zip_fn.seek(0)
-    else:
-        size = os.path.getsize(zip_fn)
+            yield from list_folder(subfolder, rel_path(path, subfolder))
 
-    resp = send_file(
-        zip_fn,
-        mimetype="application/zip",
-        as_attachment=True,
-        attachment_filename=quote(folder.title.encode("utf8") + b".zip"),
-    )
-    resp.headers.add("Content-Length", str(size))
+    # collect entries first: the archive is streamed after the view has
+    # returned, when the database session is gone.
+    entries = [zip_entry(doc.title, doc) for doc in docs]
+    for subfolder in folders:
+        entries.extend(list_folder(subfolder, subfolder.title))
+
+    filename = quote(folder.title.encode("utf8") + b".zip")
+    resp = Response(iter_zip(entries), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return resp
 
 
@@ -883,10 +1003,9 @@ def move_multiple(folder: Folder) -> Response:
             return redirect(url_for(folder))
         f = f.parent
 
-    exist_in_dest = objects_which_exist_in_dest(objects, target_folder)
+    exist_in_dest = repository.conflicting_objects(objects, target_folder)
     if exist_in_dest:
         # items existing in destination: cancel operation
-        db.session.rollback()
         msg = _(
             "Move elements: canceled, some elements exists in destination "
             "folder: {elements}"
@@ -895,6 +1014,7 @@ def move_multiple(folder: Folder) -> Response:
         flash(msg.format(elements=elements), "error")
         return redirect(current_folder_url)
 
+    repository.move_objects(objects, target_folder)
     db.session.commit()
 
     msg_f = (
@@ -913,17 +1033,6 @@ def move_multiple(folder: Folder) -> Response:
     return redirect(url_for(folder))
 
 
-def objects_which_exist_in_dest(objects, dest):
-    exist_in_dest = []
-    for item in objects:
-        try:
-            with db.session.begin_nested():
-                item.parent = dest
-        except sa.exc.IntegrityError:
-            exist_in_dest.append(item)
-    return exist_in_dest
-
-
 def create_subfolder(folder: Folder) -> Response:
     check_write_access(folder)
 
@@ -972,16 +1081,10 @@ def check_valid_name():
     else:
         raise InternalServerError()
 
-    existing = {e.title for e in parent.children}
-
-    if action in ("folder-edit", "document-edit"):
-        try:
-            existing.remove(obj.title)
-        except KeyError:
-            pass
+    exclude = obj if action in ("folder-edit", "document-edit") else None
 
     result = {}
-    valid = result["valid"] = title not in existing
+    valid = result["valid"] = not repository.title_exists(parent, title, exclude)
     if not valid:
         result["help_text"] = help_text.format(name=title)
 
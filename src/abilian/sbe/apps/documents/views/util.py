@@ -23,12 +23,16 @@ def breadcrumbs_for(obj: Document) -> list[dict[str, str]]:
     if obj is None:
         return []
 
-    bc = [{"label": obj.title}]
-    parent = obj.parent
-    while parent and not parent.is_root_folder:
-        bc = [{"label": parent.title, "path": url_for(parent)}] + bc
-        parent = parent.parent
-
+    # avoid looking up the community of each ancestor
+    community = getattr(g, "community", None)
+    kw = {"community_id": community.slug} if community is not None else {}
+
+    bc = [
+        {"label": parent.title, "path": url_for(parent, **kw)}
+        for parent in obj.ancestors
+        if not parent.is_root_folder
+    ]
+    bc.append({"label": obj.title})
     return bc
 
 
@@ -62,8 +66,11 @@ def get_new_filename(folder: Folder, name: str) -> str:
 
     If name already exists, a numbered suffix is added.
     """
-    existing = {c.name for c in folder.children}
-    renamed = name in existing
+    if folder.id is None:
+        # new folder: has no children yet
+        return name
+
+    renamed = repository.title_exists(folder, name)
 
     if renamed:
         components = name.rsplit(".", 1)
@@ -74,8 +81,7 @@ def get_new_filename(folder: Folder, name: str) -> str:
         # find all numbered suffixes from name-1.ext, name-5.ext,...
         suffixes = (
             n[prefix_len:].rsplit(".", 1)[0]
-            for n in existing
-            if n.startswith(prefix) and n.endswith(ext)
+            for n in repository.titles_like(folder, prefix, ext)
         )
         int_suffixes = [int(val) for val in suffixes if re.match(r"^\d+$", val)]
 
@@ -100,7 +106,7 @@ def create_document(folder: Folder, fs: FileStorage) -> Document:
     name = get_new_filename(folder, name)
     doc = folder.create_document(title=name)
     content_type = fs.content_type or ""
-    doc.set_content(fs.read(), content_type)
+    doc.set_content_from_file(fs, content_type)
 
     if original_name != name:
         # set message after document has been successfully created!
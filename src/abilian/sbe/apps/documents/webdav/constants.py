@@ -19,8 +19,8 @@ DAV_PROPS = [
 #           'MKCOL, DELETE, TRACE, REPORT'
 OPTIONS = (
     "GET, HEAD, POST, PUT, DELETE, OPTIONS, TRACE, PROPFIND, "
-    + "PROPPATCH, MKCOL, COPY, MOVE"
-)  # + ', LOCK, UNLOCK'
+    + "PROPPATCH, MKCOL, COPY, MOVE, LOCK, UNLOCK"
+)
 
 HTTP_CONTINUE = 100
 HTTP_SWITCHING_PROTOCOLS = 101
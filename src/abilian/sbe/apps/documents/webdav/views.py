@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import os.path
-import uuid
+import re
+from html import escape
 
 from flask import Blueprint, request
 from flask_login import current_user
@@ -13,12 +14,14 @@ from werkzeug.wrappers import BaseResponse as Response
 from abilian.core.extensions import db
 from abilian.services import get_service
 
-from .. import repository
+from ..lock import DEPTH_INFINITY, DEPTH_ZERO, LockedError
+from ..repository import repository
 from .constants import (
     DAV_PROPS,
     HTTP_BAD_REQUEST,
     HTTP_CONFLICT,
     HTTP_CREATED,
+    HTTP_LOCKED,
     HTTP_METHOD_NOT_ALLOWED,
     HTTP_MULTI_STATUS,
     HTTP_NO_CONTENT,
@@ -33,6 +36,13 @@ route = webdav.route
 
 __all__ = ["webdav"]
 
+LOCK_TOKEN_RE = re.compile(r"<(?:urn:uuid:|opaquelocktoken:)([^>]+)>")
+
+LOCK_TOKEN_MISMATCH = """<?xml version="1.0" encoding="utf-8" ?>
+<D:error xmlns:D="DAV:">
+    <D:lock-token-matches-request-uri/>
+</D:error>"""
+
 #
 # Utils
 #
@@ -84,6 +94,24 @@ def split_path(path):
     return os.path.dirname(path), os.path.basename(path)
 
 
+def parse_timeout(header: str | None) -> int | None:
+    """Return the first timeout in seconds of a `Timeout` header, or `None`
+    for the default one."""
+    for value in (header or "").split(","):
+        value = value.strip()
+        if value.startswith("Second-"):
+            try:
+                return int(value[len("Second-") :])
+            except ValueError:
+                pass
+    return None
+
+
+def parse_lock_tokens(header: str) -> list[str]:
+    """Return the lock tokens of an `If` or `Lock-Token` header."""
+    return LOCK_TOKEN_RE.findall(header)
+
+
 def get_object(path):
     obj = repository.get_object_by_path(path)
     if obj is None:
@@ -182,7 +210,7 @@ def delete(path):
 
     obj = get_object(path)
 
-    db.session.delete(obj)
+    repository.delete_object(obj)
     db.session.commit()
     return "", HTTP_NO_CONTENT, {}
 
@@ -256,16 +284,30 @@ def propfind(path):
 def lock(path):
     path = normpath(path)
     obj = get_object(path)
-    token = str(uuid.uuid1())
-
-    if repository.is_locked(obj):
-        if not repository.can_unlock(obj):
-            return "", 423, {}
+    timeout = parse_timeout(request.headers.get("Timeout"))
+    tokens = parse_lock_tokens(request.headers.get("If", ""))
+
+    if tokens and not request.data:
+        # lock refresh
+        for token in tokens:
+            lock_ = repository.refresh_lock(obj, token, timeout)
+            if lock_ is not None:
+                break
         else:
-            headers = {"Lock-Token": f"urn:uuid:{token}"}
-            return "TODO", HTTP_OK, headers
+            return "", HTTP_PRECONDITION_FAILED, {}
+    else:
+        depth = request.headers.get("Depth", DEPTH_INFINITY).lower()
+        if depth not in (DEPTH_ZERO, DEPTH_INFINITY):
+            return "", HTTP_BAD_REQUEST, {}
 
-    token = repository.lock(obj)
+        # locks don't extend to folder contents: an "infinity" lock is
+        # granted as a "0" one, which the response reports
+        try:
+            lock_ = repository.lock(obj, timeout=timeout, depth=DEPTH_ZERO)
+        except LockedError:
+            return "", HTTP_LOCKED, {}
+
+    db.session.commit()
 
     xml = f"""<?xml version="1.0" encoding="utf-8" ?>
 <D:prop xmlns:D="DAV:">
@@ -273,72 +315,33 @@ def lock(path):
         <D:activelock>
             <D:lockscope><D:exclusive/></D:lockscope>
             <D:locktype><D:write/></D:locktype>
-            <D:depth>0</D:depth>
-            <D:timeout>Second-179</D:timeout>
-            <D:owner>flora</D:owner>
+            <D:depth>{lock_.depth}</D:depth>
+            <D:timeout>Second-{lock_.timeout}</D:timeout>
+            <D:owner>{escape(lock_.user)}</D:owner>
             <D:locktoken>
-                <D:href>opaquelocktoken:{token}</D:href>
+                <D:href>urn:uuid:{lock_.token}</D:href>
             </D:locktoken>
         </D:activelock>
     </D:lockdiscovery>
 </D:prop>"""
 
-    hlist = [("Content-Type", "text/xml"), ("Lock-Token", f"<urn:uuid:{token}>")]
-
-    return Response(xml, headers=Headers.linked(hlist))  # , status ='423 Locked'
-    # public Response lock(@Context UriInfo uriInfo) throws Exception {
-    #     String token = null;
-    #     Prop prop = null;
-    #     if (backend.isLocked(doc.getRef())) {
-    #         if (!backend.canUnlock(doc.getRef())) {
-    #             return Response.status(423).build();
-    #         } else {
-    #             token = backend.getCheckoutUser(doc.getRef());
-    #             prop = new Prop(getLockDiscovery(doc, uriInfo));
-    #             return Response.ok().entity(prop).header("Lock-Token",
-    #                     "urn:uuid:" + token).build();
-    #         }
-    #     }
-    #
-    #     token = backend.lock(doc.getRef());
-    #     if (READONLY_TOKEN.equals(token)) {
-    #         return Response.status(423).build();
-    #     } else if (StringUtils.isEmpty(token)) {
-    #         return Response.status(400).build();
-    #     }
-    #
-    #     prop = new Prop(getLockDiscovery(doc, uriInfo));
-    #
-    #     backend.saveChanges();
-    #     return Response.ok().entity(prop).header("Lock-Token",
-    #             "urn:uuid:" + token).build();
-    # }
+    hlist = [("Content-Type", "text/xml"), ("Lock-Token", f"<urn:uuid:{lock_.token}>")]
+
+    return Response(xml, headers=Headers.linked(hlist))
 
 
 @route("/<path:path>", methods=["UNLOCK"])
 def unlock(path):
     path = normpath(path)
     obj = get_object(path)
+    tokens = parse_lock_tokens(request.headers.get("Lock-Token", ""))
+    if not tokens:
+        return "Missing Lock-Token header.", HTTP_BAD_REQUEST, {}
 
-    if repository.is_locked(obj):
-        if not repository.can_unlock(obj):
-            return "", 423, {}
-        else:
-            repository.unlock(obj)
-            db.session.commit()
-            return "", HTTP_NO_CONTENT, {}
+    if not repository.unlock(obj, tokens[0]):
+        # RFC 4918, section 9.11.1: the token isn't the one of a lock on obj
+        headers = {"Content-Type": "text/xml"}
+        return LOCK_TOKEN_MISMATCH, HTTP_CONFLICT, headers
 
+    db.session.commit()
     return "", HTTP_NO_CONTENT, {}
-    #     if (backend.isLocked(doc.getRef())) {
-    #         if (!backend.canUnlock(doc.getRef())) {
-    #             return Response.status(423).build();
-    #         } else {
-    #             backend.unlock(doc.getRef());
-    #             backend.saveChanges();
-    #             return Response.status(HTTP_NO_CONTENT).build();
-    #         }
-    #     } else {
-    #         // TODO: return an error
-    #         return Response.status(HTTP_NO_CONTENT).build();
-    #     }
-    #
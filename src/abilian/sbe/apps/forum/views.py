@@ -327,7 +327,7 @@ class ThreadCreate(BaseThreadView, views.ObjectCreate):
             attachment.post = self.post
 
             with fileobj.open("rb") as f:
-                attachment.set_content(f.read(), mimetype)
+                attachment.set_content_from_file(f, mimetype)
             session.add(attachment)
 
     def commit_success(self):
@@ -513,7 +513,7 @@ class ThreadPostEdit(BaseThreadView, views.ObjectEdit):
             attachment = PostAttachment(name=name, post=self.obj)
 
             with fileobj.open("rb") as f:
-                attachment.set_content(f.read(), mimetype)
+                attachment.set_content_from_file(f, mimetype)
             session.add(attachment)
 
 
@@ -429,7 +429,7 @@ def attachment_upload() -> Response:
 
         attachment = WikiPageAttachment(name=name)
         attachment.wikipage = page
-        attachment.set_content(f.read(), f.content_type)
+        attachment.set_content_from_file(f, f.content_type)
         db.session.add(attachment)
         saved_count += 1
 